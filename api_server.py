@@ -0,0 +1,412 @@
+# api_server.py>
+# Headless HTTP/JSON API to run SimSS without the Streamlit UI. Runs next to the Streamlit app (behind nginx at /api/)
+# and shares the result cache and parameter handling of utils/. It has its own simss worker pool, run.sh splits the
+# cores between the pools of both processes with SIMSS_WORKERS.
+#
+#   GET    /api/health                          liveness check
+#   POST   /api/simulations                     {"parameters": {"L": "300E-9", ...}, "timeout": 600, "wait": false}
+#                                               Parameters start from device_parameters_default_1.txt, like a reset in
+#                                               the UI. The timeout is capped at SIMSS_TIMEOUT.
+#   GET    /api/simulations/<id>                status of a simulation, add ?stdout=1 for the console output
+#   DELETE /api/simulations/<id>                cancel a simulation
+#   GET    /api/simulations/<id>/jv             JV.dat, ?format=npz (default, compressed numpy arrays) or json
+#   GET    /api/simulations/<id>/var            Var.dat, same formats, ?vext=<V> for a single voltage
+#   GET    /api/archive                         archived runs, ?limit=<n> most recently used first (token only)
+#   GET    /api/archive/<key>                   compressed archive of a run (npz with its tables, texts and metadata)
+#   GET    /api/archive/export?keys=<k1>,<k2>   zip with the archives of the selected runs, streamed in chunks. Keys may
+#                                               be shortened to unique prefixes of at least 8 characters (token only).
+#   POST   /api/archive/export                  {"keys": [...]} or {"simulations": [<id>, ...]}, same zip
+#
+# The archive holds the runs of every user. Without the token (Authorization: Bearer $SIMSALABIM_API_TOKEN) runs can
+# only be fetched by their full key or simulation id, which only the session or client that ran them knows. Listing
+# and key prefixes need the token.
+#   GET    /api/metrics                         metrics of all app processes in the Prometheus text format
+#
+# Usage: python api_server.py [--host 127.0.0.1] [--port 8502]
+import argparse
+import asyncio
+import gzip
+import hmac
+import inspect
+import io
+import json
+import math
+import os
+import re
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+from utils import dev_par_model as dpm
+from utils import metrics
+from utils import run_archive as ra
+from utils import simss_runner as sr
+from utils import var_sidecar as vs
+from utils import warmup
+
+# Largest accepted request body in bytes
+max_body_size = 1024**2
+# JSON responses larger than this are gzip compressed when the client accepts it
+gzip_min_size = 512
+# Token giving access to the archived runs of all users, the listing is disabled when it is not set
+api_token = os.environ.get('SIMSALABIM_API_TOKEN', '')
+
+status_reasons = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class ApiError(Exception):
+    # Description:  Error returned to the client as {"error": message} with the given HTTP status.
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def get_parameter_values(parameters, base_model):
+    # Description:  Check the parameter overrides of a request: known names, a single number or string per parameter
+    #               that fits on its line and a number for parameters that are numbers by default.
+    # Arguments:    parameters (dict) - parameter name -> value from the request
+    #               base_model (DevParModel) - the default device parameters
+    # Returns:      values (dict) - parameter name -> value as written in the file
+    unknown = [name for name in parameters if name not in base_model]
+    if unknown:
+        raise ApiError(400, 'Unknown parameter(s): ' + ', '.join(sorted(unknown)))
+    values = {}
+    for name, value in parameters.items():
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise ApiError(400, 'Value of ' + name + ' must be a number or a string')
+        try:
+            values[name] = dpm.check_value(name, value)
+        except ValueError as err:
+            raise ApiError(400, str(err))
+        number = dpm.to_number(values[name])
+        if base_model.get_number(name) is not None and (number is None or not math.isfinite(number)):
+            raise ApiError(400, 'Value of ' + name + ' must be a number, not ' + repr(values[name]))
+    return values
+
+def get_timeout(body):
+    # Description:  Wall clock time limit of a requested simulation, at most the limit of the server.
+    # Returns:      timeout (float) - time limit in s, None for the default
+    if body.get('timeout') is None:
+        return None
+    try:
+        timeout = float(body['timeout'])
+    except (TypeError, ValueError):
+        raise ApiError(400, 'timeout must be a number of seconds')
+    if not timeout > 0:
+        raise ApiError(400, 'timeout must be larger than 0')
+    return sr.limit_timeout(timeout)
+
+def get_query_number(query, name, convert):
+    # Description:  Parse a numerical query parameter.
+    # Arguments:    query (dict) - parsed query string
+    #               name (string) - name of the parameter
+    #               convert (function) - int or float
+    # Returns:      value (number) - the value, None when the parameter is not given
+    if name not in query:
+        return None
+    try:
+        value = convert(query[name][0])
+    except ValueError:
+        raise ApiError(400, name + ' must be a number, not ' + repr(query[name][0]))
+    if not math.isfinite(value):
+        raise ApiError(400, name + ' must be finite')
+    return value
+
+def is_authorized(headers):
+    # Description:  Check if a request carries the API token.
+    # Arguments:    headers (dict) - request headers, lower case names
+    # Returns:      authorized (bool)
+    if not api_token:
+        return False
+    return hmac.compare_digest(headers.get('authorization', '').encode(), ('Bearer ' + api_token).encode())
+
+def get_job_or_404(job_id):
+    job = sr.get_job(job_id)
+    if job is None:
+        raise ApiError(404, 'Unknown simulation ' + job_id)
+    return job
+
+def job_to_dict(job, with_stdout=False):
+    # Description:  Status of a job as JSON serializable dict.
+    result = {'id': job.id, 'status': job.status, 'returncode': job.returncode, 'from_cache': job.from_cache,
+                'submitted': job.submitted, 'started': job.started, 'finished': job.finished}
+    if with_stdout:
+        result['stdout'] = job.stdout
+    return result
+
+async def create_simulation(body):
+    # Description:  Apply the parameter overrides to the default parameters and submit the simulation.
+    # Arguments:    body (dict) - parsed request body
+    # Returns:      status (number), result (dict)
+    parameters = body.get('parameters', {})
+    if not isinstance(parameters, dict):
+        raise ApiError(400, 'parameters must be an object of name: value pairs')
+    base_model = warmup.get_default_model()
+    values = get_parameter_values(parameters, base_model)
+    timeout = get_timeout(body)
+    dev_par_variant = base_model.copy()
+    dev_par_variant.update(values)
+    par_file = dev_par_variant.to_txt()
+    job = await asyncio.to_thread(submit_simulation, par_file, timeout)
+    metrics.incr('api.simulations')
+    if body.get('wait') and job.future is not None:
+        await asyncio.wrap_future(job.future)
+    return (200 if job.is_finished() else 202), job_to_dict(job, with_stdout=bool(body.get('wait')))
+
+def submit_simulation(par_file, timeout):
+    # Description:  Create the directory of an API simulation and submit it. Runs in a worker thread: a result cache
+    #               hit copies the output files right away.
+    # Returns:      job (SimssJob) - the submitted job
+    # Every API simulation gets its own directory, cleaned up like the directories of idle Streamlit sessions
+    job_dir = sr.create_session_dir('api_' + os.urandom(8).hex())
+    with open(job_dir + 'device_parameters.txt', 'w') as fp:
+        fp.write(par_file)
+    return sr.submit_simss(par_file, job_dir, timeout=timeout)
+
+def load_output(job, file_name, query):
+    # Description:  Load an output file of a finished job as columns. Runs in a worker thread.
+    # Returns:      columns (dict) - column name -> ndarray
+    import pandas as pd
+    if job.status != 'done':
+        raise ApiError(400, 'Simulation ' + job.id + ' is ' + job.status)
+    path = job.session_dir + file_name
+    if not os.path.isfile(path):
+        raise ApiError(404, file_name + ' not available')
+    if file_name == 'Var.dat':
+        sidecar = vs.open_sidecar(path)
+        vext = get_query_number(query, 'vext', float)
+        if vext is not None and vext not in vs.get_voltages(sidecar):
+            raise ApiError(400, 'No Var.dat data at Vext = ' + str(vext))
+        data = vs.load_columns(sidecar, vs.get_columns(sidecar), vext)
+    else:
+        data = pd.read_csv(path, sep=r'\s+')
+    return {column: data[column].to_numpy() for column in data.columns}
+
+def encode_output(columns, output_format):
+    # Description:  Encode output columns for the response.
+    # Returns:      content_type (string), payload (bytes)
+    if output_format == 'npz':
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **columns)
+        return 'application/octet-stream', buffer.getvalue()
+    if output_format == 'json':
+        return 'application/json', json.dumps({name: values.tolist() for name, values in columns.items()}).encode()
+    raise ApiError(400, 'Unknown format ' + output_format + ', use npz or json')
+
+def get_export_keys(method, query, body, authorized):
+    # Description:  Runs selected for a bulk export, by archive key or by the id of a finished simulation.
+    # Arguments:    authorized (bool) - the request carries the API token, key prefixes are accepted
+    # Returns:      keys (List) - full archive keys
+    if method == 'POST':
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            raise ApiError(400, 'Request body is not valid JSON')
+        if not isinstance(request, dict):
+            raise ApiError(400, 'Request body must be a JSON object')
+        keys = list(request.get('keys', []))
+        simulations = list(request.get('simulations', []))
+    elif method == 'GET':
+        keys = [key for value in query.get('keys', []) for key in value.split(',') if key]
+        simulations = [job_id for value in query.get('simulations', []) for job_id in value.split(',') if job_id]
+    else:
+        raise ApiError(405, 'Use GET or POST')
+    for job_id in simulations:
+        job = get_job_or_404(str(job_id))
+        if job.status != 'done':
+            raise ApiError(400, 'Simulation ' + job.id + ' is ' + job.status)
+        keys.append(job.cache_key)
+    if not keys:
+        raise ApiError(400, 'No runs selected, give keys or simulations')
+    try:
+        return ra.resolve_keys([str(key) for key in keys], prefixes=authorized)
+    except KeyError as err:
+        raise ApiError(404, err.args[0])
+
+def archive_to_dict(archive):
+    # Description:  Summary of an archived run as JSON serializable dict.
+    meta = ra.read_meta(archive['key']) or {}
+    return {'key': archive['key'], 'bytes': archive['bytes'], 'last_used': archive['time'],
+            'source_bytes': meta.get('source_bytes'), 'started': meta.get('started'), 'finished': meta.get('finished'),
+            'tables': {name: table['rows'] for name, table in meta.get('tables', {}).items()}}
+
+async def dispatch_archive(method, path, query, body, headers):
+    # Description:  Handle the /api/archive requests.
+    # Returns:      status (number), content_type (string), payload (bytes, dict or a generator of bytes)
+    authorized = is_authorized(headers)
+    if path == '/api/archive':
+        if not authorized:
+            raise ApiError(403, 'Listing the archived runs needs the API token')
+        limit = get_query_number(query, 'limit', int)
+        if limit is not None and limit < 0:
+            raise ApiError(400, 'limit must be 0 or larger')
+        archives = await asyncio.to_thread(lambda: [archive_to_dict(archive) for archive in ra.list_archives(limit)])
+        return 200, 'application/json', {'runs': archives}
+    if path == '/api/archive/export':
+        keys = await asyncio.to_thread(get_export_keys, method, query, body, authorized)
+        return 200, 'application/zip', ra.iter_export(keys)
+    match = re.fullmatch(r'/api/archive/([0-9a-f]{8,64})', path)
+    if match is None:
+        raise ApiError(404, 'Not found: ' + path)
+    if method != 'GET':
+        raise ApiError(405, 'Use GET')
+    try:
+        key = ra.resolve_keys([match.group(1)], prefixes=authorized)[0]
+        payload = await asyncio.to_thread(ra.read_archive_bytes, key)
+    except (KeyError, OSError):
+        raise ApiError(404, 'Unknown run ' + match.group(1))
+    return 200, 'application/octet-stream', payload
+
+async def dispatch(method, target, body, headers=None):
+    # Description:  Route a request to its handler.
+    # Arguments:    headers (dict) - request headers, lower case names
+    # Returns:      status (number), content_type (string), payload (bytes, dict or a generator of bytes)
+    url = urlsplit(target)
+    query = parse_qs(url.query)
+    path = url.path.rstrip('/')
+    if path == '/api/health':
+        return 200, 'application/json', {'status': 'ok', 'workers': sr.get_worker_count()}
+    if path == '/api/metrics':
+        return 200, 'text/plain; version=0.0.4', metrics.render_metrics().encode()
+    if path == '/api/archive' or path.startswith('/api/archive/'):
+        return await dispatch_archive(method, path, query, body, headers or {})
+    if path == '/api/simulations':
+        if method != 'POST':
+            raise ApiError(405, 'Use POST to submit a simulation')
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            raise ApiError(400, 'Request body is not valid JSON')
+        if not isinstance(request, dict):
+            raise ApiError(400, 'Request body must be a JSON object')
+        status, result = await create_simulation(request)
+        return status, 'application/json', result
+    match = re.fullmatch(r'/api/simulations/([0-9a-f]+)(?:/(jv|var))?', path)
+    if match is None:
+        raise ApiError(404, 'Not found: ' + path)
+    job = get_job_or_404(match.group(1))
+    if match.group(2) is None:
+        if method == 'DELETE':
+            sr.cancel_job(job.id)
+        elif method != 'GET':
+            raise ApiError(405, 'Use GET or DELETE')
+        return 200, 'application/json', job_to_dict(job, with_stdout='stdout' in query)
+    if method != 'GET':
+        raise ApiError(405, 'Use GET')
+    file_name = 'JV.dat' if match.group(2) == 'jv' else 'Var.dat'
+    columns = await asyncio.to_thread(load_output, job, file_name, query)
+    content_type, payload = await asyncio.to_thread(encode_output, columns, query.get('format', ['npz'])[0])
+    return 200, content_type, payload
+
+async def write_stream(writer, status, content_type, chunks, chunked, keep_alive):
+    # Description:  Write a response of unknown length from a generator of bytes, one chunk at a time. The generator
+    #               does file I/O and runs in a worker thread. Without chunked transfer encoding (HTTP/1.0 clients)
+    #               the end of the response is marked by closing the connection.
+    # Returns:      complete (bool) - False when the generator failed, the response is cut off then
+    headers = {'Content-Type': content_type, 'Connection': 'keep-alive' if keep_alive else 'close',
+                # Ask nginx to pass the chunks on instead of buffering the whole response
+                'X-Accel-Buffering': 'no'}
+    if chunked:
+        headers['Transfer-Encoding'] = 'chunked'
+    if content_type == 'application/zip':
+        headers['Content-Disposition'] = 'attachment; filename="simsalabim_runs.zip"'
+    head = 'HTTP/1.1 ' + str(status) + ' ' + status_reasons.get(status, '') + '\r\n'
+    head = head + ''.join(name + ': ' + value + '\r\n' for name, value in headers.items()) + '\r\n'
+    writer.write(head.encode('latin-1'))
+    try:
+        while True:
+            try:
+                chunk = await asyncio.to_thread(next, chunks, None)
+            except Exception as err:
+                metrics.incr('api.errors')
+                metrics.logger.warning('Streamed response failed: ' + str(err))
+                return False
+            if chunk is None:
+                break
+            if chunk:
+                writer.write(format(len(chunk), 'x').encode() + b'\r\n' + chunk + b'\r\n' if chunked else chunk)
+                # Wait for the client to take the chunk before producing the next one
+                await writer.drain()
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        return True
+    finally:
+        chunks.close()
+
+async def write_response(writer, status, content_type, payload, accept_gzip, keep_alive):
+    # Description:  Write a complete HTTP response. JSON payloads are serialized here and gzip compressed when large.
+    if isinstance(payload, (dict, list)):
+        payload = json.dumps(payload).encode()
+    headers = {'Content-Type': content_type, 'Connection': 'keep-alive' if keep_alive else 'close'}
+    if accept_gzip and len(payload) >= gzip_min_size and not content_type.startswith('application/octet-stream'):
+        payload = gzip.compress(payload, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+    headers['Content-Length'] = str(len(payload))
+    head = 'HTTP/1.1 ' + str(status) + ' ' + status_reasons.get(status, '') + '\r\n'
+    head = head + ''.join(name + ': ' + value + '\r\n' for name, value in headers.items()) + '\r\n'
+    writer.write(head.encode('latin-1') + payload)
+    await writer.drain()
+
+async def handle_connection(reader, writer):
+    # Description:  Serve the HTTP/1.1 requests of a single (keep-alive) connection.
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, version = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            accept_gzip = 'gzip' in headers.get('accept-encoding', '')
+            length = int(headers.get('content-length', 0))
+            if length > max_body_size:
+                await write_response(writer, 413, 'application/json', {'error': 'Request body too large'},
+                                    False, False)
+                break
+            body = await reader.readexactly(length) if length else b''
+            with metrics.span('api.request'):
+                try:
+                    status, content_type, payload = await dispatch(method, target, body, headers)
+                except ApiError as err:
+                    status, content_type, payload = err.status, 'application/json', {'error': err.message}
+                except Exception as err:
+                    metrics.incr('api.errors')
+                    status, content_type, payload = 500, 'application/json', {'error': str(err)}
+                if inspect.isgenerator(payload):
+                    chunked = version == 'HTTP/1.1'
+                    keep_alive = keep_alive and chunked
+                    complete = await write_stream(writer, status, content_type, payload, chunked, keep_alive)
+                    keep_alive = keep_alive and complete
+                else:
+                    await write_response(writer, status, content_type, payload, accept_gzip, keep_alive)
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        # Client went away or sent a malformed request
+        pass
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_connection, host, port)
+    metrics.logger.info('SIMsalabim API listening on http://' + host + ':' + str(port) + '/api/')
+    async with server:
+        await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless HTTP/JSON API for SIMsalabim')
+    parser.add_argument('--host', default=os.environ.get('SIMSALABIM_API_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SIMSALABIM_API_PORT', 8502)))
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
 import streamlit as st
+from utils import warmup
+
+warmup.prewarm()
 
 
 st.set_page_config(layout="wide", page_title="SIMsalabim online")
@@ -1,17 +1,29 @@
+import time
 import streamlit as st
-from subprocess import run,PIPE
-from utils import helper_functions as hf
+from utils import dev_par_model as dpm
 from utils import draw_band_diagram as dbd
+from utils import simss_runner as sr
+from utils import result_cache as rc
+from utils import preview
+from utils import voltage_range as vr
+from utils import metrics
+from utils import warmup
+
+page_start = time.perf_counter()
+warmup.prewarm()
 
 # Page configuration
 st.set_page_config(layout="wide", page_title="SIMsalabim device parameters")
 
 # Parameters
 SimSS_path = 'SIMsalabim/SimSS/'
+# Every session edits and simulates in its own directory
+session_dir = sr.get_session_dir(st.session_state)
+status_container = st.empty()
 placeholder = st.empty()
 plot_container_title = st.empty()
 plot_container = st.empty()
-dev_par_object = []
+dev_par_model = None
 
 # Load custom CSS to reduce whitespace between rows in columns. Convert disbaled greyed text back to either white or black.
 
@@ -23,45 +35,139 @@ local_css('./utils/style.css')
 
 # Functions             
 def run_simss():
-    with st.spinner('SIMulating...'):
-        # Temp code to show console output on browser
-        result = run('./simss', cwd=SimSS_path, stdout=PIPE)
-    if result.returncode != 0:
-        # st.error('SIMsalabim raised an error')
-        result_decode = result.stdout.decode('utf-8')
-        st.error('Errocode: ' + str(result.returncode) +'\n\n'+result_decode)
+    # Queue the simulation in the worker pool. The status is polled at the end of the script.
+    job = sr.get_job(st.session_state.get('simss_job'))
+    if job is not None and not job.is_finished():
+        # Only one simulation per session at a time
+        return
+    with open(session_dir+'device_parameters.txt') as fp:
+        par_file = fp.read()
+    # The limit of the server (SIMSS_TIMEOUT) cannot be raised from the page
+    timeout = sr.limit_timeout(st.session_state.get('simss_timeout'))
+    plan = None
+    if not rc.has_entry(rc.get_cache_key(par_file, SimSS_path)):
+        # When only the voltage range changed, simulate just the voltages missing from the current results
+        plan = vr.plan_extension(session_dir, par_file)
+    if plan is not None:
+        job = vr.submit_extension(par_file, session_dir, plan, timeout=timeout)
+    else:
+        job = sr.submit_simss(par_file, session_dir, timeout=timeout)
+    st.session_state['simss_job'] = job.id
+    # Runs of this session, the plot page lists their archives
+    st.session_state['run_keys'] = st.session_state.get('run_keys', []) + [job.cache_key]
+    # Shown until the simulation has finished, computed in the background while the simulation starts
+    if not job.is_finished():
+        st.session_state['simss_preview'] = preview.submit_estimate(dpm.parse_dev_par(par_file))
+
+def show_preview():
+    # Estimate of the JV curve of the current (applied) parameters, without running simss
+    st.session_state['simss_preview'] = preview.submit_estimate(dev_par_model.copy())
+    st.session_state['simss_preview_requested'] = True
+
+def get_preview(wait=False):
+    # The estimated JV curve once it has been computed, None until then or when there is none
+    future = st.session_state.get('simss_preview')
+    if future is None or not (wait or future.done()):
+        return None
+    return future.result()
+
+def get_preview_chart_data(data_jv=None):
+    # Combine the estimated JV curve with the points simulated so far in a table for st.line_chart
+    import pandas as pd
+    estimate = get_preview()
+    columns = []
+    if estimate is not None:
+        columns.append(pd.Series(estimate['Jext'], index=estimate['Vext'], name='Estimate'))
+    if data_jv is not None and 'Jext' in data_jv:
+        columns.append(pd.Series(data_jv['Jext'].to_numpy(), index=data_jv['Vext'].to_numpy(), name='Simulated'))
+    if not columns:
+        return None
+    return pd.concat(columns, axis=1).sort_index()
+
+def describe_preview(estimate):
+    # Caption making clear that the preview is not a simulation result
+    if estimate['exact']:
+        return 'Preview: result of an earlier simulation with the same parameters'
+    return ('Estimate (not a simulation result), interpolated from ' + str(len(estimate['neighbours']))
+            + ' earlier simulation(s) with similar parameters')
+
+def cancel_simss():
+    sr.cancel_job(st.session_state.get('simss_job'))
+
+def show_job_status():
+    # Poll the status of the running job until it is finished. Any user interaction reruns the script and interrupts
+    # this loop, the job itself continues in the worker pool.
+    job = sr.get_job(st.session_state.get('simss_job'))
+    if job is None:
+        return
+    while not job.is_finished():
+        with status_container.container():
+            if job.status == 'queued':
+                st.info('Waiting for a free worker...')
+            else:
+                st.info('SIMulating... (' + str(int(time.time() - job.started)) + ' s)')
+            # Console output and the JV points simulated so far, next to the estimate from earlier simulations
+            col_out, col_jv = st.columns([1,1])
+            with col_out:
+                st.code(''.join(job.output[-15:]) or ' ')
+            with col_jv:
+                chart_data = get_preview_chart_data(sr.read_partial_output(job))
+                if chart_data is not None:
+                    st.line_chart(chart_data, height=250)
+                if get_preview() is not None:
+                    st.caption(describe_preview(get_preview()))
+        time.sleep(0.5)
+    st.session_state.pop('simss_preview', None)
+    if job.status == 'cancelled':
+        status_container.warning('Simulation cancelled')
+    elif job.status == 'failed':
+        status_container.error('Errocode: ' + str(job.returncode) +'\n\n'+job.stdout)
+    elif job.from_cache:
+        status_container.success('Simulation complete (result reused from an identical earlier run)')
     else:
-        st.success('Simulation complete')
+        status_container.success('Simulation complete')
+    del st.session_state['simss_job']
 
 def save_parameters():
-    par_file = hf.write_to_txt(dev_par_object)
-    
-    # Open the device_parameters file and write content of par_file to it. Close the file afterwards.
-    with open(SimSS_path+'device_parameters.txt', 'w') as fp:
-        fp.write(par_file)
-        fp.close()
-        # Draw the band diagram
-    get_param_band_diagram(dev_par_object)
+    # Write the model of this session to the device_parameters file. Only the lines of changed parameters are rewritten.
+    with metrics.span('params.write'):
+        dpm.write_cached_model(st.session_state, session_dir+'device_parameters.txt', dev_par_model)
+    st.session_state['unsaved_sections'] = set()
+    # Draw the band diagram
+    get_param_band_diagram(dev_par_model)
+
+def apply_section(par_section, values):
+    # Apply the submitted values of a section form to the model of this session. The file is written on save.
+    try:
+        changed = dev_par_model.update(values)
+    except ValueError as err:
+        st.error(str(err))
+        return
+    if changed:
+        st.session_state.setdefault('unsaved_sections', set()).add(par_section[0])
+
+def show_unsaved_sections():
+    # Warn about applied but unsaved sections, nothing when all changes have been saved
+    if st.session_state.get('unsaved_sections'):
+        unsaved_container.warning('Unsaved changes in: ' + ', '.join(sorted(st.session_state['unsaved_sections'])))
+    else:
+        unsaved_container.empty()
 
 def close_figure():
     # Close the band diagram containers
     plot_container = st.empty
     plot_container_title = st.empty
 
-def get_param_band_diagram(dev_par_object): 
-    # A fixed list of parameters must be supplied to create the band diagram.
-    plot_param = {}
-    plot_param_keys = ['L','L_LTL','L_RTL','CB','VB','W_L','W_R','CB_LTL','CB_RTL','VB_LTL','VB_RTL']
-    # Find the parameter in the main object and assign it to its key in the dict.
-    for section in dev_par_object[1:]:
-        for param in section:
-            if (param[1] in plot_param_keys):      
-                plot_param[param[1]]=param[2]
+def get_param_band_diagram(dev_par_model): 
+    # A fixed list of parameters must be supplied to create the band diagram. Look them up in the model index.
+    plot_param = {key: dev_par_model.get(key) for key in dbd.band_param_keys}
     # Band diagram will fail when the width the transport layers exceeds the device width. Early exit when this is the case.
     if (float(plot_param['L'])-float(plot_param['L_LTL'])-float(plot_param['L_RTL']) <= 0):
         st.error('Cannot create band diagram, Width of transport layers (L_LTL + L_RTL) is larger than the device width (L)')
-    else:
-        fig = dbd.create_band_energy_diagram(plot_param)
+        return
+    # Rendered (or taken from the memoized renderer) as PNG, no figure object is kept around
+    with metrics.span('band_diagram.get'):
+        band_diagram = dbd.render_band_diagram(plot_param)
 
     # Initialize the plot containers again and split into (virtual) columns to position correctly.
     plot_container_title=st.empty()
@@ -77,7 +183,7 @@ def get_param_band_diagram(dev_par_object):
     with plot_container:
         col_plot_1, col_plot_2, col_plot_3 = st.columns([3,4,4])
         with col_plot_2:
-            st.pyplot(fig)
+            st.image(band_diagram)
         with col_plot_3:
             st.markdown('''<em>Note: Band diagram is not to scale</em>''',unsafe_allow_html=True)
 
@@ -90,35 +196,52 @@ with plot_container.container():
 with st.sidebar: 
     st.button('Save device parameters', on_click=save_parameters)
 
-    with open(SimSS_path+'device_parameters.txt') as fo:
+    with open(session_dir+'device_parameters.txt') as fo:
         st.download_button('Download device parameters', fo, file_name="device_parameters.txt")
         fo.close()
     
     reset_device_parameters = st.button('Reset device parameters to default')
     st.button('Run SimSS', on_click=run_simss)
+    st.button('Preview JV (estimate)', on_click=show_preview,
+                help='Estimate the JV curve from earlier simulations with similar parameters, without running SimSS')
+    job = sr.get_job(st.session_state.get('simss_job'))
+    st.button('Cancel simulation', on_click=cancel_simss, disabled=(job is None or job.is_finished()))
+    if sr.default_timeout:
+        st.number_input('Time limit of a simulation (s)', min_value=1.0, max_value=sr.default_timeout,
+                        value=sr.default_timeout, step=60.0, key='simss_timeout',
+                        help='At most ' + '{:g}'.format(sr.default_timeout) + ' s, the limit of this server')
+    else:
+        st.number_input('Time limit of a simulation (s)', min_value=0.0, value=0.0, step=60.0, key='simss_timeout',
+                        help='0 for no limit')
+    cache_stats = rc.get_stats()
+    st.caption('Result cache: ' + str(cache_stats['hits']) + ' hits, ' + str(cache_stats['misses']) + ' misses')
+    unsaved_container = st.empty()
 
-# Read the device_parameters.txt file and create a List object
-with open(SimSS_path+'device_parameters.txt') as fp:
-    dev_par_object = hf.read_from_txt(fp)
-    fp.close()
+# The parameter model is kept in the session state and only parsed again when device_parameters.txt has changed
+with metrics.span('params.parse'):
+    dev_par_model, parsed = dpm.get_cached_model(st.session_state, session_dir+'device_parameters.txt')
+if parsed:
+    st.session_state['unsaved_sections'] = set()
 
-# WHen the reset button is pressed, empty the container and create a List object from the default .txt file. Next, save the default parameters to the parameter file.
+# WHen the reset button is pressed, empty the container and create the model from the default .txt file. Next, save the default parameters to the parameter file.
 if reset_device_parameters:
     placeholder.empty()
-    with open(SimSS_path + 'device_parameters_default_1.txt') as fd:
-        dev_par_object = hf.read_from_txt(fd)
+    # Parsed once per process, copy before editing
+    dev_par_model = warmup.get_default_model().copy()
     save_parameters()
 
+show_unsaved_sections()
+
 # Build UI layout
 with placeholder.container():
     st.title("SIMsalabim device parameters")
-    for par_section in dev_par_object:
+    for par_section in dev_par_model.sections:
         if par_section[0]=='Description':
             # Version number
-            version=[i for i in par_section if i[1].startswith('version:')]
+            version=[i for i in dev_par_model.iter_section(par_section) if i.name.startswith('version:')]
             # Add version number (from device parameters file) to sidebar
             with st.sidebar:
-                st.write("SIMsalabim " + version[0][1])
+                st.write("SIMsalabim " + version[0].name)
             # Reference to the SIMsalabim manual
             st.write("""For more information about the device parameters or SIMsalabim itself, refer to the 
                             [Manual](https://raw.githubusercontent.com/kostergroup/SIMsalabim/master/Docs/Manual.pdf)""")
@@ -127,18 +250,40 @@ with placeholder.container():
                 expand=False
             else:
                 expand = True
-            with st.expander(par_section[0], expanded=expand):
+            # Edits are collected in a form per section and only applied to the model when the form is submitted,
+            # typing in a field does not rerun the page.
+            with st.expander(par_section[0], expanded=expand), st.form('form_' + par_section[0]):
+                section_values = {}
                 col_par, col_val, col_desc = st.columns([2,2,8],)
-                for item in par_section[1:]:
-                    if item[0]=='comm':
-                        st.write(item[1])
+                for item in dev_par_model.iter_section(par_section):
+                    if item.kind=='comm':
+                        st.write(item.name)
                         col_par, col_val, col_desc = st.columns([2,2,8])
-                    if item[0]=='par':
+                    if item.kind=='par':
                         with col_par : 
-                            st.text_input(item[1], value=item[1], disabled=True, label_visibility="collapsed")
+                            st.text_input(item.name, value=item.name, disabled=True, label_visibility="collapsed")
                             # st.code(item[1],language='markdown')
                         with col_val :
-                            item[2] = st.text_input(item[1] + '_val', value=item[2], label_visibility="collapsed")
+                            section_values[item.name] = st.text_input(item.name + '_val', value=item.value, label_visibility="collapsed")
                         with col_desc :
-                            st.text_input(item[1] +'_desc', value=item[3], disabled=True, label_visibility="collapsed")
+                            st.text_input(item.name +'_desc', value=item.desc, disabled=True, label_visibility="collapsed")
+                if st.form_submit_button('Apply changes'):
+                    apply_section(par_section, section_values)
+                    show_unsaved_sections()
+
+if st.session_state.pop('simss_preview_requested', False):
+    # Asked for with the preview button, wait for it
+    estimate = get_preview(wait=True)
+    with status_container.container():
+        if estimate is None:
+            st.info('No earlier simulations with similar parameters to estimate the JV curve from, run SimSS instead.')
+        else:
+            st.line_chart(get_preview_chart_data(), height=250)
+            st.caption(describe_preview(estimate))
+    if sr.get_job(st.session_state.get('simss_job')) is None:
+        del st.session_state['simss_preview']
+
+metrics.observe('page.dev_par', time.perf_counter() - page_start)
+warmup.report_first_paint(st.session_state, page_start)
+show_job_status()
 #st.success('Done!')
\ No newline at end of file
@@ -0,0 +1,144 @@
+import time
+import streamlit as st
+from utils import dev_par_model as dpm
+from utils import simss_runner as sr
+from utils import fitting
+from utils import sweep
+from utils import warmup
+
+warmup.prewarm()
+
+# Page configuration
+st.set_page_config(layout="wide", page_title="SIMsalabim fit to measurement")
+
+# Parameters
+session_dir = sr.get_session_dir(st.session_state)
+fit_dir = session_dir + 'fit/'
+status_container = st.empty()
+
+# Functions
+def start_fit(dev_par_model, measured, free_params, iterations, population):
+    # Start the fit in the background and remember it in the session.
+    st.session_state['fit_job'] = fitting.start_fit(dev_par_model, measured, free_params, fit_dir, iterations,
+                                                    population)
+
+def cancel_fit():
+    fit_job = st.session_state.get('fit_job')
+    if fit_job is not None:
+        fitting.cancel_fit(fit_job)
+
+def apply_best_values(dev_par_model, best_values):
+    # Write the fitted values to the device parameters of this session
+    dev_par_model.update(best_values)
+    dpm.write_cached_model(st.session_state, session_dir+'device_parameters.txt', dev_par_model)
+    st.session_state['fit_applied'] = True
+
+def show_fit_status(fit_job):
+    # Poll until the fit has finished. Any user interaction reruns the script and interrupts this loop.
+    progress = status_container.progress(0.0)
+    progress_text = st.empty()
+    chart = st.empty()
+    while True:
+        progress.progress(fit_job.iteration/max(fit_job.iterations, 1))
+        progress_text.caption('Iteration ' + str(fit_job.iteration) + ' of ' + str(fit_job.iterations)
+                                + ', best error ' + '{:.4g}'.format(fit_job.best_error) + ', '
+                                + str(fit_job.evaluations) + ' simulations, ' + str(fit_job.memo_hits)
+                                + ' repeated candidates')
+        if fit_job.history:
+            chart.line_chart({'best error': [entry['best_error'] for entry in fit_job.history]})
+        if fit_job.is_finished():
+            break
+        time.sleep(0.5)
+    if fit_job.status == 'failed':
+        status_container.error('Fit failed: ' + fit_job.message)
+    elif fit_job.status == 'cancelled':
+        status_container.warning('Fit cancelled after ' + str(fit_job.iteration) + ' iterations')
+    else:
+        status_container.success('Fit complete in ' + '{:.0f}'.format(fit_job.finished - fit_job.started) + ' s')
+
+# The fit starts from the device parameters of this session (including applied but unsaved changes)
+dev_par_model, parsed = dpm.get_cached_model(st.session_state, session_dir+'device_parameters.txt')
+par_values = dev_par_model.values()
+
+st.title("Fit to a measured JV curve")
+st.write("""Upload a measured JV curve (two columns: voltage in V and current density in A/m2, with the SimSS sign
+            convention) and select the parameters to fit within bounds. The other parameters keep the values of the
+            device parameters page. Every iteration simulates a batch of candidates in parallel.""")
+
+measured_file = st.file_uploader('Measured JV curve', type=['dat', 'txt', 'csv'])
+measured = None
+if measured_file is not None:
+    try:
+        measured = fitting.parse_measured_jv(measured_file.getvalue().decode('utf-8', errors='replace'))
+    except ValueError as err:
+        st.error(str(err))
+
+# Only numerical parameters can be fitted
+free = st.multiselect('Parameters to fit', [name for name, value in par_values.items()
+                                            if dpm.to_number(value) is not None])
+free_params = {}
+input_error = False
+for name in free:
+    col_name, col_low, col_high, col_log = st.columns([2,3,3,2])
+    value = float(par_values[name])
+    with col_name:
+        st.text_input(name, value=name + ' (now ' + par_values[name] + ')', disabled=True, label_visibility="collapsed")
+    with col_low:
+        low = st.text_input(name + '_low', value='{:.4g}'.format(value/10 if value > 0 else value - 1),
+                            label_visibility="collapsed")
+    with col_high:
+        high = st.text_input(name + '_high', value='{:.4g}'.format(value*10 if value > 0 else value + 1),
+                            label_visibility="collapsed")
+    with col_log:
+        log = st.checkbox('log scale', value=value > 0, key=name + '_log')
+    try:
+        free_params[name] = (float(low), float(high), log)
+        if not float(low) < float(high) or (log and float(low) <= 0):
+            raise ValueError('lower bound must be below upper bound (and positive on a log scale)')
+    except ValueError as err:
+        st.error(name + ': ' + str(err))
+        input_error = True
+
+col_iter, col_pop = st.columns(2)
+with col_iter:
+    iterations = st.number_input('Iterations', min_value=1, max_value=500, value=20)
+with col_pop:
+    population = st.number_input('Candidates per iteration (0: automatic)', min_value=0, max_value=500, value=0)
+
+fit_job = st.session_state.get('fit_job')
+running = fit_job is not None and not fit_job.is_finished()
+col_start, col_cancel = st.columns(2)
+with col_start:
+    st.button('Start fit', on_click=start_fit,
+                args=(dev_par_model, measured, free_params, int(iterations), int(population) or None),
+                disabled=(measured is None or not free_params or input_error or running))
+with col_cancel:
+    st.button('Cancel fit', on_click=cancel_fit, disabled=not running)
+
+# Progress and result of the last fit of this session
+if fit_job is not None:
+    show_fit_status(fit_job)
+    if fit_job.best_values:
+        st.subheader('Best parameters')
+        st.write(fit_job.best_values)
+        st.button('Apply to device parameters', on_click=apply_best_values, args=(dev_par_model, fit_job.best_values))
+        if st.session_state.pop('fit_applied', False):
+            st.success('Fitted values applied and saved, run SimSS on the device parameters page to see the result')
+        fitted_par_file = sweep.set_parameters(dpm.parse_dev_par(fit_job.base_par_file), fit_job.best_values).to_txt()
+        if dev_par_model.to_txt() not in (fit_job.base_par_file, fitted_par_file):
+            st.caption('The device parameters have changed since this fit was started, the fit used the parameters '
+                        + 'of that moment for the other parameters')
+        if measured is not None:
+            # The curve of the best candidate was kept by the fit, nothing is simulated here
+            if fit_job.best_jv is None:
+                st.info('The simulated curve of the best candidate is not available')
+            else:
+                from matplotlib.figure import Figure
+                fig = Figure()
+                ax = fig.subplots()
+                ax.plot(measured[0], measured[1], 'o', ms=3, label='Measured')
+                ax.plot(fit_job.best_jv[0], fit_job.best_jv[1], label='Best fit')
+                ax.set_xlabel('Vext')
+                ax.set_ylabel('Jext')
+                ax.legend()
+                st.pyplot(fig, format='png')
@@ -1,22 +1,34 @@
-from turtle import width
+import os
+import time
+page_start = time.perf_counter()
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
-import seaborn as sns
+from utils import simss_runner as sr
+from utils import var_sidecar as vs
+from utils import fast_plot as fp
+from utils import frame_cache as fc
+from utils import metrics
+from utils import warmup
+# pandas, matplotlib and seaborn are imported below, after the controls have been shown
+
+warmup.prewarm()
 
 # Page configuration
 st.set_page_config(layout="centered", page_title="SIMsalabim device parameters")
 
 SimSS_path = 'SIMsalabim/SimSS/'
-data_var = pd.read_csv(SimSS_path+'Var.dat', delim_whitespace=True)
-data_jv = pd.read_csv(SimSS_path+'JV.dat', delim_whitespace=True)
-st.write(data_jv)
-st.write(data_var)
+# Results of the simulations of this session
+session_dir = sr.get_session_dir(st.session_state)
+if not os.path.isfile(session_dir+'Var.dat') or not os.path.isfile(session_dir+'JV.dat'):
+    st.info('No simulation results yet. Run SimSS on the device parameters page first.')
+    st.stop()
+# Var.dat is read through its binary sidecar, only the columns and voltages needed for the plots are loaded.
+with metrics.span('plot.open_var'):
+    var_sidecar = vs.open_sidecar(session_dir+'Var.dat')
+jv_table = st.empty()
 with st.sidebar:
     options = st.multiselect(
         'Which parameters would you like to plot on the y-axis?',
-        list(data_var.columns),
+        vs.get_columns(var_sidecar),
         ['V'])
 
     scale_y = ['linear','log']
@@ -25,29 +37,151 @@ with st.sidebar:
     style = ['line','scatter']
     choice_style = st.selectbox('plot style', style)
 
-    voltages = list(set(data_var['Vext']))
-    voltages.sort()
+    voltages = vs.get_voltages(var_sidecar)
     format_func = lambda volt : f'{volt:.2}'
     choice_voltage = st.select_slider('Voltage to plot variables at', voltages, format_func=format_func)
+    frame_stats = fc.get_stats()
+    st.caption('Shared table cache: ' + str(frame_stats['entries']) + ' tables, '
+                + '{:.1f}'.format(frame_stats['resident_bytes']/1024**2) + ' of '
+                + '{:.0f}'.format(frame_stats['max_bytes']/1024**2) + ' MB')
+warmup.report_first_paint(st.session_state, page_start)
+
+with metrics.span('plot.import'):
+    import numpy as np
+    import pandas as pd
+    import seaborn as sns
+    from matplotlib.figure import Figure
+# Tables come from the process wide cache and are shared with other sessions, they are not modified here
+with metrics.span('plot.load_jv'):
+    data_jv = fc.get_frame(session_dir+'JV.dat')
+jv_table.write(data_jv)
 
-fig1, ax1 = plt.subplots()
-fig2, ax2 = plt.subplots()
+# Plain figures instead of pyplot, so they are freed after the rerun
+fig1 = Figure()
+ax1 = fig1.subplots()
+fig2 = Figure()
+ax2 = fig2.subplots()
 # fig,(ax1,ax2)=plt.subplots(1,2)
 
 ax2.set_yscale(choice_y_scale)
 plot_funcs = {'scatter':sns.scatterplot, 'line':sns.lineplot}
-plot_funcs[choice_style](data=data_jv, x='Vext', y='Jext', label='Cell JV', ax=ax1)
+with metrics.span('plot.plot_jv'):
+    plot_funcs[choice_style](data=data_jv, x='Vext', y='Jext', label='Cell JV', ax=ax1)
+
 
+# Var.dat at the selected voltage
+with metrics.span('plot.load_var_slice'):
+    data_var_slice = fc.get_frame(session_dir+'Var.dat', ('Vext', choice_voltage),
+                                lambda path: vs.load_columns(var_sidecar, vs.get_columns(var_sidecar), choice_voltage))
+st.write(data_var_slice)
 
 if len(options) == 1:
-    plot_funcs[choice_style](data=data_var, x='x', y=options[0], hue='Vext', ax=ax2)
+    # All voltages in one plot: drawn by the fast (downsampled, cached) renderer instead of seaborn
+    with metrics.span('plot.plot_var_all'):
+        var_image = fp.render_var_plot(var_sidecar, options[0], choice_y_scale, choice_style)
 elif len(options) > 1:
-    data_var = data_var[data_var['Vext'] == choice_voltage]
-    for y_var in options:
-        plot_funcs[choice_style](data=data_var, x='x', y=y_var, ax=ax2, label=y_var)
+    data_var = data_var_slice
+    with metrics.span('plot.plot_var_slice'):
+        for y_var in options:
+            plot_funcs[choice_style](data=data_var, x='x', y=y_var, ax=ax2, label=y_var)
 
     ax1.axvline(x=choice_voltage, label='2nd plot V', ls='--', color='grey')
     ax1.legend()
 
-st.pyplot(fig1, format='png')
-st.pyplot(fig2, format='png')
\ No newline at end of file
+with metrics.span('plot.encode'):
+    st.pyplot(fig1, format='png')
+    if len(options) == 1:
+        st.image(var_image)
+    else:
+        st.pyplot(fig2, format='png')
+metrics.observe('page.plot', time.perf_counter() - page_start)
+
+# Compare the JV curve of this session with the sweep points of this session and earlier (cached) simulations
+with st.expander('Compare JV curves', expanded=False):
+    # The body of a collapsed expander runs as well, the curves are only loaded when asked for
+    if st.checkbox('Compare', value=False):
+        from utils import jv_analysis as ja
+        from utils import result_cache as rc
+        from matplotlib.collections import LineCollection
+        runs = [{'label': 'This session', 'dir': session_dir}]
+        if st.checkbox('Include the points of the last parameter sweep', value=True):
+            points = st.session_state.get('sweep_points', [])
+            for point, job_id in zip(points, st.session_state.get('sweep_jobs', [])):
+                job = sr.get_job(job_id)
+                if job is not None and job.status == 'done':
+                    runs.append({'label': ', '.join(name + '=' + value for name, value in point.items()),
+                                'dir': job.session_dir})
+        n_cached = st.number_input('Number of recent cached simulations to include', min_value=0, max_value=1000,
+                                    value=0, step=10)
+        for entry in rc.list_entries(int(n_cached)):
+            used = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['time']))
+            runs.append({'label': 'cache ' + entry['key'][:8] + ' (' + used + ')', 'dir': entry['dir']})
+
+        with metrics.span('plot.compare'):
+            data_fom, compare_v, compare_j = ja.analyse_runs(runs)
+            fig3 = Figure()
+            ax3 = fig3.subplots()
+            # All curves as one LineCollection, NaN padding is not drawn
+            ax3.add_collection(LineCollection(np.stack((compare_v, compare_j), axis=-1),
+                                            array=np.arange(len(data_fom)), cmap='viridis', linewidths=1))
+            ax3.autoscale()
+            ax3.scatter(data_fom['Vmpp (V)'], data_fom['Jmpp (A/m2)'], marker='x', color='black', s=16, label='MPP')
+            ax3.axhline(0, color='grey', lw=0.5)
+            ax3.set_xlabel('Vext')
+            ax3.set_ylabel('Jext')
+            ax3.legend()
+        st.pyplot(fig3, format='png')
+        if len(data_fom) < len(runs):
+            st.caption(str(len(runs) - len(data_fom)) + ' run(s) left out, their results are no longer available')
+        st.write(data_fom)
+        st.download_button('Download figures of merit', data_fom.to_csv(index=False),
+                            file_name='figures_of_merit.csv')
+
+# Archived runs (compressed parameters, JV, Var and metadata of every completed run) and their bulk export. Only the
+# runs of this session are listed, the archive holds the runs of every user.
+with st.expander('Export runs', expanded=False):
+    # The body of a collapsed expander runs as well, the archives are only read when asked for
+    if st.checkbox('List the archived runs of this session', value=False):
+        from utils import result_cache as rc
+        from utils import run_archive as ra
+        session_key = None
+        if os.path.isfile(session_dir + sr.run_parameters_file):
+            with open(session_dir + sr.run_parameters_file) as fp_run:
+                session_key = rc.get_cache_key(fp_run.read(), SimSS_path)
+        session_keys = list(st.session_state.get('run_keys', []))
+        for job_id in st.session_state.get('sweep_jobs', []):
+            job = sr.get_job(job_id)
+            if job is not None and job.status == 'done':
+                session_keys.append(job.cache_key)
+        fit_job = st.session_state.get('fit_job')
+        if fit_job is not None and fit_job.best_key is not None:
+            session_keys.append(fit_job.best_key)
+        if session_key is not None:
+            session_keys.append(session_key)
+        rows = []
+        for key in dict.fromkeys(session_keys):
+            meta = ra.read_meta(key)
+            if meta is None:
+                # Not archived (yet) or evicted
+                continue
+            rows.append({'run': key[:12] + (' (current results)' if key == session_key else ''),
+                        'finished': time.strftime('%Y-%m-%d %H:%M', time.localtime(meta.get('finished', 0))),
+                        'voltages': meta.get('tables', {}).get('JV', {}).get('rows'),
+                        'output files (kB)': meta.get('source_bytes', 0)/1024,
+                        'key': key})
+        if not rows:
+            st.info('No archived runs of this session yet.')
+        else:
+            data_archives = pd.DataFrame(rows)
+            st.write(data_archives.drop(columns='key'))
+            selection = st.multiselect('Runs to export', list(data_archives['run']),
+                                        [row['run'] for row in rows if row['key'] == session_key])
+            if selection:
+                # Streamed as a zip by the API server (api_server.py), the download does not pass through this
+                # session. Full keys: the API only accepts key prefixes with its token.
+                keys = [row['key'] for row in rows if row['run'] in selection]
+                st.markdown('[Download ' + str(len(keys)) + ' run(s) as zip](/api/archive/export?keys='
+                            + ','.join(keys) + ')')
+            if session_key is not None and any(row['key'] == session_key for row in rows):
+                st.download_button('Download the current results as archive', ra.read_archive_bytes(session_key),
+                                    file_name='simsalabim_run_' + session_key[:12] + '.npz')
@@ -0,0 +1,117 @@
+import time
+import streamlit as st
+from utils import dev_par_model as dpm
+from utils import simss_runner as sr
+from utils import sweep
+from utils import warmup
+
+warmup.prewarm()
+
+# Page configuration
+st.set_page_config(layout="wide", page_title="SIMsalabim parameter sweep")
+
+# Parameters
+session_dir = sr.get_session_dir(st.session_state)
+sweep_dir = session_dir + 'sweep/'
+status_container = st.empty()
+
+# Functions
+def start_sweep(dev_par_model, sweep_values):
+    # Fan the sweep out over the worker pool and remember the jobs in the session.
+    points = sweep.create_sweep_points(sweep_values)
+    jobs = sweep.run_sweep(dev_par_model, points, sweep_dir)
+    st.session_state['sweep_points'] = points
+    st.session_state['sweep_jobs'] = [job.id for job in jobs]
+
+def cancel_sweep():
+    # Stop all unfinished points of the running sweep
+    sweep.cancel_sweep(get_sweep_jobs())
+
+def get_sweep_jobs():
+    jobs = [sr.get_job(job_id) for job_id in st.session_state.get('sweep_jobs', [])]
+    return [job for job in jobs if job is not None]
+
+def show_sweep_status(jobs):
+    # Poll until all points have finished. Any user interaction reruns the script and interrupts this loop.
+    progress = status_container.progress(0.0)
+    progress_text = st.empty()
+    while True:
+        finished = sum(1 for job in jobs if job.is_finished())
+        progress.progress(finished/len(jobs))
+        progress_text.caption('Finished ' + str(finished) + ' of ' + str(len(jobs)) + ' points')
+        if finished == len(jobs):
+            break
+        time.sleep(0.5)
+    failed = sum(1 for job in jobs if job.status == 'failed')
+    cancelled = sum(1 for job in jobs if job.status == 'cancelled')
+    if cancelled:
+        status_container.warning('Sweep cancelled, ' + str(cancelled) + ' of ' + str(len(jobs)) + ' points not simulated')
+    elif failed:
+        status_container.warning('Sweep complete, ' + str(failed) + ' of ' + str(len(jobs)) + ' points failed')
+    else:
+        status_container.success('Sweep complete')
+
+# Read the device parameters of this session, the sweep starts from these values
+dev_par_model = dpm.read_dev_par_file(session_dir+'device_parameters.txt')
+
+par_names = dev_par_model.names()
+par_values = dev_par_model.values()
+
+st.title("Parameter sweep")
+st.write("""Select one or more parameters and the values to simulate. Ranges are entered as start:stop:num (linear) or
+            log:start:stop:num (logarithmic), lists as comma separated values. All combinations are simulated in parallel,
+            starting from the saved device parameters.""")
+
+swept = st.multiselect('Parameters to sweep', par_names)
+sweep_values = {}
+input_error = False
+for name in swept:
+    col_name, col_spec, col_count = st.columns([2,6,2])
+    with col_name:
+        st.text_input(name, value=name + ' (now ' + par_values[name] + ')', disabled=True, label_visibility="collapsed")
+    with col_spec:
+        spec = st.text_input(name + '_sweep', value=par_values[name], label_visibility="collapsed")
+    with col_count:
+        try:
+            sweep_values[name] = sweep.parse_sweep_values(spec)
+            st.write(str(len(sweep_values[name])) + ' values')
+        except ValueError as err:
+            st.error(str(err))
+            input_error = True
+
+n_points = 1
+for values in sweep_values.values():
+    n_points = n_points*len(values)
+
+jobs = get_sweep_jobs()
+running = any(not job.is_finished() for job in jobs)
+if swept and not input_error:
+    st.write('Total number of simulations: ' + str(n_points) + ', running up to ' + str(sweep.get_max_in_flight()) + ' at a time')
+    if n_points > sweep.max_points:
+        st.error('A sweep can have at most ' + str(sweep.max_points) + ' simulations, use fewer values')
+        input_error = True
+col_run, col_cancel = st.columns([1,1])
+with col_run:
+    st.button('Run sweep', on_click=start_sweep, args=(dev_par_model, sweep_values),
+                disabled=(not swept or input_error or running))
+with col_cancel:
+    st.button('Cancel sweep', on_click=cancel_sweep, disabled=not running)
+
+# Results of the last sweep of this session
+if jobs and len(jobs) == len(st.session_state['sweep_points']):
+    show_sweep_status(jobs)
+    points = st.session_state['sweep_points']
+    data_sweep = sweep.collect_sweep_results(points, jobs)
+    if not data_sweep.empty:
+        st.subheader('Results')
+        import seaborn as sns
+        from matplotlib.figure import Figure
+        key_columns = list(points[0])
+        fig = Figure()
+        ax = fig.subplots()
+        hue = data_sweep[key_columns].astype(str).agg(', '.join, axis=1)
+        sns.lineplot(data=data_sweep, x='Vext', y='Jext', hue=hue, ax=ax)
+        ax.legend(title=', '.join(key_columns), fontsize='small')
+        st.pyplot(fig, format='png')
+        st.write(data_sweep)
+        st.download_button('Download sweep results', data_sweep.to_csv(index=False), file_name='sweep_JV.csv')
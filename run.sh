@@ -2,4 +2,17 @@
 nginx -t
 service nginx start
 cd SIMsalabim-web
-streamlit run app.py
+# The API and the Streamlit app each run their own simss worker pool. Without a job spool the cores are split between
+# them, a quarter (at least 1) for the API. Set SIMSS_API_WORKERS and SIMSS_APP_WORKERS to change the split.
+if [ -z "$SIMSS_SPOOL_DIR" ]; then
+    cores=$(nproc)
+    api_workers=${SIMSS_API_WORKERS:-$(( cores/4 > 0 ? cores/4 : 1 ))}
+    app_workers=${SIMSS_APP_WORKERS:-$(( cores - api_workers > 0 ? cores - api_workers : 1 ))}
+else
+    # Runs are handed to the spool workers, which limit the number of simss processes themselves
+    api_workers=$SIMSS_WORKERS
+    app_workers=$SIMSS_WORKERS
+fi
+# Headless API next to the Streamlit app, proxied by nginx at /api/
+SIMSS_WORKERS=$api_workers python3 api_server.py &
+SIMSS_WORKERS=$app_workers streamlit run app.py
@@ -0,0 +1,136 @@
+# spool_worker.py>
+# Worker running simss jobs from a job spool on shared storage (see utils/job_spool.py). Start it on any host that can
+# run simss and mounts the spool directory, the web app is pointed at the same directory with SIMSS_SPOOL_DIR.
+# Several workers (on one or more hosts) can serve the same spool.
+#
+# Usage: python spool_worker.py [--spool-dir /mnt/spool] [--workers 8] [--poll 1]
+#
+# To try it on a single machine:
+#   SIMSS_SPOOL_DIR=/tmp/spool streamlit run app.py
+#   python spool_worker.py --spool-dir /tmp/spool --workers 2 &
+#   python spool_worker.py --spool-dir /tmp/spool --workers 2 &
+import argparse
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+from utils import job_spool as js
+from utils import metrics
+from utils import simss_runner as sr
+
+_stop = threading.Event()
+
+
+def keep_alive(job_dir, claim_id, job, finished):
+    # Description:  Heartbeat of a running job: renew the lease, publish the console output and stop simss when the job
+    #               is cancelled or when the lease was lost (the job has been requeued to another worker).
+    while not finished.wait(js.heartbeat_interval):
+        alive = js.heartbeat(job_dir, claim_id)
+        if alive:
+            write_stdout(job_dir, job)
+        if not alive or js.is_cancelled(job_dir):
+            job.cancel_requested = True
+            sr.stop_process(job)
+            break
+
+def write_stdout(job_dir, job):
+    # Description:  Write the console output of a job for the web app to show, replaced atomically.
+    tmp_name = job_dir + '.stdout.txt.tmp'
+    try:
+        with open(tmp_name, 'w') as fp:
+            fp.write(job.stdout)
+        os.replace(tmp_name, job_dir + 'stdout.txt')
+    except OSError:
+        # Job directory moved away (requeued), the heartbeat notices
+        pass
+
+def process_job(spool, job_dir, claim_id, worker_id):
+    # Description:  Run a claimed job with simss on this host and move it to done with its output files. The output is
+    #               collected in a local directory and only copied into the job directory while the lease is held, so a
+    #               worker that lost its job never writes into the job of the new owner.
+    job_info = js.read_json(job_dir + 'job.json') or {}
+    with open(job_dir + 'device_parameters.txt') as fp:
+        par_file = fp.read()
+    os.makedirs(sr.scratch_base_dir, exist_ok=True)
+    output_dir = os.path.join(tempfile.mkdtemp(prefix='spool_output_', dir=sr.scratch_base_dir), '')
+    try:
+        job = sr.SimssJob(par_file, output_dir, timeout=job_info.get('timeout'))
+        job.cache_key = sr.rc.get_cache_key(par_file, sr.SimSS_path)
+        finished = threading.Event()
+        heartbeat = threading.Thread(target=keep_alive, args=(job_dir, claim_id, job, finished), daemon=True)
+        heartbeat.start()
+        try:
+            sr.run_job(job, local=True)
+        finally:
+            finished.set()
+            heartbeat.join()
+        if not js.holds_lease(job_dir, claim_id):
+            metrics.incr('spool.lost_leases')
+            return
+        write_stdout(job_dir, job)
+        sr.collect_output_files(output_dir, job_dir)
+        result = {'status': job.status, 'returncode': job.returncode, 'worker': worker_id,
+                    'started': job.started, 'finished': job.finished}
+        if js.complete(spool, job_dir, result, claim_id):
+            metrics.incr('spool.completed')
+        else:
+            metrics.incr('spool.lost_leases')
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def work(spool, worker_id, poll_interval):
+    # Description:  Claim and run jobs until the worker is stopped.
+    last_requeue_check = 0.0
+    while not _stop.is_set():
+        if time.time() - last_requeue_check > js.heartbeat_interval:
+            for job_id in js.requeue_stale(spool):
+                metrics.logger.info('Requeued job ' + job_id + ' of a lost worker')
+            last_requeue_check = time.time()
+        claimed = js.claim(spool, worker_id)
+        if claimed is None:
+            _stop.wait(poll_interval)
+            continue
+        job_dir, claim_id = claimed
+        try:
+            process_job(spool, job_dir, claim_id, worker_id)
+        except Exception as err:
+            # Leave the job to the requeue of its lease, keep the worker alive
+            metrics.logger.warning('Job in ' + job_dir + ' failed: ' + str(err))
+
+def stop(signum, frame):
+    # Finish the running jobs, do not claim new ones
+    _stop.set()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run SIMsalabim jobs from a shared job spool')
+    parser.add_argument('--spool-dir', default=js.spool_dir, help='spool directory, default $SIMSS_SPOOL_DIR')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='simss runs at the same time')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds between looking for new jobs')
+    args = parser.parse_args(argv)
+    if not args.spool_dir:
+        parser.error('no spool directory, use --spool-dir or set SIMSS_SPOOL_DIR')
+    # Fail early when simss has not been built on this host
+    sr.locate_simss()
+    js.create_spool(args.spool_dir)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    base_id = socket.gethostname() + ':' + str(os.getpid())
+    threads = [threading.Thread(target=work, args=(args.spool_dir, base_id + ':' + str(index), args.poll),
+                                name='spool_worker_' + str(index)) for index in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    metrics.logger.info('Spool worker ' + base_id + ' serving ' + args.spool_dir + ' with ' + str(args.workers)
+                        + ' worker(s)')
+    # Wake up regularly, so the signal handler runs
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(1)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
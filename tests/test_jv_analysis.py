@@ -0,0 +1,26 @@
+# test_jv_analysis.py>
+import numpy as np
+from utils import jv_analysis as ja
+
+
+def make_curve(vmax):
+    # Illuminated diode: Jsc = -400 A/m2, Voc close to 0.8 V
+    vext = np.linspace(-0.5, vmax, 101)
+    jext = -400 + 1e-9*(np.exp(vext/0.0259) - 1)*400/(np.exp(0.8/0.0259)*1e-9)
+    return vext, jext
+
+def test_figures_of_merit_full_curve():
+    vext, jext = make_curve(1.0)
+    fom = ja.figures_of_merit(vext[None, :], jext[None, :])
+    assert abs(fom['Voc'][0] - 0.8) < 0.01
+    assert abs(fom['Jsc'][0] + 400) < 1
+    assert 0 < fom['Vmpp'][0] < fom['Voc'][0]
+    assert 0 < fom['FF'][0] < 1
+
+def test_figures_of_merit_range_before_voc():
+    # The range stops before J crosses zero: no Voc, and no maximum power point at the end of the range
+    vext, jext = make_curve(0.49)
+    fom = ja.figures_of_merit(vext[None, :], jext[None, :])
+    assert abs(fom['Jsc'][0] + 400) < 1
+    for name in ['Voc', 'Vmpp', 'Jmpp', 'Pmpp', 'FF']:
+        assert np.isnan(fom[name][0])
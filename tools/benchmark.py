@@ -0,0 +1,268 @@
+# benchmark.py>
+# Offline micro-benchmarks for the parameter file parser/writer, the band diagram and the output file loaders.
+#
+# Usage (from the repository root):
+#   python -m tools.benchmark                                   run all stages, write benchmark_results.json
+#   python -m tools.benchmark --sizes 100x20 1000x200           choose the Var.dat sizes (grid points x voltages)
+#   python -m tools.benchmark --compare baseline.json           flag stages that got slower than the baseline
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# Columns of a SimSS Var.dat file
+var_columns = ['x','V','Evac','Ec','Ev','phin','phip','n','p','ND','NA','anion','cation','ntb','nti','mun','mup',
+                'G_ehp','Gfree','Rdir','BulkSRHn','BulkSRHp','IntSRHn','IntSRHp','Jn','Jp','Jint','lid','Vext']
+# Columns of a SimSS JV.dat file
+jv_columns = ['Vext','Jext','convIndex','P','recLan','recSRH','Jbimo','JSRH_bulk','JSRH_LI','JSRH_RI','Jph','Jn_l',
+                'Jp_l','Jn_r','Jp_r']
+# Parameters needed for the band diagram, with realistic values
+band_params = {'L':'340E-9','L_LTL':'30E-9','L_RTL':'30E-9','CB':'3.0','VB':'5.0','W_L':'3.0','W_R':'5.0',
+                'CB_LTL':'3.0','CB_RTL':'2.5','VB_LTL':'5.5','VB_RTL':'5.0'}
+section_titles = ['General','Mobilities','Contacts','Transport layers','Ions','Generation and recombination',
+                'Trapping','Numerical Parameters','Voltage range of simulation','User interface']
+
+
+def create_par_file(n_params):
+    # Description:  Create a synthetic device parameters file in the SIMsalabim layout.
+    # Arguments:    n_params (number) - approximate number of parameters, spread over all sections
+    # Returns:      par_file (string) - content of the file
+    lines = ['** SIMsalabim Device Parameters File\n', '** version: 4.47\n', '** synthetic file for benchmarks\n']
+    per_section = max(1, n_params//len(section_titles))
+    band_names = list(band_params)
+    for section_index, title in enumerate(section_titles):
+        lines.append('\n')
+        lines.append(('**' + title).ljust(84, '*') + '\n')
+        lines.append('** comment in section ' + title + '\n')
+        for par_index in range(per_section):
+            if band_names and section_index < 4:
+                name = band_names.pop(0)
+                value = band_params[name]
+            else:
+                name = 'par_' + str(section_index) + '_' + str(par_index)
+                value = '{:.4g}'.format(1.234e-7*(par_index + 1))
+            lines.append((name + ' = ' + value).ljust(25) + '* unit, description of ' + name + '\n')
+            if par_index % 10 == 0:
+                lines.append(' '*25 + '* continued description\n')
+    # Parameters that did not fit in the first sections
+    for name in band_names:
+        lines.append((name + ' = ' + band_params[name]).ljust(25) + '* band parameter\n')
+    return ''.join(lines)
+
+def create_var_file(path, n_grid, n_voltages):
+    # Description:  Write a synthetic Var.dat file of n_grid points for each of n_voltages voltages.
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 340e-9, n_grid)
+    voltages = np.round(np.linspace(-0.5, 1.4, n_voltages), 4)
+    with open(path, 'w') as fp:
+        fp.write(' '.join(var_columns) + '\n')
+        for vext in voltages:
+            block = rng.random((n_grid, len(var_columns)))*np.logspace(-10, 25, len(var_columns))
+            block[:, 0] = x
+            block[:, 1] = vext*x/x[-1]
+            block[:, -1] = vext
+            np.savetxt(fp, block, fmt='%.6E')
+
+def create_jv_file(path, n_voltages):
+    # Description:  Write a synthetic JV.dat file with n_voltages rows.
+    vext = np.linspace(-0.5, 1.4, n_voltages)
+    data = np.zeros((n_voltages, len(jv_columns)))
+    data[:, 0] = vext
+    data[:, 1] = -200 + 1e-3*np.expm1(vext/0.03)
+    with open(path, 'w') as fp:
+        fp.write(' '.join(jv_columns) + '\n')
+        np.savetxt(fp, data, fmt='%.6E')
+
+def measure(func, repeat):
+    # Description:  Time a function and measure the peak of the memory allocated while it runs.
+    # Arguments:    func (function) - function without arguments
+    #               repeat (number) - number of timed runs
+    # Returns:      result (dict) - median, min and max time in s and peak memory in bytes
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'max_s': max(times), 'repeat': repeat,
+            'peak_bytes': peak}
+
+def get_parameter_stages(n_params):
+    # Description:  Stages for the parameter file handling.
+    # Returns:      stages (List) - (name, function) pairs
+    from utils import helper_functions as hf
+    from utils import dev_par_model as dpm
+    par_file = create_par_file(n_params)
+    lines = par_file.splitlines(True)
+    dev_par_object = hf.read_from_txt(lines)
+    dev_par_model = dpm.parse_dev_par(par_file)
+    comment_lines = [line for line in lines if line.startswith('**')]
+
+    def read_comment_lines():
+        for line in comment_lines:
+            hf.read_comment_line(line, 0)
+
+    def model_variant():
+        variant = dev_par_model.copy()
+        variant.set('L', '300E-9')
+        variant.to_txt()
+
+    suffix = '[' + str(n_params) + ' params]'
+    return [('read_from_txt' + suffix, lambda: hf.read_from_txt(lines)),
+            ('write_to_txt' + suffix, lambda: hf.write_to_txt(dev_par_object)),
+            ('read_comment_line' + suffix, read_comment_lines),
+            ('dev_par_model.parse' + suffix, lambda: dpm.parse_dev_par(par_file)),
+            ('dev_par_model.variant' + suffix, model_variant)]
+
+def get_band_diagram_stages():
+    # Description:  Stages for the band diagram.
+    # Returns:      stages (List) - (name, function) pairs
+    import io
+    from utils import draw_band_diagram as dbd
+
+    def create_and_encode():
+        fig = dbd.create_band_energy_diagram(band_params)
+        fig.savefig(io.BytesIO(), format='png')
+
+    def render_cold():
+        dbd._render_band_diagram.cache_clear()
+        dbd.render_band_diagram(band_params)
+
+    return [('create_band_energy_diagram', lambda: dbd.create_band_energy_diagram(band_params)),
+            ('create_band_energy_diagram+png', create_and_encode),
+            ('render_band_diagram.cold', render_cold),
+            ('render_band_diagram.warm', lambda: dbd.render_band_diagram(band_params))]
+
+def get_output_stages(work_dir, n_grid, n_voltages):
+    # Description:  Stages for loading Var.dat and JV.dat, both as the plot page did originally and through the sidecar.
+    # Returns:      stages (List) - (name, function) pairs
+    import pandas as pd
+    from utils import var_sidecar as vs
+    from utils import fast_plot as fp
+    var_path = os.path.join(work_dir, 'Var_' + str(n_grid) + 'x' + str(n_voltages) + '.dat')
+    jv_path = os.path.join(work_dir, 'JV_' + str(n_voltages) + '.dat')
+    create_var_file(var_path, n_grid, n_voltages)
+    create_jv_file(jv_path, n_voltages)
+    vs.open_sidecar(var_path)
+
+    def read_csv_and_slice():
+        data_var = pd.read_csv(var_path, sep=r'\s+')
+        voltages = sorted(set(data_var['Vext']))
+        data_var[data_var['Vext'] == voltages[len(voltages)//2]]
+
+    def convert():
+        vs.convert_var_file(var_path)
+        vs._sidecars.clear()
+
+    def sidecar_slice():
+        sidecar = vs.open_sidecar(var_path)
+        voltages = vs.get_voltages(sidecar)
+        vs.load_columns(sidecar, vs.get_columns(sidecar), voltages[len(voltages)//2])
+
+    def sidecar_cold():
+        vs._sidecars.clear()
+        sidecar_slice()
+
+    def render_cold():
+        fp._images.clear()
+        fp.render_var_plot(vs.open_sidecar(var_path), 'n', 'log', 'line')
+
+    suffix = '[' + str(n_grid) + 'x' + str(n_voltages) + ']'
+    return [('Var.dat read_csv+slice' + suffix, read_csv_and_slice),
+            ('Var.dat sidecar.convert' + suffix, convert),
+            ('Var.dat sidecar.slice.cold' + suffix, sidecar_cold),
+            ('Var.dat sidecar.slice.warm' + suffix, sidecar_slice),
+            ('Var.dat render_var_plot.cold' + suffix, render_cold),
+            ('JV.dat read_csv' + suffix, lambda: pd.read_csv(jv_path, sep=r'\s+'))]
+
+def run_benchmarks(sizes, param_counts, repeat, only=None):
+    # Description:  Run all stages and collect the results.
+    # Arguments:    sizes (List) - (n_grid, n_voltages) pairs for the Var.dat files
+    #               param_counts (List) - number of parameters for the synthetic parameter files
+    #               repeat (number) - number of timed runs per stage
+    #               only (string) - run only the stages whose name contains this text
+    # Returns:      results (dict) - stage name -> measurement
+    work_dir = tempfile.mkdtemp(prefix='simsalabim_benchmark_')
+    try:
+        stages = []
+        for n_params in param_counts:
+            stages.extend(get_parameter_stages(n_params))
+        stages.extend(get_band_diagram_stages())
+        for n_grid, n_voltages in sizes:
+            stages.extend(get_output_stages(work_dir, n_grid, n_voltages))
+        results = {}
+        for name, func in stages:
+            if only and only not in name:
+                continue
+            results[name] = measure(func, repeat)
+            print('{:<50} {:>10.3f} ms {:>10.1f} MB'.format(
+                name, results[name]['median_s']*1000, results[name]['peak_bytes']/1024**2))
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare(results, baseline, tolerance):
+    # Description:  Compare the median times with a stored baseline.
+    # Arguments:    results (dict) - results of this run
+    #               baseline (dict) - results of the baseline run
+    #               tolerance (float) - allowed relative slow down, 0.2 = 20%
+    # Returns:      regressions (List) - names of the stages that are slower than allowed
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median_s']/max(baseline[name]['median_s'], 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1/(1 + tolerance):
+            flag = 'faster'
+        print('{:<50} {:>8.2f}x {}'.format(name, ratio, flag))
+    return regressions
+
+def parse_size(size):
+    n_grid, n_voltages = size.lower().split('x')
+    return int(n_grid), int(n_voltages)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for SIMsalabim-web')
+    parser.add_argument('--sizes', nargs='+', default=['100x20', '500x50', '1000x100'],
+                        help='Var.dat sizes as grid points x voltages')
+    parser.add_argument('--params', nargs='+', type=int, default=[100, 1000],
+                        help='number of parameters of the synthetic parameter files')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per stage')
+    parser.add_argument('--only', help='run only stages whose name contains this text')
+    parser.add_argument('--output', default='benchmark_results.json', help='file to write the results to')
+    parser.add_argument('--compare', help='baseline results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slow down before flagging')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks([parse_size(size) for size in args.sizes], args.params, args.repeat, args.only)
+    with open(args.output, 'w') as fp:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'time': time.time(),
+                   'results': results}, fp, indent=2)
+    print('Results written to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(str(len(regressions)) + ' stage(s) slower than the baseline')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# fake_simss.py>
+# Stand-in for the simss executable, for load tests without the Pascal build. Run in a directory with a
+# device_parameters.txt, like simss, and writes JV.dat, Var.dat, log.txt and scPars.dat with the columns of SimSS.
+# Only the standard library is used, so it runs with any python3.
+#
+# Configured with environment variables (inherited from the app that starts it):
+#   FAKE_SIMSS_SECONDS     run time in s (default 1)
+#   FAKE_SIMSS_MODE        'sleep' (default) or 'cpu' to keep a core busy for the run time
+#   FAKE_SIMSS_GRID        grid points per voltage in Var.dat (default 500)
+#   FAKE_SIMSS_VOLTAGES    number of voltages between Vmin and Vmax, by default the grid of Vstep (or 50 voltages)
+#   FAKE_SIMSS_FAIL_RATE   fraction of runs that fail with exit code 1 (default 0)
+import math
+import os
+import random
+import re
+import sys
+import time
+
+var_columns = ['x','V','Evac','Ec','Ev','phin','phip','n','p','ND','NA','anion','cation','ntb','nti','mun','mup',
+                'G_ehp','Gfree','Rdir','BulkSRHn','BulkSRHp','IntSRHn','IntSRHp','Jn','Jp','Jint','lid','Vext']
+jv_columns = ['Vext','Jext','convIndex','P','recLan','recSRH','Jbimo','JSRH_bulk','JSRH_LI','JSRH_RI','Jph','Jn_l',
+                'Jp_l','Jn_r','Jp_r']
+
+
+def get_parameter(par_file, name, default):
+    # Description:  Numerical value of a parameter in the device parameters file, default when missing.
+    match = re.search(r'^\s*' + re.escape(name) + r'\s*=\s*([^\s*]+)', par_file, re.MULTILINE)
+    try:
+        return float(match.group(1)) if match else default
+    except ValueError:
+        return default
+
+def wait(seconds, mode):
+    # Description:  Spend the run time sleeping or computing.
+    end = time.time() + seconds
+    if mode == 'cpu':
+        value = 0.0
+        while time.time() < end:
+            for i in range(10000):
+                value = value + math.sqrt(i)
+    else:
+        time.sleep(max(0.0, seconds))
+
+def main():
+    seconds = float(os.environ.get('FAKE_SIMSS_SECONDS', 1))
+    mode = os.environ.get('FAKE_SIMSS_MODE', 'sleep')
+    n_grid = int(os.environ.get('FAKE_SIMSS_GRID', 500))
+    fail_rate = float(os.environ.get('FAKE_SIMSS_FAIL_RATE', 0))
+    with open('device_parameters.txt') as fp:
+        par_file = fp.read()
+    # The parameters that shape the curve, so different parameters give different results
+    thickness = get_parameter(par_file, 'L', 340e-9)
+    generation = get_parameter(par_file, 'Gehp', 1.2e28)
+    v_min = get_parameter(par_file, 'Vmin', -0.5)
+    v_max = get_parameter(par_file, 'Vmax', 1.4)
+    v_step = get_parameter(par_file, 'Vstep', 0)
+    j_sc = -1.602e-19*generation*thickness*0.8
+    if 'FAKE_SIMSS_VOLTAGES' in os.environ or v_step <= 0:
+        n_voltages = int(os.environ.get('FAKE_SIMSS_VOLTAGES', 50))
+        voltages = [v_min + (v_max - v_min)*i/max(n_voltages - 1, 1) for i in range(n_voltages)]
+    else:
+        n_voltages = int(math.floor((v_max - v_min)/v_step + 1e-6)) + 1
+        voltages = [v_min + i*v_step for i in range(n_voltages)]
+
+    print('SIMsalabim (fake simss for load tests)', flush=True)
+    with open('JV.dat', 'w') as jv_fp, open('Var.dat', 'w') as var_fp:
+        jv_fp.write(' '.join(jv_columns) + '\n')
+        var_fp.write(' '.join(var_columns) + '\n')
+        for index, vext in enumerate(voltages):
+            wait(seconds/n_voltages, mode)
+            jext = j_sc + 1e-7*math.expm1(min(vext/0.0259, 700)/1.5)
+            jv_fp.write(' '.join('{:.6E}'.format(value) for value in [vext, jext, 0, 0] + [jext/11]*11) + '\n')
+            jv_fp.flush()
+            for grid_index in range(n_grid):
+                x = thickness*grid_index/max(n_grid - 1, 1)
+                row = [x, vext*x/thickness] + [1e20*math.exp(-grid_index/n_grid)*(1 + column) for column in range(26)]
+                var_fp.write(' '.join('{:.6E}'.format(value) for value in row + [vext]) + '\n')
+            print('Vext = ' + '{:.3f}'.format(vext) + ', J = ' + '{:.4E}'.format(jext) + ' A/m2', flush=True)
+    with open('log.txt', 'w') as fp:
+        fp.write('fake simss run, ' + str(n_voltages) + ' voltages\n')
+    with open('scPars.dat', 'w') as fp:
+        fp.write('Jsc Voc FF\n' + '{:.6E} {:.6E} {:.6E}\n'.format(j_sc, 0.0259*1.5*math.log(-j_sc/1e-7 + 1), 0.8))
+    if random.random() < fail_rate:
+        print('fake failure', flush=True)
+        return 1
+    print('Finished', flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+# loadtest.py>
+# Load test: N concurrent sessions that edit parameters, save, run SimSS and plot, against a stand-in simss
+# (tools/fake_simss.py). Reports throughput and latency percentiles per stage.
+#
+# Usage (from the repository root):
+#   python -m tools.loadtest --sessions 20 --duration 60            sessions in this process, through utils/ like the pages
+#   python -m tools.loadtest --api http://127.0.0.1:8502 --sessions 20
+#                                                                   sessions against a running api_server.py
+#   python -m tools.loadtest --sim-seconds 5 --sim-mode cpu --grid 1000 --voltages 100
+#
+# In process, everything (fake simss, session directories, result cache, run archive) lives in a temporary directory.
+# Against the API the server has to be started with the fake simss in SIMsalabim/SimSS/simss.
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import numpy as np
+
+# Stages of a session iteration, in order
+stages = ['edit', 'save', 'run', 'plot']
+
+
+class StageTimes:
+    # Description:  Latencies per stage, shared by all session threads.
+    def __init__(self):
+        self.times = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, ok=True):
+        with self.lock:
+            self.times.setdefault(stage, []).append(seconds)
+            if not ok:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+
+
+def create_fake_simss_dir(work_dir):
+    # Description:  Create a SimSS directory with the fake simss and a device parameters file.
+    #               The parameter file of the SIMsalabim checkout is used when present.
+    # Returns:      simss_dir (string) - the directory, ending with a separator
+    simss_dir = os.path.join(work_dir, 'SimSS', '')
+    os.makedirs(simss_dir)
+    shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_simss.py'), simss_dir + 'simss')
+    os.chmod(simss_dir + 'simss', os.stat(simss_dir + 'simss').st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    if os.path.isfile('SIMsalabim/SimSS/device_parameters.txt'):
+        shutil.copyfile('SIMsalabim/SimSS/device_parameters.txt', simss_dir + 'device_parameters.txt')
+    else:
+        from tools import benchmark
+        with open(simss_dir + 'device_parameters.txt', 'w') as fp:
+            fp.write(benchmark.create_par_file(100))
+    return simss_dir
+
+def get_variant_value(rng, repeat_ratio):
+    # Description:  Thickness to simulate: one of a few common values (cache hits) with probability repeat_ratio, a new
+    #               value otherwise.
+    if rng.random() < repeat_ratio:
+        return '{:.4g}'.format(rng.choice([100e-9, 200e-9, 300e-9]))
+    return '{:.6g}'.format(rng.uniform(50e-9, 500e-9))
+
+def run_session_in_process(session_index, args, stage_times, stop):
+    # Description:  One simulated user, going through the stages of the pages with the functions they use.
+    from utils import dev_par_model as dpm
+    from utils import fast_plot as fp
+    from utils import frame_cache as fc
+    from utils import simss_runner as sr
+    from utils import var_sidecar as vs
+    rng = random.Random(args.seed + session_index)
+    session_state = {}
+    session_dir = sr.get_session_dir(session_state)
+    par_path = session_dir + 'device_parameters.txt'
+    while not stop.is_set():
+        start = time.perf_counter()
+        dev_par_model, parsed = dpm.get_cached_model(session_state, par_path)
+        dev_par_model.set('L', get_variant_value(rng, args.repeat_ratio))
+        stage_times.add('edit', time.perf_counter() - start)
+
+        start = time.perf_counter()
+        dpm.write_cached_model(session_state, par_path, dev_par_model)
+        stage_times.add('save', time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with open(par_path) as fp_par:
+            job = sr.submit_simss(fp_par.read(), session_dir, timeout=args.timeout)
+        while not job.is_finished():
+            time.sleep(0.1)
+        stage_times.add('run', time.perf_counter() - start, job.status == 'done')
+        if job.status != 'done':
+            continue
+
+        start = time.perf_counter()
+        ok = True
+        try:
+            fc.get_frame(session_dir + 'JV.dat')
+            sidecar = vs.open_sidecar(session_dir + 'Var.dat')
+            voltages = vs.get_voltages(sidecar)
+            vs.load_columns(sidecar, vs.get_columns(sidecar), voltages[len(voltages)//2])
+            fp.render_var_plot(sidecar, 'n', 'log', 'line')
+        except Exception:
+            ok = False
+        stage_times.add('plot', time.perf_counter() - start, ok)
+        stop.wait(rng.uniform(0, 2*args.think))
+
+def api_request(url, method='GET', body=None):
+    # Returns:      payload (bytes) - response body, raises on HTTP errors
+    data = None if body is None else json.dumps(body).encode()
+    request = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=3600) as response:
+        return response.read()
+
+def run_session_api(session_index, args, stage_times, stop):
+    # Description:  One simulated user of the HTTP API: submit a simulation with changed parameters, wait for it and
+    #               fetch the JV and Var results.
+    rng = random.Random(args.seed + session_index)
+    base_url = args.api.rstrip('/') + '/api/simulations'
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            body = {'parameters': {'L': get_variant_value(rng, args.repeat_ratio)}, 'timeout': args.timeout,
+                    'wait': True}
+            job = json.loads(api_request(base_url, 'POST', body))
+            ok = job.get('status') == 'done'
+        except Exception:
+            job, ok = {}, False
+        stage_times.add('run', time.perf_counter() - start, ok)
+        if not ok:
+            continue
+        start = time.perf_counter()
+        try:
+            api_request(base_url + '/' + job['id'] + '/jv?format=npz')
+            api_request(base_url + '/' + job['id'] + '/var?format=npz')
+            ok = True
+        except Exception:
+            ok = False
+        stage_times.add('plot', time.perf_counter() - start, ok)
+        stop.wait(rng.uniform(0, 2*args.think))
+
+def summarize(stage_times, elapsed):
+    # Description:  Throughput and latency percentiles per stage.
+    # Returns:      report (dict) - stage -> count, errors, throughput (/s) and p50/p90/p99/max latency (s)
+    report = {}
+    for stage in stages:
+        times = stage_times.times.get(stage)
+        if not times:
+            continue
+        p50, p90, p99 = np.percentile(times, [50, 90, 99])
+        report[stage] = {'count': len(times), 'errors': stage_times.errors.get(stage, 0),
+                        'throughput': len(times)/elapsed, 'p50_s': p50, 'p90_s': p90, 'p99_s': p99,
+                        'max_s': max(times)}
+    return report
+
+def print_report(report, args, elapsed):
+    print(str(args.sessions) + ' sessions, ' + '{:.0f}'.format(elapsed) + ' s, simulated run time '
+            + str(args.sim_seconds) + ' s (' + args.sim_mode + ')')
+    print('{:<8} {:>7} {:>7} {:>9} {:>10} {:>10} {:>10} {:>10}'.format(
+        'stage', 'count', 'errors', 'per s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for stage, result in report.items():
+        print('{:<8} {:>7} {:>7} {:>9.2f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            stage, result['count'], result['errors'], result['throughput'], result['p50_s']*1000,
+            result['p90_s']*1000, result['p99_s']*1000, result['max_s']*1000))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test for SIMsalabim-web with a stand-in simss')
+    parser.add_argument('--sessions', type=int, default=10, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=60, help='length of the test in s')
+    parser.add_argument('--think', type=float, default=1.0, help='mean pause between iterations of a user in s')
+    parser.add_argument('--repeat-ratio', type=float, default=0.2,
+                        help='fraction of runs with commonly used parameters (result cache hits)')
+    parser.add_argument('--timeout', type=float, default=600, help='time limit of a run in s')
+    parser.add_argument('--api', help='base URL of a running api_server.py, test in process when not given')
+    parser.add_argument('--workers', type=int, help='simss worker pool size (in process), default number of cores')
+    parser.add_argument('--sim-seconds', type=float, default=1.0, help='run time of the fake simss in s')
+    parser.add_argument('--sim-mode', choices=['sleep', 'cpu'], default='sleep', help='fake simss sleeps or computes')
+    parser.add_argument('--grid', type=int, default=500, help='grid points per voltage in Var.dat')
+    parser.add_argument('--voltages', type=int, default=50, help='voltages in JV.dat and Var.dat')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of fake runs that fail')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args(argv)
+
+    # Read by the fake simss, also when it is started by the worker pool
+    os.environ.update({'FAKE_SIMSS_SECONDS': str(args.sim_seconds), 'FAKE_SIMSS_MODE': args.sim_mode,
+                        'FAKE_SIMSS_GRID': str(args.grid), 'FAKE_SIMSS_VOLTAGES': str(args.voltages),
+                        'FAKE_SIMSS_FAIL_RATE': str(args.fail_rate)})
+    # Only the report, not a metrics line per event
+    from utils import metrics
+    metrics.logger.setLevel(logging.WARNING)
+    work_dir = tempfile.mkdtemp(prefix='simsalabim_loadtest_')
+    try:
+        if args.api:
+            run_session = run_session_api
+        else:
+            if args.workers:
+                os.environ['SIMSS_WORKERS'] = str(args.workers)
+            from utils import result_cache as rc
+            from utils import run_archive as ra
+            from utils import simss_runner as sr
+            # Keep the test apart from the sessions and cache of a real installation
+            sr.SimSS_path = create_fake_simss_dir(work_dir)
+            sr.session_base_dir = os.path.join(work_dir, 'sessions')
+            sr.scratch_base_dir = os.path.join(work_dir, 'jobs')
+            rc.cache_dir = os.path.join(work_dir, 'cache')
+            ra.archive_dir = os.path.join(work_dir, 'archive')
+            run_session = run_session_in_process
+
+        stage_times = StageTimes()
+        stop = threading.Event()
+        threads = [threading.Thread(target=run_session, args=(index, args, stage_times, stop), daemon=True)
+                    for index in range(args.sessions)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        stop.wait(args.duration)
+        stop.set()
+        # Let the iterations in progress finish, they are part of the measured period
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        report = summarize(stage_times, elapsed)
+        print_report(report, args, elapsed)
+        if args.output:
+            with open(args.output, 'w') as fp:
+                json.dump({'arguments': vars(args), 'elapsed_s': elapsed, 'stages': report}, fp, indent=2)
+        if not args.api:
+            # Archives are written in the background, let them finish before the directory is removed
+            ra.wait_for_archives()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
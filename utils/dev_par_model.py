@@ -0,0 +1,245 @@
+# dev_par_model.py>
+import os
+from utils import helper_functions as hf
+
+# Section names in file order, identical to the sections of the List object created by helper_functions.read_from_txt
+section_names = ['Description','General','Mobilities','Contacts','Transport layers','Ions',
+                'Generation and recombination','Trapping','Numerical Parameters',
+                'Voltage range of simulation','User interface']
+
+
+class DevParEntry:
+    # Description:  A single parameter or left adjusted comment of a device parameters file.
+    #               kind (string) -     'par' or 'comm'
+    #               name (string) -     parameter name, or the comment text for comments
+    #               value (string) -    parameter value as written in the file
+    #               number (float) -    value parsed as number, None when the value is not a number (file names)
+    #               desc (string) -     description, lines of multi-line descriptions separated by '*'
+    #               line (number) -     index of the (first) line of the entry in DevParModel.lines
+    __slots__ = ('kind', 'name', 'value', 'number', 'desc', 'line')
+
+    def __init__(self, kind, name, value, desc, line):
+        self.kind = kind
+        self.name = name
+        self.value = value
+        self.number = to_number(value)
+        self.desc = desc
+        self.line = line
+
+
+class DevParModel:
+    # Description:  Indexed model of a device parameters file.
+    #               The original lines are kept, and a changed parameter only rewrites its own line. Untouched lines are
+    #               written back exactly as read, so the file layout (comments, sections, alignment) is preserved.
+    #               The section layout and the name index are never modified after parsing and are shared between
+    #               copies, so copy() and set() are cheap enough to create thousands of variants for sweeps and fits.
+    #               lines (List) -      lines of the file, including line endings
+    #               entries (List) -    DevParEntry objects in file order
+    #               sections (List) -   [section name, [positions in entries]] for every section
+    #               index (dict) -      parameter name -> position in entries
+    #               dirty (set) -       positions of entries whose line must be rewritten
+    __slots__ = ('lines', 'entries', 'sections', 'index', 'dirty')
+
+    def __init__(self, lines, entries, sections, index):
+        self.lines = lines
+        self.entries = entries
+        self.sections = sections
+        self.index = index
+        self.dirty = set()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get_entry(self, name):
+        # Returns:  entry (DevParEntry) - the entry of parameter name. Raises KeyError for unknown parameters.
+        return self.entries[self.index[name]]
+
+    def get(self, name):
+        # Returns:  value (string) - value of parameter name as written in the file
+        return self.get_entry(name).value
+
+    def get_number(self, name):
+        # Returns:  value (float) - value of parameter name as number, None when it is not a number
+        return self.get_entry(name).number
+
+    def names(self):
+        # Returns:  names (List) - all parameter names in file order
+        return list(self.index)
+
+    def values(self):
+        # Returns:  values (dict) - parameter name -> value (string)
+        return {name: self.entries[position].value for name, position in self.index.items()}
+
+    def set(self, name, value):
+        # Description:  Change the value of a parameter. Only marks the line as dirty, rendering happens in to_txt.
+        # Arguments:    name (string) - parameter name
+        #               value (string or number) - new value
+        # Returns:      changed (bool) - False when the value was already equal
+        #               Raises ValueError for values that cannot be written to the file (see check_value)
+        position = self.index[name]
+        entry = self.entries[position]
+        value = check_value(name, value)
+        if value == entry.value:
+            return False
+        # Entries may be shared with copies of the model: replace, never modify
+        self.entries[position] = DevParEntry(entry.kind, entry.name, value, entry.desc, entry.line)
+        self.dirty.add(position)
+        return True
+
+    def update(self, values):
+        # Description:  Change several parameter values at once.
+        # Arguments:    values (dict) - parameter name -> new value
+        # Returns:      changed (List) - names of the parameters whose value changed
+        #               Raises ValueError before changing anything when one of the values is invalid
+        for name, value in values.items():
+            check_value(name, value)
+        return [name for name, value in values.items() if self.set(name, value)]
+
+    def copy(self):
+        # Returns:  model (DevParModel) - independent copy, sharing the immutable parts with this model
+        model = DevParModel(list(self.lines), list(self.entries), self.sections, self.index)
+        model.dirty = set(self.dirty)
+        return model
+
+    def iter_section(self, section):
+        # Description:  Entries of a section, in file order.
+        # Arguments:    section (List) - element of sections
+        # Returns:      entries (generator) - DevParEntry objects
+        return (self.entries[position] for position in section[1])
+
+    def to_txt(self):
+        # Description:  Serialize the model to the text of a device parameters file.
+        #               Only the lines of changed parameters are rendered again.
+        # Returns:      par_file (string) - content of the device parameters file
+        for position in self.dirty:
+            entry = self.entries[position]
+            self.lines[entry.line] = render_par_line(entry, self.lines[entry.line])
+        self.dirty.clear()
+        return ''.join(self.lines)
+
+    def to_list_object(self):
+        # Description:  Convert to the nested List object of helper_functions.read_from_txt.
+        # Returns:      dev_par_object (List) - List with nested lists for all parameters in all sections
+        dev_par_object = []
+        for section in self.sections:
+            section_object = [section[0]]
+            for entry in self.iter_section(section):
+                if entry.kind == 'par':
+                    section_object.append(['par', entry.name, entry.value, entry.desc])
+                else:
+                    section_object.append(['comm', entry.name])
+            dev_par_object.append(section_object)
+        return dev_par_object
+
+
+def check_value(name, value):
+    # Description:  Check that a value can be written as the value of a parameter line: a single line, without the
+    #               description marker '*'. Otherwise a value could add or hide lines of the file.
+    # Arguments:    name (string) - parameter name, for the error message
+    #               value (string or number) - new value
+    # Returns:      value (string) - the value as written in the file
+    #               Raises ValueError when the value is empty or contains a line break or '*'
+    value = str(value).strip()
+    if value == '' or '*' in value or '\n' in value or '\r' in value:
+        raise ValueError('Invalid value for ' + name + ': ' + repr(value)
+                            + ', values cannot be empty or contain line breaks or *')
+    return value
+
+def to_number(value):
+    # Description:  Parse a parameter value as number.
+    # Arguments:    value (string) - value as written in the file
+    # Returns:      number (float) - the value, None when it is not a number
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def render_par_line(entry, line):
+    # Description:  Create the line for a changed parameter. The description is kept at the same column as in the
+    #               original line, unless the new 'par = val' part is too wide for it.
+    # Arguments:    entry (DevParEntry) - the changed parameter
+    #               line (string) - the current line of the parameter
+    # Returns:      line (string) - the new line
+    par_val = entry.name + ' = ' + entry.value
+    desc_column = line.find('*')
+    if desc_column < 0:
+        return par_val + line[len(line.rstrip('\r\n')):]
+    if len(par_val) < desc_column:
+        return par_val.ljust(desc_column) + line[desc_column:]
+    return par_val + ' ' + line[desc_column:]
+
+def parse_dev_par(par_file):
+    # Description:  Create the model from the content of a device parameters file. Follows the same rules as
+    #               helper_functions.read_from_txt.
+    # Arguments:    par_file (string or iterable) - content of the file, or an opened file
+    # Returns:      model (DevParModel) - the parsed model
+    if isinstance(par_file, str):
+        lines = par_file.splitlines(True)
+    else:
+        lines = list(par_file)
+    entries = []
+    sections = [[name, []] for name in section_names]
+    index = {}
+    section_index = 0
+    for line_number, line in enumerate(lines):
+        if line.startswith('**'):
+            # Left adjusted comment, either a section title or a comment belonging to the current section
+            section_index, changes = hf.read_comment_line(line, section_index)
+            if section_index == 0 or changes:
+                sections[section_index][1].append(len(entries))
+                entries.append(DevParEntry('comm', line[2:].strip(), None, None, line_number))
+        elif line.strip() == '':
+            continue
+        else:
+            par_line = line.split('*', 1)
+            if '=' in par_line[0]:
+                name, value = par_line[0].split('=', 1)
+                desc = par_line[1].strip() if len(par_line) > 1 else ''
+                index[name.strip()] = len(entries)
+                sections[section_index][1].append(len(entries))
+                entries.append(DevParEntry('par', name.strip(), value.strip(), desc, line_number))
+            else:
+                # Continuation of the description of the last parameter. It is kept as its own line in lines.
+                position = sections[section_index][1][-1]
+                entry = entries[position]
+                entry.desc = entry.desc + '*' + par_line[-1].strip()
+    return DevParModel(lines, entries, sections, index)
+
+def read_dev_par_file(path):
+    # Description:  Read and parse a device parameters file.
+    # Arguments:    path (string) - path to the file
+    # Returns:      model (DevParModel) - the parsed model
+    with open(path) as fp:
+        return parse_dev_par(fp.read())
+
+def get_file_signature(path):
+    # Description:  Modification time and size of a file, changes whenever the file is written.
+    # Arguments:    path (string) - path to the file
+    # Returns:      signature (tuple) - (mtime in ns, size)
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def get_cached_model(cache, path):
+    # Description:  Get the model of a parameter file from a cache (e.g. st.session_state), parsing the file only when it
+    #               is not cached yet or has been changed on disk since it was parsed.
+    # Arguments:    cache (dict) - mapping to keep the model in
+    #               path (string) - path to the file
+    # Returns:      model (DevParModel) - the model of the file, including changes not yet written to the file
+    #               parsed (bool) - True when the file was (re)parsed
+    signature = get_file_signature(path)
+    entry = cache.get('dev_par_model')
+    if entry is not None and entry[0] == path and entry[1] == signature:
+        return entry[2], False
+    model = read_dev_par_file(path)
+    cache['dev_par_model'] = (path, signature, model)
+    return model, True
+
+def write_cached_model(cache, path, model):
+    # Description:  Write a model to its file and store it in the cache with the signature of the written file.
+    # Arguments:    cache (dict) - mapping to keep the model in
+    #               path (string) - path to the file
+    #               model (DevParModel) - model to write
+    par_file = model.to_txt()
+    with open(path, 'w') as fp:
+        fp.write(par_file)
+    cache['dev_par_model'] = (path, get_file_signature(path), model)
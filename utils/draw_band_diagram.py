@@ -1,5 +1,10 @@
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+import io
+from functools import lru_cache
+from utils import metrics
+# matplotlib is imported in the functions that draw, so importing this module does not slow down the page start
+
+# Parameters (in this order) that determine the band diagram
+band_param_keys = ['L','L_LTL','L_RTL','CB','VB','W_L','W_R','CB_LTL','CB_RTL','VB_LTL','VB_RTL']
 
 def create_rectangle_patch(
         CB,
@@ -25,6 +30,7 @@ def create_rectangle_patch(
     #               ax (ax) -                       Figure
     # Returns:      rect (Rectangle) -              Rectangle patches object.
     #               p_right (float) -               x value of right border of current layer to be used as input for x position of the next layer
+    import matplotlib.patches as patches
     e_CB = (CB-energy_offset)/energy_step_size
     e_VB = (VB-energy_offset)/energy_step_size
     e_delta = e_VB-e_CB
@@ -53,7 +59,13 @@ def create_energy_label(x_left, x_right, y, offset, value, size, ax):
         ax.text(x_left,y + offset,value)
 
 def create_band_energy_diagram(param):
-    fig, ax = plt.subplots()
+    # Description:  Create the band diagram figure. A plain Figure is used instead of pyplot, so the figure is not kept
+    #               alive by the pyplot figure registry and is freed as soon as it is no longer referenced.
+    # Arguments:    param (dict) - the band_param_keys parameters (string or float)
+    # Returns:      fig (Figure) - the band diagram
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
 
     size = 1000000  # set number of grid points
     ax.set_xlim(-0.01*size, size+0.01*size)  # Add extra whitespace to x-axis
@@ -132,6 +144,30 @@ def create_band_energy_diagram(param):
     # plt.savefig('./figures/band_diagram.png')
     return fig
 
+def normalize_band_parameters(param):
+    # Description:  Convert the band diagram parameters to a hashable key. Values are compared as numbers, so 3e-7 and
+    #               300E-9 map to the same key.
+    # Arguments:    param (dict) - the band_param_keys parameters (string or float)
+    # Returns:      key (tuple) - float values in the order of band_param_keys
+    return tuple(float(param[key]) for key in band_param_keys)
+
+def render_band_diagram(param):
+    # Description:  Band diagram as PNG image. Rendering is memoized on the normalized parameters, so saving the device
+    #               parameters again without changing the band parameters returns the stored image.
+    # Arguments:    param (dict) - the band_param_keys parameters (string or float)
+    # Returns:      image (bytes) - PNG encoded band diagram
+    return _render_band_diagram(normalize_band_parameters(param))
+
+@lru_cache(maxsize=256)
+@metrics.timed('band_diagram.render')
+def _render_band_diagram(key):
+    fig = create_band_energy_diagram(dict(zip(band_param_keys, key)))
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    # Release all artists of the figure right away instead of waiting for the garbage collector
+    fig.clear()
+    return buffer.getvalue()
+
 
 if __name__ == '__main__':
     # TEMP parameters for testing
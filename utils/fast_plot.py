@@ -0,0 +1,167 @@
+# fast_plot.py>
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from utils import metrics
+
+# Number of rendered images kept in memory
+max_cached_images = 64
+
+_images = OrderedDict()
+_lock = threading.Lock()
+
+
+def lttb(x, y, n_out, y_shape=None):
+    # Description:  Largest-Triangle-Three-Buckets downsampling, applied to many curves at once.
+    #               The first and last point are kept, the points in between are divided into n_out-2 buckets and from
+    #               every bucket the point forming the largest triangle with the previously selected point and the average
+    #               of the next bucket is selected. This preserves peaks and steps, unlike taking every n-th point.
+    # Arguments:    x (ndarray) - x values, shape (n_points) or (n_curves, n_points)
+    #               y (ndarray) - y values, shape (n_curves, n_points)
+    #               n_out (number) - number of points to keep per curve
+    #               y_shape (ndarray) - y values the points are selected on, y when None. For a log scale this is
+    #                                   log10(|y|), so the selection follows the curve as it is drawn.
+    # Returns:      x_out (ndarray) - downsampled x values, shape (n_curves, n_out)
+    #               y_out (ndarray) - downsampled y values, shape (n_curves, n_out)
+    y = np.asarray(y, dtype=float)
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    n_curves, n_points = y.shape
+    if n_out >= n_points or n_out < 3:
+        return np.array(x), np.array(y)
+    shape = y if y_shape is None else np.asarray(y_shape, dtype=float)
+
+    rows = np.arange(n_curves)
+    # Bucket edges for the points between the first and the last point
+    edges = np.floor(np.linspace(1, n_points - 1, n_out - 1)).astype(int)
+    x_out = np.empty((n_curves, n_out))
+    y_out = np.empty((n_curves, n_out))
+    x_out[:, 0], y_out[:, 0] = x[:, 0], y[:, 0]
+    x_out[:, -1], y_out[:, -1] = x[:, -1], y[:, -1]
+    selected = np.zeros(n_curves, dtype=int)
+    for bucket in range(n_out - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        # Average of the next bucket, the last bucket looks ahead to the last point
+        if bucket < n_out - 3:
+            next_start, next_stop = edges[bucket + 1], edges[bucket + 2]
+        else:
+            next_start, next_stop = n_points - 1, n_points
+        x_next = np.nanmean(x[:, next_start:next_stop], axis=1)
+        y_next = np.nanmean(shape[:, next_start:next_stop], axis=1)
+        x_prev = x[rows, selected]
+        y_prev = shape[rows, selected]
+        # Twice the area of the triangles, for all candidate points of the bucket in all curves
+        area = np.abs((x_prev - x_next)[:, None]*(shape[:, start:stop] - y_prev[:, None])
+                      - (x_prev[:, None] - x[:, start:stop])*(y_next - y_prev)[:, None])
+        area = np.nan_to_num(area, nan=-1.0)
+        selected = start + np.argmax(area, axis=1)
+        x_out[:, bucket + 1] = x[rows, selected]
+        y_out[:, bucket + 1] = y[rows, selected]
+    return x_out, y_out
+
+def lttb_padded(x, y, lengths, n_out, y_shape=None):
+    # Description:  lttb for NaN padded curves of unequal length: curves of the same length are downsampled together,
+    #               each over its own points only, so the padding is never selected and the real last point is kept.
+    # Arguments:    x, y (ndarray) - values, shape (n_curves, n_points), NaN after the valid points of every curve
+    #               lengths (ndarray) - number of valid points of every curve
+    #               n_out (number) - number of points to keep per curve
+    #               y_shape (ndarray) - y values the points are selected on, see lttb
+    # Returns:      x_out, y_out (ndarray) - downsampled values, shape (n_curves, min(n_out, n_points)), NaN padded
+    n_width = min(n_out, x.shape[1])
+    x_out = np.full((x.shape[0], n_width), np.nan)
+    y_out = np.full((x.shape[0], n_width), np.nan)
+    for length in np.unique(lengths):
+        rows = np.flatnonzero(lengths == length)
+        x_rows, y_rows = lttb(x[rows, :length], y[rows, :length], n_out,
+                                None if y_shape is None else y_shape[rows, :length])
+        x_out[rows, :x_rows.shape[1]] = x_rows
+        y_out[rows, :y_rows.shape[1]] = y_rows
+    return x_out, y_out
+
+def get_curves(sidecar, y_var):
+    # Description:  Collect the x and y values of every voltage as equally long curves.
+    # Arguments:    sidecar (dict) - Var.dat sidecar from var_sidecar.open_sidecar
+    #               y_var (string) - column to plot
+    # Returns:      x (ndarray) - x values, shape (n_curves, n_points)
+    #               y (ndarray) - y values, shape (n_curves, n_points)
+    #               vext (ndarray) - voltage of every curve
+    #               lengths (ndarray) - number of points of every curve, None when they are all n_points
+    from utils import var_sidecar as vs
+    index = sidecar['meta']['index']
+    x_all = vs.get_column(sidecar, 'x')
+    y_all = vs.get_column(sidecar, y_var)
+    vext = np.array([entry[0] for entry in index])
+    lengths = set(stop - start for value, start, stop in index)
+    if len(lengths) == 1:
+        # Same grid for every voltage (the normal case): reshape without copying
+        n_points = lengths.pop()
+        return x_all.reshape(len(index), n_points), y_all.reshape(len(index), n_points), vext, None
+    # Unequal blocks: pad with NaN, which is not drawn
+    n_points = max(lengths)
+    x = np.full((len(index), n_points), np.nan)
+    y = np.full((len(index), n_points), np.nan)
+    for row, (value, start, stop) in enumerate(index):
+        x[row, :stop - start] = x_all[start:stop]
+        y[row, :stop - start] = y_all[start:stop]
+    return x, y, vext, np.array([stop - start for value, start, stop in index])
+
+def render_var_plot(sidecar, y_var, scale, style, dpi=100, figsize=(6.4, 4.8)):
+    # Description:  Render y_var as function of x for all voltages as a single PNG image. All curves are drawn as one
+    #               LineCollection (or one scatter), downsampled with LTTB to the pixel width of the figure.
+    #               Images are cached on (Var.dat identity, variable, scale, style), so switching back and forth is free.
+    # Arguments:    sidecar (dict) - Var.dat sidecar from var_sidecar.open_sidecar
+    #               y_var (string) - column to plot on the y-axis
+    #               scale (string) - 'linear' or 'log'
+    #               style (string) - 'line' or 'scatter'
+    # Returns:      image (bytes) - PNG encoded figure
+    file_hash = hashlib.sha1(repr(sidecar['meta']['source']).encode('utf-8')).hexdigest()
+    key = (file_hash, y_var, scale, style, dpi, figsize)
+    with _lock:
+        if key in _images:
+            _images.move_to_end(key)
+            metrics.incr('var_plot.cache_hits')
+            return _images[key]
+
+    from matplotlib.figure import Figure
+    from matplotlib.collections import LineCollection
+    import matplotlib.colors as mcolors
+
+    with metrics.span('var_plot.downsample'):
+        x, y, vext, lengths = get_curves(sidecar, y_var)
+        n_out = int(figsize[0]*dpi)
+        y_shape = None
+        if scale == 'log':
+            # Select on the decades, otherwise the points follow the largest values and low values are flattened
+            with np.errstate(divide='ignore', invalid='ignore'):
+                y_shape = np.where(y != 0, np.log10(np.abs(y)), np.nan)
+        if lengths is None:
+            x, y = lttb(x, y, n_out, y_shape)
+        else:
+            x, y = lttb_padded(x, y, lengths, n_out, y_shape)
+
+    render_start = time.perf_counter()
+    fig = Figure(figsize=figsize, dpi=dpi)
+    ax = fig.subplots()
+    ax.set_yscale(scale)
+    norm = mcolors.Normalize(vmin=vext.min(), vmax=vext.max())
+    if style == 'scatter':
+        mappable = ax.scatter(x.ravel(), y.ravel(), c=np.repeat(vext, x.shape[1]), norm=norm, s=4, cmap='viridis')
+    else:
+        mappable = LineCollection(np.stack((x, y), axis=-1), array=vext, norm=norm, cmap='viridis', linewidths=1)
+        ax.add_collection(mappable)
+        ax.autoscale()
+    ax.set_xlabel('x')
+    ax.set_ylabel(y_var)
+    fig.colorbar(mappable, ax=ax, label='Vext')
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    image = buffer.getvalue()
+    metrics.observe('var_plot.render', time.perf_counter() - render_start)
+    with _lock:
+        _images[key] = image
+        while len(_images) > max_cached_images:
+            _images.popitem(last=False)
+    return image
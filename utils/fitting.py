@@ -0,0 +1,248 @@
+# fitting.py>
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import wait
+import numpy as np
+from utils import metrics
+from utils import result_cache as rc
+from utils import run_archive as ra
+from utils import simss_runner as sr
+from utils import sweep
+
+# Significant digits of the parameter values written for a candidate. Candidates that are equal at this precision are
+# simulated once, and rounding makes repeated candidates hit the result cache.
+value_digits = 4
+# Differential evolution settings: mutation factor and crossover probability
+mutation_factor = 0.7
+crossover_rate = 0.9
+
+
+class FitJob:
+    # Description:  Book keeping of a fit running in a background thread.
+    #               status is one of 'running', 'done', 'failed' or 'cancelled'.
+    #               history holds one dict per iteration with the best error so far and the evaluation counts.
+    #               best_jv holds the simulated (vext, jext) of best_values and best_key its result cache key.
+    def __init__(self, free_params, iterations, population, base_par_file=None):
+        self.id = uuid.uuid4().hex
+        self.base_par_file = base_par_file
+        self.free_params = free_params
+        self.iterations = iterations
+        self.population = population
+        self.status = 'running'
+        self.iteration = 0
+        self.best_error = float('inf')
+        self.best_values = None
+        self.best_jv = None
+        self.best_key = None
+        self.history = []
+        self.evaluations = 0
+        self.memo_hits = 0
+        self.message = ''
+        self.started = time.time()
+        self.finished = None
+        self.cancel_requested = False
+        self.running_jobs = []
+        self.thread = None
+        # Simulated curves of candidates that improved on the best error, candidate key -> (vext, jext, cache key)
+        self.improved = {}
+
+    def is_finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+
+def parse_measured_jv(text):
+    # Description:  Read a measured JV curve: two whitespace, comma, semicolon or tab separated columns with the
+    #               voltage (V) and current density (A/m2, SimSS sign convention). Header and comment lines are skipped.
+    # Arguments:    text (string) - content of the uploaded file
+    # Returns:      vext (ndarray) - measured voltages, sorted
+    #               jext (ndarray) - measured current densities
+    rows = []
+    for line in text.splitlines():
+        fields = line.replace(',', ' ').replace(';', ' ').split()
+        if len(fields) < 2:
+            continue
+        try:
+            rows.append((float(fields[0]), float(fields[1])))
+        except ValueError:
+            # Header or comment
+            continue
+    if len(rows) < 2:
+        raise ValueError('The measured JV file should contain at least two rows with a voltage and a current density')
+    data = np.array(sorted(rows))
+    return data[:, 0], data[:, 1]
+
+def get_fit_error(sim_v, sim_j, meas_v, meas_j):
+    # Description:  Root mean square difference between the simulated and measured current density, at the measured
+    #               voltages inside the simulated voltage range, relative to the largest measured current density.
+    # Returns:      error (float) - relative RMS error, inf when the voltage ranges do not overlap
+    order = np.argsort(sim_v)
+    sim_v, sim_j = sim_v[order], sim_j[order]
+    inside = (meas_v >= sim_v[0]) & (meas_v <= sim_v[-1])
+    if np.count_nonzero(inside) < 2:
+        return float('inf')
+    difference = np.interp(meas_v[inside], sim_v, sim_j) - meas_j[inside]
+    return float(np.sqrt(np.mean(difference**2))/max(np.max(np.abs(meas_j)), 1e-30))
+
+def to_values(free_params, candidates):
+    # Description:  Map candidates from the unit cube to parameter values, logarithmically for parameters with log=True.
+    # Arguments:    free_params (dict) - name -> (lower bound, upper bound, log)
+    #               candidates (ndarray) - shape (n_candidates, n_params), values in [0, 1]
+    # Returns:      values (List) - one dict (name -> formatted value) per candidate
+    values = []
+    for candidate in candidates:
+        point = {}
+        for x, (name, (low, high, log)) in zip(candidate, free_params.items()):
+            if log:
+                value = 10**(np.log10(low) + x*(np.log10(high) - np.log10(low)))
+            else:
+                value = low + x*(high - low)
+            point[name] = '{:.{}g}'.format(value, value_digits)
+        values.append(point)
+    return values
+
+def evaluate_batch(fit_job, dev_par_model, points, measured, fit_dir, memo):
+    # Description:  Simulate a batch of candidates in parallel on the simss worker pool and compute their errors.
+    #               Candidates already in memo (or twice in the batch) are simulated only once.
+    # Arguments:    fit_job (FitJob) - the fit, for progress and cancellation
+    #               dev_par_model (DevParModel) - parameters to start from
+    #               points (List) - candidate parameter values from to_values
+    #               measured (tuple) - measured (vext, jext)
+    #               fit_dir (string) - directory for the evaluations
+    #               memo (dict) - candidate key -> error, updated in place
+    # Returns:      errors (ndarray) - error of every candidate
+    keys = [tuple(sorted(point.items())) for point in points]
+    submitted = {}
+    for key, point in zip(keys, points):
+        if key in memo or key in submitted:
+            fit_job.memo_hits += 1
+            continue
+        fit_job.evaluations += 1
+        eval_dir = os.path.join(fit_dir, 'eval_' + str(fit_job.evaluations), '')
+        os.makedirs(eval_dir, exist_ok=True)
+        par_file = sweep.set_parameters(dev_par_model, point).to_txt()
+        # Candidates are not archived, only the best fit is (archive_best)
+        submitted[key] = sr.submit_simss(par_file, eval_dir, archive=False)
+    fit_job.running_jobs = list(submitted.values())
+    wait([job.future for job in fit_job.running_jobs if job.future is not None])
+    fit_job.running_jobs = []
+    for key, job in submitted.items():
+        error = float('inf')
+        if job.status == 'done':
+            try:
+                sim_jv = np.genfromtxt(job.session_dir + 'JV.dat', names=True)
+                error = get_fit_error(sim_jv['Vext'], sim_jv['Jext'], *measured)
+                if error < fit_job.best_error:
+                    # Candidate for the best fit, keep its curve so the result can be shown without simulating again
+                    fit_job.improved[key] = (sim_jv['Vext'], sim_jv['Jext'], job.cache_key)
+            except (OSError, ValueError):
+                pass
+        memo[key] = error
+        # Output is kept in the result cache, the evaluation directory is not needed anymore
+        shutil.rmtree(job.session_dir, ignore_errors=True)
+    metrics.incr('fit.evaluations', len(submitted))
+    return np.array([memo[key] for key in keys])
+
+def update_best(fit_job, population, errors):
+    # Description:  Store the best candidate of the population in fit_job.
+    best = int(np.argmin(errors))
+    fit_job.best_error = float(errors[best])
+    if np.isfinite(errors[best]):
+        fit_job.best_values = to_values(fit_job.free_params, population[best:best + 1])[0]
+        best_key = tuple(sorted(fit_job.best_values.items()))
+        if best_key in fit_job.improved:
+            sim_v, sim_j, fit_job.best_key = fit_job.improved[best_key]
+            fit_job.best_jv = (sim_v, sim_j)
+        # Candidates that are not the best anymore are never shown
+        fit_job.improved = {best_key: fit_job.improved[best_key]} if best_key in fit_job.improved else {}
+
+def archive_best(fit_job, dev_par_model):
+    # Description:  Archive the simulation of the best fit, from its result cache entry.
+    if fit_job.best_key is None:
+        return
+    entry_dir = rc.lookup(fit_job.best_key)
+    if entry_dir is None:
+        return
+    job = sr.SimssJob(sweep.set_parameters(dev_par_model, fit_job.best_values).to_txt(), entry_dir)
+    job.cache_key = fit_job.best_key
+    job.stdout = rc.read_stdout(entry_dir)
+    job.started = fit_job.started
+    job.finished = time.time()
+    ra.archive_run(job, entry_dir)
+
+def run_fit(fit_job, dev_par_model, measured, fit_dir, seed=None):
+    # Description:  Differential evolution (rand/1/bin) in the unit cube of the free parameters. Every generation is
+    #               evaluated as one parallel batch. Runs in the background thread of fit_job.
+    rng = np.random.default_rng(seed)
+    n_params = len(fit_job.free_params)
+    memo = {}
+    try:
+        shutil.rmtree(fit_dir, ignore_errors=True)
+        population = rng.random((fit_job.population, n_params))
+        errors = evaluate_batch(fit_job, dev_par_model, to_values(fit_job.free_params, population), measured,
+                                fit_dir, memo)
+        update_best(fit_job, population, errors)
+        for iteration in range(1, fit_job.iterations + 1):
+            if fit_job.cancel_requested:
+                fit_job.status = 'cancelled'
+                break
+            with metrics.span('fit.iteration'):
+                trials = np.empty_like(population)
+                for index in range(fit_job.population):
+                    others = rng.choice([i for i in range(fit_job.population) if i != index], 3, replace=False)
+                    a, b, c = population[others]
+                    mutant = np.clip(a + mutation_factor*(b - c), 0, 1)
+                    cross = rng.random(n_params) < crossover_rate
+                    cross[rng.integers(n_params)] = True
+                    trials[index] = np.where(cross, mutant, population[index])
+                trial_errors = evaluate_batch(fit_job, dev_par_model, to_values(fit_job.free_params, trials),
+                                              measured, fit_dir, memo)
+            better = trial_errors < errors
+            population[better] = trials[better]
+            errors[better] = trial_errors[better]
+            update_best(fit_job, population, errors)
+            fit_job.iteration = iteration
+            fit_job.history.append({'iteration': iteration, 'best_error': fit_job.best_error,
+                                    'evaluations': fit_job.evaluations, 'memo_hits': fit_job.memo_hits})
+        else:
+            fit_job.status = 'done'
+        archive_best(fit_job, dev_par_model)
+    except Exception as err:
+        fit_job.message = str(err)
+        fit_job.status = 'failed'
+    finally:
+        fit_job.finished = time.time()
+        shutil.rmtree(fit_dir, ignore_errors=True)
+
+def start_fit(dev_par_model, measured, free_params, fit_dir, iterations=20, population=None, seed=None):
+    # Description:  Start fitting the free parameters to a measured JV curve in a background thread.
+    # Arguments:    dev_par_model (DevParModel) - parameters to start from, the other parameters are kept fixed
+    #               measured (tuple) - measured (vext, jext) from parse_measured_jv
+    #               free_params (dict) - name -> (lower bound, upper bound, log)
+    #               fit_dir (string) - directory for the evaluations
+    #               iterations (number) - number of generations
+    #               population (number) - candidates per generation, by default a multiple of the worker pool size
+    # Returns:      fit_job (FitJob) - the started fit
+    unknown = [name for name in free_params if name not in dev_par_model]
+    if unknown:
+        raise KeyError('Unknown parameter(s): ' + ', '.join(sorted(unknown)))
+    for name, (low, high, log) in free_params.items():
+        if not low < high or (log and low <= 0):
+            raise ValueError('Invalid bounds for ' + name + ': lower < upper required, and > 0 on a log scale')
+    if population is None:
+        # Whole batches of the worker pool, at least 5 candidates per free parameter
+        workers = sr.get_worker_count()
+        population = workers*max(1, -(-5*len(free_params)//workers))
+    fit_job = FitJob(free_params, iterations, max(4, population), dev_par_model.to_txt())
+    fit_job.thread = threading.Thread(target=run_fit, args=(fit_job, dev_par_model.copy(), measured, fit_dir, seed),
+                                      name='fit_' + fit_job.id, daemon=True)
+    fit_job.thread.start()
+    return fit_job
+
+def cancel_fit(fit_job):
+    # Description:  Stop a fit after the running batch, the simss runs of that batch are cancelled.
+    fit_job.cancel_requested = True
+    for job in list(fit_job.running_jobs):
+        sr.cancel_job(job.id)
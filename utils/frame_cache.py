@@ -0,0 +1,160 @@
+# frame_cache.py>
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from utils import metrics
+
+# Memory budget of all cached tables together (bytes). Least recently used tables are evicted first.
+frame_cache_max_bytes = int(os.environ.get('SIMSALABIM_FRAME_CACHE_BYTES', 512*1024**2))
+# Columns with this name and few unique values (e.g. the Vext of every row of Var.dat) are stored as categorical
+categorical_columns = ['Vext']
+# Significant digits of the numbers in the output files. Columns are only stored as float32 when every value keeps
+# these digits.
+text_digits = 7
+
+_frames = OrderedDict()
+_resident_bytes = 0
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'too_large': 0}
+_lock = threading.Lock()
+# One lock per table being loaded, so sessions asking for the same table at the same time load it only once
+_loading = {}
+
+
+def get_file_key(path):
+    # Description:  Identity of an output file, changes whenever simss (or the result cache) replaces the file.
+    #               The path is not part of it: sessions sharing a file (hard linked from the result cache) share the
+    #               cached table.
+    # Arguments:    path (string) - path to the file
+    # Returns:      key (tuple) - (device, inode, size, modification time in ns)
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def read_output_file(path):
+    # Description:  Default loader, reads a whitespace delimited SimSS output file (JV.dat, Var.dat, scPars.dat).
+    import pandas as pd
+    return pd.read_csv(path, sep=r'\s+')
+
+def round_significant(values, digits):
+    # Description:  Round non-zero values to a number of significant digits.
+    magnitude = 10.0**(np.floor(np.log10(np.abs(values))) - (digits - 1))
+    return np.round(values/magnitude)*magnitude
+
+def is_float32_safe(values):
+    # Description:  Check if a float64 column survives the conversion to float32: no overflow, no underflow of
+    #               non-zero values to zero, and the values have at most text_digits significant digits which float32
+    #               still reproduces. A relative tolerance cannot tell this: the rounding error of float32 is always
+    #               below 6e-8, also for values with 15 digits.
+    # Arguments:    values (ndarray) - float64 values
+    # Returns:      safe (bool)
+    finite = values[np.isfinite(values)]
+    nonzero = finite[finite != 0]
+    if len(nonzero) == 0:
+        return True
+    magnitude = np.abs(nonzero)
+    if magnitude.min() < np.finfo(np.float32).tiny or magnitude.max() > np.finfo(np.float32).max:
+        return False
+    # Fewest digits that hold every value, remaining differences are float64 noise of the decimal conversion only
+    for digits in range(1, text_digits + 1):
+        if np.allclose(round_significant(nonzero, digits), nonzero, rtol=1e-12, atol=0):
+            break
+    else:
+        return False
+    converted = nonzero.astype(np.float32).astype(np.float64)
+    return bool(np.allclose(round_significant(converted, digits), nonzero, rtol=1e-12, atol=0))
+
+def downcast_frame(data):
+    # Description:  Reduce the memory of a table: float64 columns to float32 where that is safe and columns in
+    #               categorical_columns with repeated values to categorical.
+    # Arguments:    data (DataFrame) - table to convert, converted in place
+    # Returns:      data (DataFrame) - the converted table
+    for column in data.columns:
+        values = data[column]
+        if column in categorical_columns:
+            n_unique = values.nunique()
+            if 1 < n_unique and n_unique*4 <= len(values):
+                data[column] = values.astype('category')
+                continue
+        if values.dtype == np.float64 and is_float32_safe(values.to_numpy()):
+            data[column] = values.astype(np.float32)
+    return data
+
+def get_frame(path, variant=None, loader=None):
+    # Description:  Get an output table from the process wide cache, loading (and downcasting) it on a miss.
+    #               The table is shared by all sessions of the process: treat it as read-only and copy it before
+    #               modifying it.
+    # Arguments:    path (string) - path to the output file, its identity is part of the cache key
+    #               variant (tuple) - extra key for tables derived from the file, e.g. ('Vext', 0.5) for a slice
+    #               loader (function) - function(path) returning the DataFrame, read_output_file when None
+    # Returns:      data (DataFrame) - the (downcast) table
+    key = get_file_key(path) + (variant,)
+    data = lookup(key)
+    if data is not None:
+        return data
+    with _lock:
+        key_lock = _loading.setdefault(key, threading.Lock())
+    try:
+        with key_lock:
+            # Loaded by another session while waiting for the lock
+            data = lookup(key)
+            if data is not None:
+                return data
+            with _lock:
+                _stats['misses'] += 1
+            metrics.incr('frame_cache.misses')
+            with metrics.span('frame_cache.load'):
+                data = downcast_frame((loader or read_output_file)(path))
+            add_frame(key, data)
+    finally:
+        with _lock:
+            _loading.pop(key, None)
+    return data
+
+def lookup(key):
+    # Description:  Get a cached table and mark it as most recently used.
+    # Returns:      data (DataFrame) - the cached table or None
+    with _lock:
+        entry = _frames.get(key)
+        if entry is None:
+            return None
+        data = entry[0]
+        _frames.move_to_end(key)
+        _stats['hits'] += 1
+    metrics.incr('frame_cache.hits')
+    return data
+
+def add_frame(key, data):
+    # Description:  Add a loaded table to the cache and evict the least recently used tables to stay within budget.
+    #               A table larger than the whole budget is not cached.
+    global _resident_bytes
+    size = int(data.memory_usage(index=True, deep=True).sum())
+    with _lock:
+        if size > frame_cache_max_bytes:
+            _stats['too_large'] += 1
+            return
+        _frames[key] = (data, size)
+        _resident_bytes += size
+        # Older versions of a file changed in place (same device and inode) are never requested again
+        stale_keys = [other for other in _frames if other[0:2] == key[0:2] and other[2:4] != key[2:4]]
+        evicted = 0
+        for other in stale_keys:
+            _resident_bytes -= _frames.pop(other)[1]
+        while _resident_bytes > frame_cache_max_bytes:
+            _resident_bytes -= _frames.popitem(last=False)[1][1]
+            evicted += 1
+        _stats['evictions'] += evicted
+    if evicted:
+        metrics.incr('frame_cache.evictions', evicted)
+
+def clear():
+    # Description:  Drop all cached tables.
+    global _resident_bytes
+    with _lock:
+        _frames.clear()
+        _resident_bytes = 0
+
+def get_stats():
+    # Description:  Statistics of the frame cache, for display in the app and the API.
+    # Returns:      stats (dict) - entries, resident and maximum bytes, hits, misses, evictions and too large tables
+    with _lock:
+        return dict(_stats, entries=len(_frames), resident_bytes=_resident_bytes, max_bytes=frame_cache_max_bytes)
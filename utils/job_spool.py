@@ -0,0 +1,268 @@
+# job_spool.py>
+# Job spool on a (shared) file system, used to run simss on other hosts with spool_worker.py.
+#
+#   <spool>/tmp/<id>/        job being written (or requeued), invisible to workers
+#   <spool>/pending/<id>/    waiting for a worker: device_parameters.txt and job.json
+#   <spool>/running/<id>/    claimed by a worker: lease.json (owner and claim id), heartbeat, stdout.txt, a cancel
+#                            file when cancelled
+#   <spool>/done/<id>/       finished: result.json and the simss output files
+#
+# Every state change is a rename of the job directory. A rename either succeeds completely or fails because another
+# process won, so a job is claimed, requeued or cancelled by exactly one process. Workers touch the heartbeat file of
+# their jobs regularly; a running job without a heartbeat for lease_timeout seconds is put back in pending. A worker
+# that resumes after losing its job must not touch the job of the new owner: heartbeats and completion check that the
+# lease still holds the claim id of the worker. The age of a heartbeat is measured with the clock of the file server
+# (the modification time of a file just touched), hosts with a skewed clock do not requeue jobs early.
+import json
+import os
+import shutil
+import socket
+import time
+import uuid
+
+# Spool directory, when set the web app hands its simss runs to spool workers instead of running them itself
+spool_dir = os.environ.get('SIMSS_SPOOL_DIR', '')
+# Seconds between heartbeats of a worker, and without heartbeat before a job is requeued
+heartbeat_interval = float(os.environ.get('SIMSS_SPOOL_HEARTBEAT', 5))
+lease_timeout = float(os.environ.get('SIMSS_SPOOL_LEASE', 30))
+# A job that lost its worker this many times is failed instead of requeued
+max_attempts = 3
+states = ['tmp', 'pending', 'running', 'done']
+
+
+def get_state_dir(spool, state):
+    # Returns:      state_dir (string) - directory of all jobs in a state, ending with a separator
+    return os.path.join(spool, state, '')
+
+def get_job_dir(spool, state, job_id):
+    # Returns:      job_dir (string) - directory of a job in a state, ending with a separator
+    return os.path.join(spool, state, job_id, '')
+
+def create_spool(spool):
+    # Description:  Create the state directories of a spool.
+    for state in states:
+        os.makedirs(get_state_dir(spool, state), exist_ok=True)
+
+def write_json(path, content):
+    # Description:  Write a JSON file atomically, readers on other hosts never see a partial file.
+    tmp_name = path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(tmp_name, 'w') as fp:
+        json.dump(content, fp)
+    os.replace(tmp_name, path)
+
+def read_json(path):
+    # Returns:      content (dict) - content of the JSON file, None when missing or unreadable
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def enqueue(spool, job_id, par_file, timeout):
+    # Description:  Add a job to the spool. It is assembled in tmp and renamed into pending when complete.
+    # Arguments:    spool (string) - spool directory
+    #               job_id (string) - unique id of the job
+    #               par_file (string) - content of the device_parameters.txt file to simulate
+    #               timeout (float) - wall clock time limit in s, 0 for no limit
+    create_spool(spool)
+    tmp_dir = get_job_dir(spool, 'tmp', job_id)
+    os.makedirs(tmp_dir)
+    with open(tmp_dir + 'device_parameters.txt', 'w') as fp:
+        fp.write(par_file)
+    write_json(tmp_dir + 'job.json', {'id': job_id, 'timeout': timeout, 'submitted': time.time(), 'attempts': 0})
+    os.rename(tmp_dir, get_job_dir(spool, 'pending', job_id))
+
+def claim(spool, worker_id):
+    # Description:  Claim the oldest pending job by renaming it into running.
+    # Arguments:    spool (string) - spool directory
+    #               worker_id (string) - id of the claiming worker, stored in the lease
+    # Returns:      claimed (tuple) - (directory of the claimed job in running, claim id), None when nothing is pending
+    pending_dir = get_state_dir(spool, 'pending')
+    try:
+        names = os.listdir(pending_dir)
+    except OSError:
+        return None
+    candidates = []
+    for name in names:
+        try:
+            candidates.append((os.path.getmtime(pending_dir + name), name))
+        except OSError:
+            # Claimed by another worker in the meantime
+            continue
+    for mtime, name in sorted(candidates):
+        try:
+            # A fresh heartbeat before the rename, so the job is never seen in running without one
+            touch(pending_dir + name + os.sep + 'heartbeat')
+            os.rename(pending_dir + name, get_job_dir(spool, 'running', name)[:-1])
+        except OSError:
+            continue
+        job_dir = get_job_dir(spool, 'running', name)
+        claim_id = uuid.uuid4().hex
+        if not create_lease(job_dir, {'worker': worker_id, 'claim': claim_id, 'host': socket.gethostname(),
+                                        'pid': os.getpid(), 'claimed': time.time()}):
+            # Stalled after the rename: the job was requeued and claimed by another worker
+            continue
+        return job_dir, claim_id
+    return None
+
+def create_lease(job_dir, lease):
+    # Description:  Write lease.json unless the job already has a lease. The file is written aside and hard linked into
+    #               place, the link fails when the file exists, also on NFS.
+    # Returns:      created (bool)
+    tmp_name = job_dir + '.lease.' + lease['claim'] + '.tmp'
+    try:
+        write_json(tmp_name, lease)
+        os.link(tmp_name, job_dir + 'lease.json')
+    except OSError:
+        return False
+    finally:
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
+    return True
+
+def holds_lease(job_dir, claim_id):
+    # Returns:      holds (bool) - True when the lease of the job still has this claim id
+    lease = read_json(job_dir + 'lease.json')
+    return lease is not None and lease.get('claim') == claim_id
+
+def touch(path):
+    with open(path, 'a'):
+        pass
+    os.utime(path)
+
+def heartbeat(job_dir, claim_id):
+    # Description:  Renew the lease of a running job.
+    # Arguments:    job_dir (string) - directory of the job in running
+    #               claim_id (string) - claim id returned by claim
+    # Returns:      alive (bool) - False when the job is no longer in running or has been claimed by another worker
+    #                              (requeued after a missed heartbeat)
+    if not holds_lease(job_dir, claim_id):
+        return False
+    try:
+        touch(job_dir + 'heartbeat')
+    except OSError:
+        return False
+    return True
+
+def is_cancelled(job_dir):
+    return os.path.isfile(job_dir + 'cancel')
+
+def complete(spool, job_dir, result, claim_id):
+    # Description:  Write the result of a job and move it to done, together with its output files.
+    # Arguments:    spool (string) - spool directory
+    #               job_dir (string) - directory of the job in running
+    #               result (dict) - 'status' ('done', 'failed' or 'cancelled'), 'returncode', ...
+    #               claim_id (string) - claim id returned by claim
+    # Returns:      completed (bool) - False when the job was requeued in the meantime, the result is then dropped
+    job_id = os.path.basename(os.path.normpath(job_dir))
+    if not holds_lease(job_dir, claim_id):
+        # Lease lost, job_dir belongs to another worker (or to nobody) now
+        return False
+    try:
+        write_json(job_dir + 'result.json', result)
+        os.rename(job_dir[:-1], get_job_dir(spool, 'done', job_id)[:-1])
+    except OSError:
+        return False
+    return True
+
+def requeue_stale(spool, now=None):
+    # Description:  Put running jobs whose worker stopped sending heartbeats back in pending. A job that already lost
+    #               max_attempts workers is failed. Can be called by every worker and the web app.
+    # Arguments:    spool (string) - spool directory
+    #               now (float) - current time on the clock of the file server, read from the spool when None
+    # Returns:      requeued (List) - ids of the requeued (or failed) jobs
+    if now is None:
+        try:
+            now = get_spool_time(spool)
+        except OSError:
+            return []
+    running_dir = get_state_dir(spool, 'running')
+    requeued = []
+    try:
+        names = os.listdir(running_dir)
+    except OSError:
+        return requeued
+    for name in names:
+        try:
+            if now - os.path.getmtime(running_dir + name + os.sep + 'heartbeat') <= lease_timeout:
+                continue
+            # Take the job out of running first, only one process can win this rename
+            tmp_dir = get_job_dir(spool, 'tmp', name + '.' + uuid.uuid4().hex)
+            os.rename(running_dir + name, tmp_dir[:-1])
+        except OSError:
+            continue
+        job = read_json(tmp_dir + 'job.json') or {'id': name, 'attempts': 0}
+        job['attempts'] = job.get('attempts', 0) + 1
+        write_json(tmp_dir + 'job.json', job)
+        if job['attempts'] >= max_attempts or is_cancelled(tmp_dir):
+            status = 'cancelled' if is_cancelled(tmp_dir) else 'failed'
+            write_json(tmp_dir + 'result.json', {'status': status, 'returncode': None,
+                                                'message': 'Worker lost ' + str(job['attempts']) + ' time(s)'})
+            target = get_job_dir(spool, 'done', name)
+        else:
+            # Remove the state of the lost worker, keep the job itself
+            for file_name in os.listdir(tmp_dir):
+                if file_name not in ('device_parameters.txt', 'job.json'):
+                    if os.path.isdir(tmp_dir + file_name):
+                        shutil.rmtree(tmp_dir + file_name, ignore_errors=True)
+                    else:
+                        os.remove(tmp_dir + file_name)
+            target = get_job_dir(spool, 'pending', name)
+        os.rename(tmp_dir[:-1], target[:-1])
+        requeued.append(name)
+    return requeued
+
+def get_spool_time(spool):
+    # Description:  Current time on the clock that sets the modification times in the spool (the file server for a
+    #               network file system), so heartbeats of other hosts are compared without clock skew.
+    # Returns:      now (float) - modification time of a file touched just now
+    path = get_state_dir(spool, 'tmp') + '.clock.' + uuid.uuid4().hex
+    touch(path)
+    try:
+        return os.path.getmtime(path)
+    finally:
+        os.remove(path)
+
+def cancel(spool, job_id):
+    # Description:  Cancel a job. A pending job is moved to done directly, a running job gets a cancel file that its
+    #               worker picks up at the next heartbeat.
+    # Arguments:    spool (string) - spool directory
+    #               job_id (string) - id of the job
+    tmp_dir = get_job_dir(spool, 'tmp', job_id + '.' + uuid.uuid4().hex)
+    try:
+        os.rename(get_job_dir(spool, 'pending', job_id)[:-1], tmp_dir[:-1])
+    except OSError:
+        # Not pending (anymore)
+        try:
+            touch(get_job_dir(spool, 'running', job_id) + 'cancel')
+        except OSError:
+            # Already finished
+            pass
+        return
+    write_json(tmp_dir + 'result.json', {'status': 'cancelled', 'returncode': None})
+    os.rename(tmp_dir[:-1], get_job_dir(spool, 'done', job_id)[:-1])
+
+def get_result(spool, job_id):
+    # Description:  Result of a finished job.
+    # Returns:      result (dict) - content of result.json, None while the job has not finished
+    #               done_dir (string) - directory with the result and output files
+    done_dir = get_job_dir(spool, 'done', job_id)
+    result = read_json(done_dir + 'result.json')
+    return result, done_dir
+
+def read_output(spool, job_id):
+    # Description:  Console output of a job so far, as written by its worker at every heartbeat.
+    # Returns:      stdout (string) - console output, empty while pending
+    for state in ('running', 'done'):
+        try:
+            with open(get_job_dir(spool, state, job_id) + 'stdout.txt') as fp:
+                return fp.read()
+        except OSError:
+            continue
+    return ''
+
+def remove(spool, job_id):
+    # Description:  Remove a finished job from the spool, after its output has been collected.
+    shutil.rmtree(get_job_dir(spool, 'done', job_id), ignore_errors=True)
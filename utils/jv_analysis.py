@@ -0,0 +1,117 @@
+# jv_analysis.py>
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils import frame_cache as fc
+from utils import metrics
+
+# Threads reading JV.dat files, reading is I/O bound so more threads than cores are fine
+load_workers = int(os.environ.get('SIMSALABIM_LOAD_WORKERS', 8))
+# Figures of merit returned by figures_of_merit, with their units (SimSS writes J in A/m2)
+fom_columns = {'Voc': 'V', 'Jsc': 'A/m2', 'FF': '-', 'Vmpp': 'V', 'Jmpp': 'A/m2', 'Pmpp': 'W/m2'}
+
+
+def read_jv(path):
+    # Description:  Voltage and current density of a JV.dat file, through the shared frame cache.
+    # Arguments:    path (string) - path to the JV.dat file
+    # Returns:      vext (ndarray) - applied voltages
+    #               jext (ndarray) - current densities, both empty when the file does not exist (anymore)
+    try:
+        data_jv = fc.get_frame(path)
+    except OSError:
+        # E.g. a result cache entry evicted after it was listed
+        return np.empty(0), np.empty(0)
+    return data_jv['Vext'].to_numpy(dtype=float), data_jv['Jext'].to_numpy(dtype=float)
+
+@metrics.timed('jv_analysis.load')
+def load_jv_curves(paths):
+    # Description:  Load many JV curves in parallel and pad them to a single array. Curves are sorted by voltage,
+    #               missing points at the end of shorter curves are NaN. Missing files give a curve of length 0.
+    # Arguments:    paths (List) - paths to JV.dat files
+    # Returns:      vext (ndarray) - voltages, shape (n_curves, n_points)
+    #               jext (ndarray) - current densities, shape (n_curves, n_points)
+    #               lengths (ndarray) - number of valid points of every curve
+    if not paths:
+        return np.empty((0, 0)), np.empty((0, 0)), np.zeros(0, dtype=int)
+    with ThreadPoolExecutor(max_workers=min(load_workers, len(paths))) as executor:
+        curves = list(executor.map(read_jv, paths))
+    lengths = np.array([len(v) for v, j in curves])
+    vext = np.full((len(curves), max(lengths.max(), 1)), np.nan)
+    jext = np.full((len(curves), max(lengths.max(), 1)), np.nan)
+    for row, (v, j) in enumerate(curves):
+        order = np.argsort(v, kind='stable')
+        vext[row, :len(v)] = v[order]
+        jext[row, :len(v)] = j[order]
+    return vext, jext, lengths
+
+def interpolate_crossing(x, y, index, valid):
+    # Description:  Value of x where y crosses zero between column index and index+1, for every row.
+    # Arguments:    x, y (ndarray) - shape (n_curves, n_points)
+    #               index (ndarray) - column before the crossing of every row
+    #               valid (ndarray) - rows that have a crossing
+    # Returns:      x0 (ndarray) - interpolated x values, NaN for rows without crossing
+    rows = np.arange(x.shape[0])
+    index = np.clip(index, 0, x.shape[1] - 2)
+    x1, x2 = x[rows, index], x[rows, index + 1]
+    y1, y2 = y[rows, index], y[rows, index + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x0 = np.where(y2 != y1, x1 - y1*(x2 - x1)/(y2 - y1), x1)
+    return np.where(valid, x0, np.nan)
+
+@metrics.timed('jv_analysis.figures_of_merit')
+def figures_of_merit(vext, jext):
+    # Description:  Solar cell figures of merit of all curves at once, with SimSS sign convention (photocurrent negative):
+    #               Jsc is J at V = 0, Voc the first V where J turns from negative to positive, the maximum power point
+    #               is where the generated power -V*J is largest and FF = Pmpp/(Voc*-Jsc).
+    #               Values that are not defined for a curve (no illumination, voltage range not covering 0 or Voc) are NaN.
+    # Arguments:    vext (ndarray) - voltages sorted per row, shape (n_curves, n_points), NaN padded
+    #               jext (ndarray) - current densities, same shape
+    # Returns:      fom (dict) - name in fom_columns -> ndarray of n_curves values
+    n_curves = vext.shape[0]
+    if n_curves == 0 or vext.shape[1] < 2:
+        return {name: np.full(n_curves, np.nan) for name in fom_columns}
+    rows = np.arange(n_curves)
+
+    # Jsc: J interpolated between the last point below and the first point at or above V = 0
+    with np.errstate(invalid='ignore'):
+        zero_index = np.sum(vext < 0, axis=1) - 1
+        has_zero = (zero_index >= 0) & (vext >= 0).any(axis=1)
+    jsc = interpolate_crossing(jext, vext, zero_index, has_zero)
+    # A curve that starts at exactly 0 V has no point below it
+    jsc = np.where(vext[:, 0] == 0, jext[:, 0], jsc)
+
+    # Voc: first sign change of J from negative to non-negative
+    with np.errstate(invalid='ignore'):
+        crossing = (jext[:, :-1] < 0) & (jext[:, 1:] >= 0)
+    has_voc = crossing.any(axis=1)
+    voc = interpolate_crossing(vext, jext, np.argmax(crossing, axis=1), has_voc)
+
+    # Maximum power point: largest generated power in the fourth quadrant. Without Voc the range ends before the power
+    # drops again, the largest power found would just be the end of the range.
+    with np.errstate(invalid='ignore'):
+        power = np.where((vext >= 0) & (jext < 0), -vext*jext, np.nan)
+    has_power = np.isfinite(power).any(axis=1) & has_voc
+    mpp_index = np.argmax(np.where(np.isfinite(power), power, -np.inf), axis=1)
+    vmpp = np.where(has_power, vext[rows, mpp_index], np.nan)
+    jmpp = np.where(has_power, jext[rows, mpp_index], np.nan)
+    pmpp = np.where(has_power, power[rows, mpp_index], np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ff = np.where((voc > 0) & (jsc < 0), pmpp/(voc*-jsc), np.nan)
+    return {'Voc': voc, 'Jsc': jsc, 'FF': ff, 'Vmpp': vmpp, 'Jmpp': jmpp, 'Pmpp': pmpp}
+
+def analyse_runs(runs):
+    # Description:  Load the JV curves of many runs and compute their figures of merit. Runs without JV.dat (e.g.
+    #               evicted from the result cache) are left out.
+    # Arguments:    runs (List) - dicts with at least 'label' and 'dir' (directory containing JV.dat)
+    # Returns:      table (DataFrame) - one row per loaded run: label followed by the figures of merit
+    #               vext, jext (ndarray) - padded curves, in the same order as the table
+    import pandas as pd
+    vext, jext, lengths = load_jv_curves([run['dir'] + 'JV.dat' for run in runs])
+    loaded = lengths > 0
+    vext, jext = vext[loaded], jext[loaded]
+    fom = figures_of_merit(vext, jext)
+    table = pd.DataFrame({'label': [run['label'] for run, found in zip(runs, loaded) if found]})
+    for name in fom_columns:
+        table[name + ' (' + fom_columns[name] + ')'] = fom[name]
+    return table, vext, jext
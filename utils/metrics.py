@@ -0,0 +1,197 @@
+# metrics.py>
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Timings are logged as l2met lines (measure#simsalabim.<name>=<ms>ms), next to the measure#nginx.service line of nginx.
+log_source = 'simsalabim'
+# Aggregated metrics are written in the Prometheus text format to this file, at most every metrics_interval seconds.
+metrics_file = os.environ.get('SIMSALABIM_METRICS_FILE', os.path.join(tempfile.gettempdir(), 'simsalabim_metrics.prom'))
+metrics_interval = float(os.environ.get('SIMSALABIM_METRICS_INTERVAL', 10))
+# Every process (Streamlit, api_server.py, spool_worker.py) keeps a snapshot of its own metrics in this directory. The
+# metrics file combines the snapshots of all processes, labelled with the process they come from.
+snapshot_dir = metrics_file + '.d'
+process_name = (os.environ.get('SIMSALABIM_PROCESS_NAME') or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+                or 'python') + ':' + str(os.getpid())
+# Upper bounds (s) of the histogram buckets
+buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, float('inf')]
+
+logger = logging.getLogger(log_source)
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_last_write = 0.0
+
+
+@contextmanager
+def span(name):
+    # Description:  Time a block of code. The duration is logged and added to the histogram of name, also when the
+    #               block raises an exception (e.g. st.stop()).
+    # Arguments:    name (string) - stage name, dot separated (e.g. 'simss.run')
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def timed(name):
+    # Description:  Decorator version of span.
+    # Arguments:    name (string) - stage name
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def observe(name, seconds):
+    # Description:  Record a duration measured elsewhere.
+    # Arguments:    name (string) - stage name
+    #               seconds (float) - duration
+    logger.info('measure#' + log_source + '.' + name + '=' + '{:.3f}'.format(seconds*1000) + 'ms')
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = {'counts': [0]*len(buckets), 'sum': 0.0, 'count': 0}
+        for bucket_index, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram['counts'][bucket_index] += 1
+                break
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+    write_metrics_file()
+
+def incr(name, value=1):
+    # Description:  Increase a counter, e.g. 'simss.runs' or 'simss.failures'.
+    # Arguments:    name (string) - counter name
+    #               value (number) - amount to add
+    logger.info('count#' + log_source + '.' + name + '=' + str(value))
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+    write_metrics_file()
+
+def get_metrics_name(name):
+    # Description:  Convert a dot separated name to a valid Prometheus metric name.
+    return log_source + '_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+def get_snapshot():
+    # Description:  Copy of the metrics of this process.
+    # Returns:      snapshot (dict) - 'process', 'counters' and 'histograms'
+    with _lock:
+        return {'process': process_name, 'counters': dict(_counters),
+                'histograms': {name: {'counts': list(h['counts']), 'sum': h['sum'], 'count': h['count']}
+                                for name, h in _histograms.items()}}
+
+def read_snapshots():
+    # Description:  Metrics of all processes: this process and the snapshots written by the others. Snapshots of
+    #               processes that have ended are removed.
+    # Returns:      snapshots (List) - snapshot dicts, this process first
+    snapshots = [get_snapshot()]
+    try:
+        names = os.listdir(snapshot_dir)
+    except OSError:
+        return snapshots
+    for name in names:
+        if not name.endswith('.json') or name == get_snapshot_name():
+            continue
+        path = os.path.join(snapshot_dir, name)
+        try:
+            pid = int(name[:-len('.json')].rsplit('_', 1)[1])
+            os.kill(pid, 0)
+        except (IndexError, ValueError):
+            continue
+        except ProcessLookupError:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        except PermissionError:
+            # Process of another user, still alive
+            pass
+        try:
+            with open(path) as fp:
+                snapshots.append(json.load(fp))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def get_snapshot_name():
+    return ''.join(c if c.isalnum() else '_' for c in process_name.rsplit(':', 1)[0]) + '_' + str(os.getpid()) + '.json'
+
+def render_metrics(snapshots=None):
+    # Description:  Aggregated metrics of all processes in the Prometheus text exposition format, every sample labelled
+    #               with its process.
+    # Arguments:    snapshots (List) - snapshots to render, read_snapshots() when None
+    # Returns:      text (string) - metrics, ready to be scraped
+    if snapshots is None:
+        snapshots = read_snapshots()
+    lines = []
+    for name in sorted(set(name for snapshot in snapshots for name in snapshot['counters'])):
+        metric = get_metrics_name(name) + '_total'
+        lines.append('# TYPE ' + metric + ' counter\n')
+        for snapshot in snapshots:
+            if name in snapshot['counters']:
+                label = 'process="' + snapshot['process'] + '"'
+                lines.append(metric + '{' + label + '} ' + str(snapshot['counters'][name]) + '\n')
+    for name in sorted(set(name for snapshot in snapshots for name in snapshot['histograms'])):
+        metric = get_metrics_name(name) + '_seconds'
+        lines.append('# TYPE ' + metric + ' histogram\n')
+        for snapshot in snapshots:
+            histogram = snapshot['histograms'].get(name)
+            if histogram is None:
+                continue
+            label = 'process="' + snapshot['process'] + '"'
+            cumulative = 0
+            for bound, count in zip(buckets, histogram['counts']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(metric + '_bucket{' + label + ',le="' + le + '"} ' + str(cumulative) + '\n')
+            lines.append(metric + '_sum{' + label + '} ' + repr(histogram['sum']) + '\n')
+            lines.append(metric + '_count{' + label + '} ' + str(histogram['count']) + '\n')
+    return ''.join(lines)
+
+def write_metrics_file(force=False):
+    # Description:  Write the snapshot of this process and the combined metrics file, at most once every
+    #               metrics_interval seconds unless forced. Both are replaced atomically, so a scraper never reads a
+    #               partial file. Every process rewrites the combined file with the latest snapshots of all processes.
+    # Arguments:    force (bool) - write regardless of the time of the last write
+    global _last_write
+    now = time.time()
+    with _lock:
+        if not force and now - _last_write < metrics_interval:
+            return
+        _last_write = now
+    tmp_suffix = '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        snapshot_file = os.path.join(snapshot_dir, get_snapshot_name())
+        with open(snapshot_file + tmp_suffix, 'w') as fp:
+            json.dump(get_snapshot(), fp)
+        os.replace(snapshot_file + tmp_suffix, snapshot_file)
+        with open(metrics_file + tmp_suffix, 'w') as fp:
+            fp.write(render_metrics())
+        os.replace(metrics_file + tmp_suffix, metrics_file)
+    except OSError:
+        logger.warning('Could not write metrics file ' + metrics_file)
+
+def get_summary():
+    # Description:  Counters and mean durations, for display in the app.
+    # Returns:      summary (dict) - 'counters': name -> value, 'timings': name -> (count, mean s)
+    with _lock:
+        return {'counters': dict(_counters),
+                'timings': {name: (h['count'], h['sum']/h['count']) for name, h in _histograms.items() if h['count']}}
@@ -0,0 +1,149 @@
+# preview.py>
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils import dev_par_model as dpm
+from utils import metrics
+from utils import result_cache as rc
+from utils import voltage_range as vr
+
+# Number of cached simulations the estimate is interpolated from
+n_neighbours = 4
+# Neighbours further away than this (in normalized parameter space, 1 = a factor 10 in one parameter) are not used
+max_distance = 1.0
+# Number of most recently used cache entries searched, also the number of entries whose parameters are remembered
+max_candidates = 2000
+# Threads computing estimates in the background
+preview_workers = 2
+
+# Parameters of the cache entries, entries never change so they are parsed once per process
+_entry_values = {}
+_executor = None
+_lock = threading.Lock()
+
+
+def get_entry_values(entry):
+    # Description:  Parameter values of a cache entry, from the device_parameters.txt stored with it.
+    # Arguments:    entry (dict) - cache entry from result_cache.list_entries
+    # Returns:      values (dict) - name -> value, None when the entry has no parameter file
+    with _lock:
+        if entry['key'] in _entry_values:
+            return _entry_values[entry['key']]
+    try:
+        values = dpm.read_dev_par_file(entry['dir'] + 'device_parameters.txt').values()
+    except OSError:
+        values = None
+    with _lock:
+        _entry_values[entry['key']] = values
+        if len(_entry_values) > max_candidates:
+            # Forget the entry remembered first, it is most likely not among the searched entries anymore
+            del _entry_values[next(iter(_entry_values))]
+    return values
+
+def covers_voltage_range(values, target):
+    # Description:  Check if a candidate simulated (at least) the voltage range of the target. Parts of a voltage range
+    #               extension and other narrow runs are in the result cache as well.
+    # Arguments:    values, target (dict) - name -> value of the candidate and the target parameters
+    # Returns:      covers (bool) - True as well when the target has no numerical voltage range
+    vmin, vmax = dpm.to_number(target.get('Vmin')), dpm.to_number(target.get('Vmax'))
+    if vmin is None or vmax is None:
+        return True
+    candidate_vmin, candidate_vmax = dpm.to_number(values.get('Vmin')), dpm.to_number(values.get('Vmax'))
+    if candidate_vmin is None or candidate_vmax is None:
+        return False
+    tolerance = 1e-6*max(abs(vmax - vmin), 1e-3)
+    return candidate_vmin <= vmin + tolerance and candidate_vmax >= vmax - tolerance
+
+def get_distances(target, candidates):
+    # Description:  Distance between the target parameters and each candidate in normalized parameter space: positive
+    #               values are compared on a log scale (a factor 10 is distance 1), other values relative to their
+    #               magnitude. Candidates with other parameter names or other non-numerical values (e.g. file names),
+    #               and candidates not covering the voltage range of the target, are at infinite distance. The voltage
+    #               range itself does not change J at a voltage and is not part of the distance.
+    # Arguments:    target (dict) - name -> value of the parameters to preview
+    #               candidates (List) - name -> value dicts of the cached simulations
+    # Returns:      distances (ndarray) - distance to every candidate
+    names = sorted(name for name in target if name not in vr.range_params)
+    numeric = [name for name in names if dpm.to_number(target[name]) is not None]
+    fixed = [name for name in names if dpm.to_number(target[name]) is None]
+    target_row = np.array([float(target[name]) for name in numeric])
+    rows = np.full((len(candidates), len(numeric)), np.nan)
+    usable = np.zeros(len(candidates), dtype=bool)
+    for index, values in enumerate(candidates):
+        if values is None or len(values) != len(target) or any(values.get(name) != target[name] for name in fixed):
+            continue
+        if not covers_voltage_range(values, target):
+            continue
+        row = [dpm.to_number(values.get(name, '')) for name in numeric]
+        if None in row:
+            continue
+        rows[index] = row
+        usable[index] = True
+    with np.errstate(divide='ignore', invalid='ignore'):
+        positive = (rows > 0) & (target_row > 0)
+        log_difference = np.abs(np.log10(np.where(positive, rows, 1)) - np.log10(np.where(positive, target_row, 1)))
+        scale = np.maximum(np.maximum(np.abs(rows), np.abs(target_row)), 1e-300)
+        relative_difference = np.abs(rows - target_row)/scale
+        difference = np.where(positive, log_difference, relative_difference)
+    distances = np.sqrt(np.sum(difference**2, axis=1))
+    return np.where(usable, distances, np.inf)
+
+@metrics.timed('preview.estimate')
+def estimate_jv(dev_par_model):
+    # Description:  Estimate the JV curve of a parameter set by inverse distance weighted interpolation of the JV curves
+    #               of the nearest cached simulations. This is an approximation for a quick preview only.
+    # Arguments:    dev_par_model (DevParModel) - parameters to preview
+    # Returns:      preview (dict) - 'Vext', 'Jext' (ndarray), 'neighbours' (List of (key, distance)) and 'exact' (bool),
+    #                                None when no cached simulation is close enough
+    from utils import jv_analysis as ja
+    entries = rc.list_entries(max_candidates)
+    if not entries:
+        return None
+    distances = get_distances(dev_par_model.values(), [get_entry_values(entry) for entry in entries])
+    nearest = [index for index in np.argsort(distances)[:n_neighbours] if distances[index] <= max_distance]
+    if not nearest:
+        metrics.incr('preview.misses')
+        return None
+    metrics.incr('preview.estimates')
+    vext, jext, lengths = ja.load_jv_curves([entries[index]['dir'] + 'JV.dat' for index in nearest])
+    # Entries evicted since they were listed have no curve
+    loaded = lengths > 0
+    if not loaded.any():
+        return None
+    nearest = [index for index, found in zip(nearest, loaded) if found]
+    vext, jext, lengths = vext[loaded], jext[loaded], lengths[loaded]
+    # Common voltage grid: the voltages of the nearest simulation, within the range covered by all neighbours and
+    # the range of the target
+    low = np.nanmax(np.nanmin(vext, axis=1))
+    high = np.nanmin(np.nanmax(vext, axis=1))
+    if 'Vmin' in dev_par_model and 'Vmax' in dev_par_model:
+        target_vmin, target_vmax = dev_par_model.get_number('Vmin'), dev_par_model.get_number('Vmax')
+    else:
+        target_vmin = target_vmax = None
+    if target_vmin is not None and target_vmax is not None:
+        tolerance = 1e-6*max(abs(target_vmax - target_vmin), 1e-3)
+        low, high = max(low, target_vmin - tolerance), min(high, target_vmax + tolerance)
+    grid = vext[0, :lengths[0]]
+    grid = grid[(grid >= low) & (grid <= high)]
+    if len(grid) < 2:
+        return None
+    curves = np.array([np.interp(grid, vext[row, :lengths[row]], jext[row, :lengths[row]])
+                        for row in range(len(nearest))])
+    nearest_distances = distances[nearest]
+    exact = bool(nearest_distances[0] == 0)
+    if exact:
+        weights = (nearest_distances == 0).astype(float)
+    else:
+        weights = 1/nearest_distances**2
+    return {'Vext': grid, 'Jext': weights @ curves/weights.sum(), 'exact': exact,
+            'neighbours': [(entries[index]['key'], float(distances[index])) for index in nearest]}
+
+def submit_estimate(dev_par_model):
+    # Description:  Compute estimate_jv in a background thread, so submitting a simulation does not wait for it.
+    # Arguments:    dev_par_model (DevParModel) - parameters to preview, not changed afterwards
+    # Returns:      future (Future) - resolves to the result of estimate_jv
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=preview_workers, thread_name_prefix='preview')
+    return _executor.submit(estimate_jv, dev_par_model)
@@ -0,0 +1,211 @@
+# result_cache.py>
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from utils import dev_par_model as dpm
+from utils import metrics
+
+# Directory holding one sub directory per cached simulation, named after the hash of its device parameters.
+cache_dir = os.environ.get('SIMSS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'simsalabim_cache'))
+# Maximum total size of the cache in bytes. The least recently used entries are removed when it is exceeded.
+cache_max_bytes = int(os.environ.get('SIMSS_CACHE_MAX_BYTES', 2*1024**3))
+# Files stored for every cached simulation
+cached_files = ['JV.dat', 'Var.dat', 'log.txt', 'scPars.dat', 'stdout.txt', 'device_parameters.txt']
+
+# Number of input file hashes remembered per process
+max_file_digests = 1000
+
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_file_digests = {}
+_lock = threading.Lock()
+
+
+def canonicalize_parameters(par_file):
+    # Description:  Reduce the content of a device parameters file to the information that determines the simulation
+    #               result: the parameter names and values. Comments, descriptions, alignment and notation of numbers
+    #               (3E-7 vs 300e-9) do not change the result and are removed.
+    # Arguments:    par_file (string) - content of a device_parameters.txt file
+    # Returns:      canonical (string) - one 'name=value' line per parameter, sorted by name
+    pairs = sorted((name, normalize_value(value)) for name, value in dpm.parse_dev_par(par_file).values().items())
+    return ''.join(name + '=' + value + '\n' for name, value in pairs)
+
+def normalize_value(value):
+    # Description:  Write numbers in a single notation, leave other values (file names) as they are.
+    # Arguments:    value (string) - parameter value as written in the file
+    # Returns:      value (string) - normalized value
+    try:
+        return repr(float(value))
+    except ValueError:
+        return value.strip()
+
+def get_file_digest(path):
+    # Description:  Hash of the content of an input file, computed again only when the file changes.
+    # Arguments:    path (string) - path to the file
+    # Returns:      digest (string) - hex digest of the content, None when the file does not exist
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    identity = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        if identity in _file_digests:
+            return _file_digests[identity]
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024**2), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    with _lock:
+        if len(_file_digests) >= max_file_digests:
+            _file_digests.clear()
+        _file_digests[identity] = digest.hexdigest()
+    return digest.hexdigest()
+
+def get_cache_key(par_file, simss_path):
+    # Description:  Hash of the canonical parameters, the content of the input files they refer to (generation
+    #               profile, nk and trap files) and the simss executable that will run them.
+    #               Changing an input file or rebuilding simss therefore invalidates the cached results.
+    # Arguments:    par_file (string) - content of a device_parameters.txt file
+    #               simss_path (string) - directory containing the simss executable
+    # Returns:      key (string) - hex digest identifying the simulation
+    digest = hashlib.sha256(canonicalize_parameters(par_file).encode('utf-8'))
+    # simss runs in a copy of simss_path, file names are relative to it
+    for name, value in sorted(dpm.parse_dev_par(par_file).values().items()):
+        value = value.strip()
+        if value and dpm.to_number(value) is None:
+            file_digest = get_file_digest(os.path.join(simss_path, value))
+            if file_digest is not None:
+                digest.update(('file:' + name + ':' + file_digest).encode('utf-8'))
+    try:
+        stat = os.stat(simss_path + 'simss')
+        digest.update(('simss:' + str(stat.st_size) + ':' + str(stat.st_mtime_ns)).encode('utf-8'))
+    except OSError:
+        pass
+    return digest.hexdigest()
+
+def lookup(key):
+    # Description:  Find a cached simulation and mark it as recently used.
+    # Arguments:    key (string) - cache key from get_cache_key
+    # Returns:      entry_dir (string) - directory with the cached files (ending with a separator) or None on a miss
+    entry_dir = os.path.join(cache_dir, key, '')
+    if os.path.isfile(entry_dir + 'JV.dat'):
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            # Evicted in the meantime
+            entry_dir = None
+    else:
+        entry_dir = None
+    with _lock:
+        _stats['hits' if entry_dir else 'misses'] += 1
+    metrics.incr('result_cache.hits' if entry_dir else 'result_cache.misses')
+    return entry_dir
+
+def has_entry(key):
+    # Description:  Check if a simulation is cached, without counting it as a hit or miss.
+    # Arguments:    key (string) - cache key from get_cache_key
+    # Returns:      cached (bool)
+    return os.path.isfile(os.path.join(cache_dir, key, 'JV.dat'))
+
+def read_stdout(entry_dir):
+    # Description:  Console output of the simss run that produced a cache entry.
+    # Arguments:    entry_dir (string) - directory of the cache entry
+    # Returns:      stdout (string) - stored console output
+    try:
+        with open(entry_dir + 'stdout.txt') as fp:
+            return fp.read()
+    except OSError:
+        return ''
+
+def store(key, run_dir, stdout):
+    # Description:  Add the output of a successful simss run to the cache. The entry is assembled in a temporary
+    #               directory and renamed into place, so a concurrent lookup never sees a partial entry.
+    # Arguments:    key (string) - cache key from get_cache_key
+    #               run_dir (string) - directory simss ran in, ending with a separator
+    #               stdout (string) - console output of the run
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix='.' + key + '_', dir=cache_dir)
+    except OSError:
+        # Caching is an optimisation only, a full or read-only disk must not fail the simulation
+        return
+    try:
+        for file_name in cached_files:
+            if os.path.isfile(run_dir + file_name):
+                shutil.copyfile(run_dir + file_name, os.path.join(tmp_dir, file_name))
+        with open(os.path.join(tmp_dir, 'stdout.txt'), 'w') as fp:
+            fp.write(stdout)
+        os.rename(tmp_dir, os.path.join(cache_dir, key))
+    except OSError:
+        # Another job stored the same simulation first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+    with _lock:
+        _stats['stores'] += 1
+    metrics.incr('result_cache.stores')
+    evict()
+
+def evict():
+    # Description:  Remove least recently used entries until the cache fits in cache_max_bytes.
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            continue
+        total = total + size
+    if total <= cache_max_bytes:
+        return
+    entries.sort()
+    for mtime, size, path in entries:
+        # Rename first: an entry is complete or gone, never seen half removed
+        evicted_path = os.path.join(cache_dir, '.evicted_' + os.path.basename(path) + '_' + os.urandom(4).hex())
+        try:
+            os.rename(path, evicted_path)
+        except OSError:
+            # Evicted by another process in the meantime
+            continue
+        shutil.rmtree(evicted_path, ignore_errors=True)
+        total = total - size
+        with _lock:
+            _stats['evictions'] += 1
+        metrics.incr('result_cache.evictions')
+        if total <= cache_max_bytes:
+            break
+
+def list_entries(limit=None):
+    # Description:  Cached simulations, most recently used first, e.g. to compare results of earlier runs.
+    # Arguments:    limit (number) - maximum number of entries to return, None for all
+    # Returns:      entries (List) - dicts with 'key', 'dir' (ending with a separator) and 'time' (last use, epoch s)
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return entries
+    for name in names:
+        entry_dir = os.path.join(cache_dir, name, '')
+        if name.startswith('.'):
+            continue
+        try:
+            if os.path.isfile(entry_dir + 'JV.dat'):
+                entries.append({'key': name, 'dir': entry_dir, 'time': os.path.getmtime(entry_dir)})
+        except OSError:
+            # Evicted in the meantime
+            continue
+    entries.sort(key=lambda entry: entry['time'], reverse=True)
+    return entries if limit is None else entries[:limit]
+
+def get_stats():
+    # Description:  Hit/miss counters of this process.
+    # Returns:      stats (dict) - copy of the counters
+    with _lock:
+        return dict(_stats)
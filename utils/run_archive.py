@@ -0,0 +1,372 @@
+# run_archive.py>
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from utils import dev_par_model as dpm
+from utils import metrics
+
+# Directory holding one compressed archive per simulated parameter set, named after its result cache key
+archive_dir = os.environ.get('SIMSS_ARCHIVE_DIR', os.path.join(tempfile.gettempdir(), 'simsalabim_archive'))
+# Maximum total size of the archives in bytes. The least recently used archives are removed when it is exceeded.
+archive_max_bytes = int(os.environ.get('SIMSS_ARCHIVE_MAX_BYTES', 2*1024**3))
+# Output tables stored column by column, name in the archive -> output file
+archived_tables = {'JV': 'JV.dat', 'Var': 'Var.dat', 'scPars': 'scPars.dat'}
+# Text files stored as they are
+archived_texts = ['device_parameters.txt', 'log.txt', 'stdout.txt']
+# Bytes handed out at a time by the bulk export
+export_chunk_size = 1024**2
+# Bump when the layout of the archive changes
+archive_version = 1
+# Scheduling priority (nice value) of the thread writing the archives, so archiving never competes with simss
+archive_niceness = 10
+
+# Metadata of the archives, an archive never changes after it has been written so it is read once per process
+_metas = {}
+_pending = set()
+_executor = None
+_lock = threading.Lock()
+
+
+class _ChunkBuffer:
+    # Description:  Write-only file for zipfile that keeps what has been written until it is taken by the export.
+    #               Without seek, zipfile writes the sizes after every member, so nothing has to be rewritten.
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def get_archive_path(key):
+    # Arguments:    key (string) - result cache key of the simulation
+    # Returns:      path (string) - path of the archive
+    return os.path.join(archive_dir, key + '.npz')
+
+def shuffle_bytes(values):
+    # Description:  Store the bytes of numbers grouped by significance (all first bytes, then all second bytes, ...).
+    #               Exponents and leading mantissa bytes of neighbouring values are similar, grouped they compress
+    #               several times better.
+    # Arguments:    values (ndarray) - numerical column
+    # Returns:      shuffled (ndarray) - uint8 array of shape (itemsize, len(values))
+    import numpy as np
+    values = np.ascontiguousarray(values)
+    return values.view(np.uint8).reshape(len(values), values.dtype.itemsize).T.copy()
+
+def unshuffle_bytes(shuffled, dtype):
+    # Description:  Inverse of shuffle_bytes.
+    import numpy as np
+    return np.ascontiguousarray(shuffled.T).view(dtype).ravel()
+
+def to_bytes_array(text):
+    import numpy as np
+    return np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+
+def encode_table(name, path, arrays):
+    # Description:  Add the columns of an output file to the arrays of an archive. Float columns are stored as float32
+    #               when that is as precise as the text file, and byte shuffled.
+    # Arguments:    name (string) - name of the table in the archive
+    #               path (string) - output file
+    #               arrays (dict) - arrays of the archive, extended in place
+    # Returns:      table (dict) - description of the table for the metadata: columns, dtypes and rows
+    import numpy as np
+    import pandas as pd
+    from utils import frame_cache as fc
+    data = pd.read_csv(path, sep=r'\s+')
+    dtypes = []
+    for index, column in enumerate(data.columns):
+        values = data[column].to_numpy()
+        if values.dtype == np.float64 and fc.is_float32_safe(values):
+            values = values.astype(np.float32)
+        dtypes.append(values.dtype.str)
+        arrays[name + '/' + str(index)] = shuffle_bytes(values)
+    return {'file': os.path.basename(path), 'columns': list(data.columns), 'dtypes': dtypes, 'rows': len(data)}
+
+def write_archive(key, run_dir, texts=None, run_info=None):
+    # Description:  Archive the output of a simss run: its tables as compressed columns and its parameters, log and
+    #               console output as text, with the metadata. Written to a temporary file and renamed into place.
+    # Arguments:    key (string) - result cache key of the run
+    #               run_dir (string) - directory with the output files, ending with a separator
+    #               texts (dict) - file name -> content of text files not (or not up to date) in run_dir
+    #               run_info (dict) - extra metadata, e.g. start and finish time of the run
+    # Returns:      path (string) - path of the archive
+    import numpy as np
+    arrays = {}
+    meta = dict(run_info or {}, version=archive_version, key=key, archived=time.time(), tables={}, texts=[],
+                source_bytes=0)
+    for name, file_name in archived_tables.items():
+        if os.path.isfile(run_dir + file_name):
+            meta['tables'][name] = encode_table(name, run_dir + file_name, arrays)
+            meta['source_bytes'] += os.path.getsize(run_dir + file_name)
+    texts = dict(texts or {})
+    for file_name in archived_texts:
+        if file_name not in texts and os.path.isfile(run_dir + file_name):
+            with open(run_dir + file_name, encoding='utf-8', errors='replace') as fp:
+                texts[file_name] = fp.read()
+        if file_name in texts:
+            arrays['text/' + file_name] = to_bytes_array(texts[file_name])
+            meta['texts'].append(file_name)
+            meta['source_bytes'] += len(arrays['text/' + file_name])
+    if 'device_parameters.txt' in texts:
+        meta['parameters'] = dpm.parse_dev_par(texts['device_parameters.txt']).values()
+    arrays['meta'] = to_bytes_array(json.dumps(meta))
+
+    os.makedirs(archive_dir, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix='.' + key + '_', suffix='.tmp', dir=archive_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            np.savez_compressed(fp, **arrays)
+        os.replace(tmp_name, get_archive_path(key))
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    archive_bytes = os.path.getsize(get_archive_path(key))
+    with _lock:
+        _metas[key] = meta
+    metrics.incr('archive.writes')
+    metrics.incr('archive.source_bytes', meta['source_bytes'])
+    metrics.incr('archive.bytes', archive_bytes)
+    evict()
+    return get_archive_path(key)
+
+def lower_thread_priority():
+    # Description:  Initializer of the archive thread. On Linux every thread has its own nice value.
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), archive_niceness)
+    except (AttributeError, OSError):
+        pass
+
+def get_executor():
+    # Description:  Create the single archive thread of the process on first use.
+    # Returns:      executor (ThreadPoolExecutor) - executor writing the archives one at a time
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive',
+                                            initializer=lower_thread_priority)
+    return _executor
+
+def stage_files(key, run_dir):
+    # Description:  Hard link (or copy) the files to archive into a private directory, so they can be archived after
+    #               run_dir has been removed or reused. Names starting with '.' are not taken for archives.
+    # Arguments:    key (string) - result cache key of the run
+    #               run_dir (string) - directory with the output files, ending with a separator
+    # Returns:      staging_dir (string) - the private directory, ending with a separator
+    os.makedirs(archive_dir, exist_ok=True)
+    staging_dir = os.path.join(tempfile.mkdtemp(prefix='.' + key + '_', dir=archive_dir), '')
+    for file_name in list(archived_tables.values()) + archived_texts:
+        if os.path.isfile(run_dir + file_name):
+            try:
+                os.link(run_dir + file_name, staging_dir + file_name)
+            except OSError:
+                shutil.copyfile(run_dir + file_name, staging_dir + file_name)
+    return staging_dir
+
+def archive_run(job, run_dir):
+    # Description:  Archive a successful job in the background, unless its parameters have been archived before (the
+    #               result is the same then) or the job is part of a larger run. Only the files are staged here, the
+    #               archive is written by a low priority thread so neither the caller nor its worker slot waits for it.
+    #               Archiving is a service on top of the simulation, errors are logged and do not fail the job.
+    # Arguments:    job (SimssJob) - the finished job
+    #               run_dir (string) - directory holding the output files of the job, ending with a separator
+    if not job.archive:
+        return
+    path = get_archive_path(job.cache_key)
+    try:
+        with _lock:
+            if job.cache_key in _pending:
+                return
+            if os.path.isfile(path):
+                # Mark as recently used
+                os.utime(path)
+                return
+            _pending.add(job.cache_key)
+        staging_dir = stage_files(job.cache_key, run_dir)
+    except Exception as err:
+        with _lock:
+            _pending.discard(job.cache_key)
+        metrics.incr('archive.errors')
+        metrics.logger.warning('Could not archive run ' + job.id + ': ' + str(err))
+        return
+    get_executor().submit(write_staged_archive, job.cache_key, staging_dir,
+                            {'device_parameters.txt': job.par_file, 'stdout.txt': job.stdout},
+                            {'job': job.id, 'started': job.started, 'finished': job.finished or time.time()})
+
+@metrics.timed('archive.run')
+def write_staged_archive(key, staging_dir, texts, run_info):
+    # Description:  Write the archive of staged files and remove them. Runs in the archive thread.
+    try:
+        write_archive(key, staging_dir, texts, run_info)
+    except Exception as err:
+        metrics.incr('archive.errors')
+        metrics.logger.warning('Could not archive run ' + run_info['job'] + ': ' + str(err))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        with _lock:
+            _pending.discard(key)
+
+def wait_for_archives():
+    # Description:  Wait until the archives queued so far have been written, e.g. before a load test reads them.
+    get_executor().submit(lambda: None).result()
+
+def evict():
+    # Description:  Remove least recently used archives until they fit in archive_max_bytes.
+    archives = []
+    total = 0
+    for name in os.listdir(archive_dir):
+        path = os.path.join(archive_dir, name)
+        if name.startswith('.') or not name.endswith('.npz'):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        archives.append((stat.st_mtime, stat.st_size, path))
+        total = total + stat.st_size
+    if total <= archive_max_bytes:
+        return
+    archives.sort()
+    for mtime, size, path in archives:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total = total - size
+        metrics.incr('archive.evictions')
+        if total <= archive_max_bytes:
+            break
+
+def read_meta(key):
+    # Description:  Metadata of an archive: key, run times, parameters and the tables and texts it holds.
+    # Arguments:    key (string) - key of the archive
+    # Returns:      meta (dict) - the metadata, None when there is no such archive
+    with _lock:
+        if key in _metas:
+            return _metas[key]
+    import numpy as np
+    try:
+        with np.load(get_archive_path(key)) as archive:
+            meta = json.loads(archive['meta'].tobytes().decode('utf-8'))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+    with _lock:
+        _metas[key] = meta
+    return meta
+
+def read_table(key, name):
+    # Description:  Load a table of an archive.
+    # Arguments:    key (string) - key of the archive
+    #               name (string) - 'JV', 'Var' or 'scPars'
+    # Returns:      data (DataFrame) - the table as simss wrote it, float columns may be float32
+    import numpy as np
+    import pandas as pd
+    meta = read_meta(key)
+    if meta is None or name not in meta['tables']:
+        raise KeyError('No ' + name + ' table in archive ' + key)
+    table = meta['tables'][name]
+    with np.load(get_archive_path(key)) as archive:
+        columns = {column: unshuffle_bytes(archive[name + '/' + str(index)], table['dtypes'][index])
+                    for index, column in enumerate(table['columns'])}
+    return pd.DataFrame(columns)
+
+def read_text(key, file_name):
+    # Description:  Load a text file of an archive, e.g. its device_parameters.txt.
+    import numpy as np
+    with np.load(get_archive_path(key)) as archive:
+        return archive['text/' + file_name].tobytes().decode('utf-8')
+
+def list_archives(limit=None):
+    # Description:  Archived runs, most recently used first.
+    # Arguments:    limit (number) - maximum number of archives to return, None for all
+    # Returns:      archives (List) - dicts with 'key', 'path', 'time' (last use, epoch s) and 'bytes'
+    archives = []
+    try:
+        names = os.listdir(archive_dir)
+    except OSError:
+        return archives
+    for name in names:
+        if name.startswith('.') or not name.endswith('.npz'):
+            continue
+        path = os.path.join(archive_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Evicted in the meantime
+            continue
+        archives.append({'key': name[:-len('.npz')], 'path': path, 'time': stat.st_mtime, 'bytes': stat.st_size})
+    archives.sort(key=lambda archive: archive['time'], reverse=True)
+    return archives if limit is None else archives[:limit]
+
+def resolve_keys(keys, prefixes=True):
+    # Description:  Full keys of the archives selected by keys or unique key prefixes (at least 8 characters), so
+    #               selections fit in a URL. Unknown or ambiguous keys raise a KeyError.
+    # Arguments:    keys (List) - keys or key prefixes
+    #               prefixes (bool) - accept key prefixes. Without, only full keys of existing archives are accepted
+    #                                 and the other archives are not looked at.
+    # Returns:      keys (List) - full keys, in the given order without duplicates
+    if not prefixes:
+        for key in keys:
+            if not re.fullmatch(r'[0-9a-f]{64}', key) or not os.path.isfile(get_archive_path(key)):
+                raise KeyError('Unknown run key ' + key)
+        return list(dict.fromkeys(keys))
+    available = [archive['key'] for archive in list_archives()]
+    resolved = []
+    for prefix in keys:
+        if not re.fullmatch(r'[0-9a-f]{8,64}', prefix):
+            raise KeyError('Invalid run key ' + prefix)
+        matches = [key for key in available if key.startswith(prefix)]
+        if len(matches) != 1:
+            raise KeyError(('Ambiguous' if matches else 'Unknown') + ' run key ' + prefix)
+        if matches[0] not in resolved:
+            resolved.append(matches[0])
+    return resolved
+
+def iter_export(keys, chunk_size=None):
+    # Description:  Zip file with the archives of the selected runs and a manifest.json with their metadata, produced
+    #               piece by piece: at most one chunk of an archive is held in memory. The archives are compressed
+    #               already and stored as they are. Archives evicted during the export are left out.
+    # Arguments:    keys (List) - full keys of the runs, from resolve_keys
+    #               chunk_size (number) - bytes read at a time, export_chunk_size when None
+    # Returns:      chunks (generator) - bytes of the zip file
+    chunk_size = chunk_size or export_chunk_size
+    buffer = _ChunkBuffer()
+    manifest = []
+    metrics.incr('archive.exports')
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+        for key in keys:
+            meta = read_meta(key)
+            try:
+                fp = open(get_archive_path(key), 'rb')
+            except OSError:
+                continue
+            member_info = zipfile.ZipInfo(key + '.npz', time.localtime(os.fstat(fp.fileno()).st_mtime)[:6])
+            with fp, zip_file.open(member_info, 'w', force_zip64=True) as member:
+                while True:
+                    data = fp.read(chunk_size)
+                    if not data:
+                        break
+                    member.write(data)
+                    yield buffer.take()
+            yield buffer.take()
+            manifest.append(meta)
+        zip_file.writestr('manifest.json', json.dumps({'version': archive_version, 'runs': manifest}, indent=1))
+    yield buffer.take()
+
+def read_archive_bytes(key):
+    # Description:  Content of a single archive, for downloads of one run.
+    with open(get_archive_path(key), 'rb') as fp:
+        return fp.read()
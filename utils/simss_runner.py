@@ -0,0 +1,499 @@
+# simss_runner.py>
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from utils import job_spool as js
+from utils import metrics
+from utils import result_cache as rc
+from utils import run_archive as ra
+from utils import var_sidecar as vs
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, runs are then not limited
+    resource = None
+
+# Location of the compiled simss executable and its default input files. Used as template for every job.
+SimSS_path = 'SIMsalabim/SimSS/'
+# Files written by simss. These are not copied into the scratch directory of a job, but collected after a run.
+output_files = ['JV.dat', 'Var.dat', 'log.txt', 'scPars.dat']
+# Base directories for the per-session and per-job working directories.
+session_base_dir = os.path.join(tempfile.gettempdir(), 'simsalabim_sessions')
+scratch_base_dir = os.path.join(tempfile.gettempdir(), 'simsalabim_jobs')
+# Session directories that have not been used for this many seconds are removed.
+session_max_age = 24*3600
+# Number of finished jobs to keep in the registry.
+max_finished_jobs = 500
+# Default wall clock time limit of a run in seconds, 0 for no limit.
+default_timeout = float(os.environ.get('SIMSS_TIMEOUT', 600))
+# CPU time (s) and address space (bytes) limits of the simss process, 0 for no limit.
+cpu_limit = int(os.environ.get('SIMSS_CPU_LIMIT', 0))
+memory_limit = int(os.environ.get('SIMSS_MEMORY_LIMIT', 0))
+# The parameters of the latest results are kept next to the output files in the session directory
+run_parameters_file = 'run_parameters.txt'
+# Seconds between SIGTERM and SIGKILL when stopping a run
+kill_grace_period = 2
+# Number of runs handed to spool workers at the same time, when a spool is used (see job_spool.py)
+spool_slots = int(os.environ.get('SIMSS_SPOOL_SLOTS', 64))
+# Seconds between checks for the result of a spooled run
+spool_poll_interval = 0.5
+
+_executor = None
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class SimssJob:
+    # Description:  Book keeping of a single simss run.
+    #               status is one of 'queued', 'running', 'done', 'failed' or 'cancelled'.
+    #               While running, the console output is collected line by line in output and the output files are
+    #               written in scratch_dir. Jobs with archive False (parts of a larger run) are not archived.
+    def __init__(self, par_file, session_dir, timeout=None, archive=True):
+        self.id = uuid.uuid4().hex
+        self.par_file = par_file
+        self.session_dir = session_dir
+        self.timeout = default_timeout if timeout is None else timeout
+        self.status = 'queued'
+        self.returncode = None
+        self.output = []
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.cache_key = None
+        self.from_cache = False
+        self.scratch_dir = None
+        self.process = None
+        self.cancel_requested = False
+        self.timed_out = False
+        self.archive = archive
+
+    @property
+    def stdout(self):
+        return ''.join(self.output)
+
+    @stdout.setter
+    def stdout(self, value):
+        self.output = [value]
+
+    def is_finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+
+def get_worker_count():
+    # Description:  Number of simss processes that may run at the same time. Defaults to the number of cores, or to
+    #               spool_slots when the runs are handed to spool workers on other hosts.
+    #               Can be overruled with the SIMSS_WORKERS environment variable.
+    # Returns:      workers (number) - size of the worker pool
+    workers = os.environ.get('SIMSS_WORKERS')
+    if workers:
+        return max(1, int(workers))
+    if js.spool_dir:
+        return spool_slots
+    return os.cpu_count() or 1
+
+def get_executor():
+    # Description:  Create the process wide worker pool on first use.
+    #               Every worker thread only waits on its own simss subprocess, so the pool size bounds the number of
+    #               simss processes running concurrently.
+    # Returns:      executor (ThreadPoolExecutor) - the shared worker pool
+    global _executor
+    with _jobs_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_worker_count(), thread_name_prefix='simss')
+    return _executor
+
+def get_session_dir(session_state):
+    # Description:  Get the working directory of the current (Streamlit) session. A session id is stored in the
+    #               session state on first use.
+    # Arguments:    session_state (SessionState) - st.session_state of the current session
+    # Returns:      session_dir (string) - path to the session directory, ending with a separator
+    if 'session_id' not in session_state:
+        session_state['session_id'] = uuid.uuid4().hex
+    return create_session_dir(session_state['session_id'])
+
+def create_session_dir(session_id):
+    # Description:  Create (if needed) the working directory of a session and seed it with the device parameters.
+    #               Every session edits its own device_parameters.txt and receives its own JV.dat and Var.dat.
+    # Arguments:    session_id (string) - unique id of the session
+    # Returns:      session_dir (string) - path to the session directory, ending with a separator
+    session_dir = os.path.join(session_base_dir, session_id, '')
+    if not os.path.isdir(session_dir):
+        remove_stale_session_dirs()
+        os.makedirs(session_dir, exist_ok=True)
+    if not os.path.isfile(session_dir + 'device_parameters.txt'):
+        shutil.copyfile(SimSS_path + 'device_parameters.txt', session_dir + 'device_parameters.txt')
+    else:
+        # Mark the session as in use
+        os.utime(session_dir)
+    return session_dir
+
+def remove_stale_session_dirs():
+    # Description:  Remove session directories which have not been used for longer than session_max_age.
+    if not os.path.isdir(session_base_dir):
+        return
+    now = time.time()
+    for name in os.listdir(session_base_dir):
+        path = os.path.join(session_base_dir, name)
+        try:
+            if now - os.path.getmtime(path) > session_max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                vs.close_sidecars(os.path.join(path, ''))
+        except OSError:
+            # Removed by another process in the meantime
+            continue
+
+@lru_cache(maxsize=1)
+def locate_simss():
+    # Description:  Resolve the directory of the compiled simss executable once per process.
+    #               Raises FileNotFoundError when simss has not been built, this is not cached.
+    # Returns:      simss_dir (string) - absolute path of the SimSS directory, ending with a separator
+    simss_dir = os.path.join(os.path.abspath(SimSS_path), '')
+    if not os.access(simss_dir + 'simss', os.X_OK):
+        raise FileNotFoundError('simss executable not found in ' + simss_dir)
+    return simss_dir
+
+def create_scratch_dir():
+    # Description:  Create a private copy of the SimSS directory for a single job, without any previous output files.
+    # Returns:      scratch_dir (string) - path to the scratch directory, ending with a separator
+    simss_dir = locate_simss()
+    os.makedirs(scratch_base_dir, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix='simss_', dir=scratch_base_dir)
+    shutil.copytree(simss_dir, scratch_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns(*output_files))
+    return os.path.join(scratch_dir, '')
+
+def run_job(job, local=False):
+    # Description:  Run simss for a job in its own scratch directory and move the output files to the session directory.
+    #               Executed by a worker of the pool. When a spool directory is configured the job is handed to the
+    #               spool workers instead.
+    # Arguments:    job (SimssJob) - job to run
+    #               local (bool) - always run on this host, used by the spool workers themselves
+    # Returns:      job (SimssJob) - the finished job
+    if job.cancel_requested:
+        # Cancelled after the worker picked it up, but before it started
+        job.status = 'cancelled'
+        job.finished = time.time()
+        return job
+    job.started = time.time()
+    job.status = 'running'
+    metrics.observe('simss.queue_wait', job.started - job.submitted)
+    metrics.incr('simss.runs')
+    if js.spool_dir and not local:
+        return run_spooled_job(job)
+    scratch_dir = None
+    timer = None
+    try:
+        with metrics.span('simss.scratch_dir'):
+            scratch_dir = create_scratch_dir()
+        job.scratch_dir = scratch_dir
+        with open(scratch_dir + 'device_parameters.txt', 'w') as fp:
+            fp.write(job.par_file)
+        with metrics.span('simss.run'):
+            # simss runs in its own process group, so stopping it also stops anything it started
+            # No stdin, so simss can never wait for input
+            job.process = subprocess.Popen('./simss', cwd=scratch_dir, stdin=subprocess.DEVNULL,
+                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+            set_resource_limits(job.process.pid)
+            if job.cancel_requested:
+                # Cancelled while simss was being started, cancel_job had no process to stop yet
+                stop_process(job)
+            if job.timeout:
+                timer = threading.Timer(job.timeout, stop_timed_out_job, args=(job,))
+                timer.daemon = True
+                timer.start()
+            # Stream the console output while simss runs
+            for line in job.process.stdout:
+                job.output.append(line.decode('utf-8', errors='replace'))
+            job.returncode = job.process.wait()
+        if job.cancel_requested:
+            job.status = 'cancelled'
+            metrics.incr('simss.cancelled')
+        elif job.timed_out:
+            job.output.append('\nStopped after ' + str(job.timeout) + ' s (time limit)\n')
+            job.status = 'failed'
+            metrics.incr('simss.timeouts')
+        elif job.returncode == 0:
+            rc.store(job.cache_key, scratch_dir, job.stdout)
+            collect_output_files(scratch_dir, job.session_dir)
+            record_run_parameters(job)
+            job.status = 'done'
+            if not local:
+                # Spool workers leave archiving to the web app that submitted the job
+                ra.archive_run(job, scratch_dir)
+        else:
+            job.status = 'failed'
+            metrics.incr('simss.failures')
+    except Exception as err:
+        job.output.append(str(err))
+        job.status = 'failed'
+        metrics.incr('simss.failures')
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if job.process is not None and job.process.stdout is not None:
+            job.process.stdout.close()
+        job.finished = time.time()
+        job.scratch_dir = None
+        if scratch_dir is not None:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    return job
+
+def run_spooled_job(job):
+    # Description:  Hand a job to the spool workers and wait for its result. The console output is copied from the
+    #               spool while the job runs, the output files and the result cache are filled when it has finished.
+    # Arguments:    job (SimssJob) - job to run
+    # Returns:      job (SimssJob) - the finished job
+    cancel_sent = False
+    last_requeue_check = 0.0
+    try:
+        with metrics.span('simss.spool'):
+            js.enqueue(js.spool_dir, job.id, job.par_file, job.timeout)
+            job.output = ['Waiting for a spool worker\n']
+            while True:
+                result, done_dir = js.get_result(js.spool_dir, job.id)
+                if result is not None:
+                    break
+                if job.cancel_requested and not cancel_sent:
+                    js.cancel(js.spool_dir, job.id)
+                    cancel_sent = True
+                # Also requeue the jobs of lost workers from here, in case no other worker is alive
+                if time.time() - last_requeue_check > js.lease_timeout:
+                    js.requeue_stale(js.spool_dir)
+                    last_requeue_check = time.time()
+                output = js.read_output(js.spool_dir, job.id)
+                if output:
+                    job.output = output.splitlines(True)
+                time.sleep(spool_poll_interval)
+        job.stdout = js.read_output(js.spool_dir, job.id)
+        job.returncode = result.get('returncode')
+        if result.get('message'):
+            job.output.append('\n' + result['message'] + '\n')
+        if result['status'] == 'done':
+            rc.store(job.cache_key, done_dir, job.stdout)
+            collect_output_files(done_dir, job.session_dir)
+            record_run_parameters(job)
+        job.status = result['status']
+        if job.status == 'done':
+            ra.archive_run(job, done_dir)
+        if job.status == 'cancelled':
+            metrics.incr('simss.cancelled')
+        elif job.status == 'failed':
+            metrics.incr('simss.failures')
+    except Exception as err:
+        job.output.append(str(err))
+        job.status = 'failed'
+        metrics.incr('simss.failures')
+    finally:
+        job.finished = time.time()
+        js.remove(js.spool_dir, job.id)
+    return job
+
+def set_resource_limits(pid):
+    # Description:  Apply the CPU time and memory limits to the simss process. prlimit is used instead of a preexec_fn,
+    #               which is not safe in a multi-threaded server. A run exceeding the CPU limit is killed by the kernel
+    #               (SIGXCPU/SIGKILL), a run exceeding the memory limit fails to allocate.
+    # Arguments:    pid (number) - process id of simss
+    if resource is None or not hasattr(resource, 'prlimit'):
+        return
+    try:
+        if cpu_limit > 0:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_limit, cpu_limit + kill_grace_period))
+        if memory_limit > 0:
+            resource.prlimit(pid, resource.RLIMIT_AS, (memory_limit, memory_limit))
+    except ProcessLookupError:
+        # simss already finished
+        pass
+
+def stop_process(job):
+    # Description:  Stop the simss process of a job: SIGTERM first, SIGKILL when it is still running after the grace
+    #               period. The worker thread notices the end of the process and finishes the job.
+    # Arguments:    job (SimssJob) - the running job
+    process = job.process
+    if process is None or process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(kill_grace_period)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        # Already finished
+        pass
+
+def stop_timed_out_job(job):
+    job.timed_out = True
+    stop_process(job)
+
+def cancel_job(job_id):
+    # Description:  Cancel a queued or running job. A queued job is removed from the queue, a running job is stopped.
+    # Arguments:    job_id (string) - id of the job
+    # Returns:      cancelled (bool) - False when the job is unknown or already finished
+    job = get_job(job_id)
+    if job is None or job.is_finished():
+        return False
+    job.cancel_requested = True
+    if job.future is not None and job.future.cancel():
+        job.status = 'cancelled'
+        job.finished = time.time()
+        metrics.incr('simss.cancelled')
+    else:
+        # stop_process waits for the grace period, do not block the caller
+        threading.Thread(target=stop_process, args=(job,), daemon=True).start()
+    return True
+
+def read_partial_output(job, file_name='JV.dat'):
+    # Description:  Read the rows simss has written so far to an output file of a running job. An incomplete last line
+    #               is left out.
+    # Arguments:    job (SimssJob) - the running job
+    #               file_name (string) - output file to read
+    # Returns:      data (DataFrame) - rows written so far, None when nothing is available yet
+    import io
+    import pandas as pd
+    scratch_dir = job.scratch_dir
+    if scratch_dir is None:
+        return None
+    try:
+        with open(scratch_dir + file_name) as fp:
+            text = fp.read()
+    except OSError:
+        return None
+    text = text[:text.rfind('\n') + 1]
+    if text.count('\n') < 2:
+        # Header only
+        return None
+    try:
+        return pd.read_csv(io.StringIO(text), sep=r'\s+')
+    except (ValueError, pd.errors.ParserError):
+        return None
+
+def collect_output_files(scratch_dir, session_dir, link=False):
+    # Description:  Copy the simss output files from the scratch directory (or a cache entry) to the session directory.
+    #               Files are replaced atomically, so a page reading them never sees a partially written file.
+    # Arguments:    scratch_dir (string) - directory containing the output files
+    #               session_dir (string) - destination directory
+    #               link (bool) - hard link instead of copy when possible. Output files are only ever replaced,
+    #                             never modified in place, so sharing them with the cache is safe.
+    #               All files are linked or copied aside first. When that fails, e.g. because the cache entry was
+    #               evicted meanwhile, OSError is raised and the session directory is left as it was.
+    staged = {}
+    try:
+        for file_name in output_files:
+            if os.path.isfile(scratch_dir + file_name):
+                tmp_name = session_dir + '.' + file_name + '.tmp'
+                if os.path.lexists(tmp_name):
+                    os.remove(tmp_name)
+                try:
+                    if not link:
+                        raise OSError
+                    os.link(scratch_dir + file_name, tmp_name)
+                except OSError:
+                    shutil.copyfile(scratch_dir + file_name, tmp_name)
+                staged[file_name] = tmp_name
+        # Entries are evicted as a whole (renamed away first): when the directory still exists, no file was missed
+        if not os.path.isdir(scratch_dir):
+            raise FileNotFoundError('Output directory ' + scratch_dir + ' was removed while collecting its files')
+    except BaseException:
+        for tmp_name in staged.values():
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+        raise
+    for file_name in output_files:
+        if file_name in staged:
+            os.replace(staged[file_name], session_dir + file_name)
+        elif os.path.isfile(session_dir + file_name):
+            # Do not leave output of a previous simulation next to the new results
+            os.remove(session_dir + file_name)
+
+def limit_timeout(timeout):
+    # Description:  Time limit requested by a user, bounded by the limit of the server (default_timeout). Requests for no
+    #               limit (0) or a longer limit get the server limit, unless the server has no limit itself.
+    # Arguments:    timeout (float) - requested time limit in s, None or 0 for no limit
+    # Returns:      timeout (float) - time limit to run with in s, 0 for no limit
+    if not timeout or timeout < 0:
+        return default_timeout
+    return min(timeout, default_timeout) if default_timeout else timeout
+
+def submit_simss(par_file, session_dir, timeout=None, archive=True):
+    # Description:  Queue a simss run. Returns immediately, use get_job to poll the status.
+    # Arguments:    par_file (string) - content of the device_parameters.txt file to simulate
+    #               session_dir (string) - directory to place the output files in
+    #               timeout (float) - wall clock time limit in s, None for the default, 0 for no limit
+    #               archive (bool) - archive the result (see run_archive.py), False for parts of a larger run
+    # Returns:      job (SimssJob) - the queued job
+    job = create_job(par_file, session_dir, timeout, archive)
+    start_job(job)
+    return job
+
+def create_job(par_file, session_dir, timeout=None, archive=True):
+    # Description:  Create and register a job without queueing it yet, for callers that feed the pool gradually.
+    #               Start it with start_job. Arguments as for submit_simss.
+    # Returns:      job (SimssJob) - the new job, status 'queued'
+    job = SimssJob(par_file, session_dir, timeout, archive)
+    job.cache_key = rc.get_cache_key(par_file, SimSS_path)
+    register_job(job)
+    return job
+
+def start_job(job):
+    # Description:  Reuse the cached output of a job created with create_job, or queue it on the worker pool.
+    # Arguments:    job (SimssJob) - the job to start
+    entry_dir = rc.lookup(job.cache_key)
+    if entry_dir is not None:
+        # Parameters have been simulated before, reuse the stored output
+        try:
+            collect_output_files(entry_dir, job.session_dir, link=True)
+            record_run_parameters(job)
+            job.stdout = rc.read_stdout(entry_dir)
+            job.returncode = 0
+            job.from_cache = True
+            job.status = 'done'
+            job.finished = time.time()
+            ra.archive_run(job, entry_dir)
+            return
+        except OSError:
+            # Entry evicted while copying, simulate after all
+            pass
+    job.future = get_executor().submit(run_job, job)
+
+def register_job(job):
+    # Description:  Add a job to the registry, so it can be polled and cancelled by its id.
+    # Arguments:    job (SimssJob) - the new job
+    with _jobs_lock:
+        prune_jobs()
+        _jobs[job.id] = job
+
+def record_run_parameters(job):
+    # Description:  Store the parameters of a successful job next to its output files, so later runs can tell which
+    #               parameters the output in the session directory belongs to.
+    # Arguments:    job (SimssJob) - the job whose output has just been collected
+    tmp_name = job.session_dir + '.' + run_parameters_file + '.tmp'
+    with open(tmp_name, 'w') as fp:
+        fp.write(job.par_file)
+    os.replace(tmp_name, job.session_dir + run_parameters_file)
+
+def get_job(job_id):
+    # Description:  Look up a submitted job.
+    # Arguments:    job_id (string) - id of the job
+    # Returns:      job (SimssJob) - the job or None when unknown
+    if job_id is None:
+        return None
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+def prune_jobs():
+    # Description:  Drop the oldest finished jobs from the registry when it grows beyond max_finished_jobs.
+    #               Must be called with _jobs_lock held.
+    finished = [job for job in _jobs.values() if job.is_finished()]
+    if len(finished) > max_finished_jobs:
+        finished.sort(key=lambda job: job.finished)
+        for job in finished[:len(finished) - max_finished_jobs]:
+            del _jobs[job.id]
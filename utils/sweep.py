@@ -0,0 +1,147 @@
+# sweep.py>
+import itertools
+import os
+import shutil
+import threading
+import time
+import numpy as np
+from utils import dev_par_model as dpm
+from utils import simss_runner as sr
+
+# Largest number of simulations in one sweep, so a single sweep cannot fill the queue of all sessions
+max_points = int(os.environ.get('SIMSALABIM_SWEEP_MAX_POINTS', 500))
+# Largest number of points of one sweep queued on the worker pool at the same time, 0 for half the pool. The other
+# points wait in the sweep, so runs of other sessions do not queue behind the whole sweep.
+max_in_flight = int(os.environ.get('SIMSALABIM_SWEEP_MAX_IN_FLIGHT', 0))
+# Interval in s at which the sweep checks for free places on the worker pool
+feed_interval = 0.2
+
+def parse_sweep_values(spec):
+    # Description:  Convert the values entered for a swept parameter into a list of values.
+    # Arguments:    spec (string) - One of:
+    #                                   'start:stop:num'      num linearly spaced values, including start and stop
+    #                                   'log:start:stop:num'  num logarithmically spaced values, including start and stop
+    #                                   'a, b, c'             explicit list of values
+    # Returns:      values (List) - values as strings, ready to be written to the parameter file
+    spec = spec.strip()
+    if ':' in spec:
+        parts = [part.strip() for part in spec.split(':')]
+        log_scale = parts[0].lower() == 'log'
+        if log_scale:
+            parts = parts[1:]
+        if len(parts) != 3:
+            raise ValueError('Range must be given as start:stop:num or log:start:stop:num, got ' + spec)
+        start, stop, num = float(parts[0]), float(parts[1]), int(parts[2])
+        if num < 1:
+            raise ValueError('Number of points must be at least 1, got ' + spec)
+        if num > max_points:
+            raise ValueError('At most ' + str(max_points) + ' points per sweep, got ' + spec)
+        if log_scale:
+            if start <= 0 or stop <= 0:
+                raise ValueError('Logarithmic range requires positive values, got ' + spec)
+            values = np.geomspace(start, stop, num)
+        else:
+            values = np.linspace(start, stop, num)
+        return [format_value(value) for value in values]
+    values = [value.strip() for value in spec.replace(';', ',').split(',') if value.strip() != '']
+    if not values:
+        raise ValueError('No values given')
+    return [dpm.check_value('the swept parameter', value) for value in values]
+
+def format_value(value):
+    # Description:  Format a generated number compactly for the parameter file.
+    # Arguments:    value (float) - number to format
+    # Returns:      value (string) - formatted number
+    return '{:.6g}'.format(value)
+
+def create_sweep_points(sweep_values):
+    # Description:  Create the full grid of parameter combinations.
+    # Arguments:    sweep_values (dict) - parameter name -> list of values
+    # Returns:      points (List) - one dict (parameter name -> value) per combination
+    names = list(sweep_values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*[sweep_values[name] for name in names])]
+
+def set_parameters(dev_par_model, values):
+    # Description:  Create a copy of the parameter model with some parameter values replaced.
+    # Arguments:    dev_par_model (DevParModel) - parameter model to start from
+    #               values (dict) - parameter name -> new value
+    # Returns:      dev_par_variant (DevParModel) - modified copy of the parameter model
+    unknown = [name for name in values if name not in dev_par_model]
+    if unknown:
+        raise KeyError('Unknown parameter(s): ' + ', '.join(sorted(unknown)))
+    dev_par_variant = dev_par_model.copy()
+    dev_par_variant.update(values)
+    return dev_par_variant
+
+def get_max_in_flight():
+    # Description:  Number of points of one sweep that may be queued or running on the worker pool at the same time.
+    # Returns:      limit (number) - max_in_flight, or half the pool when not set
+    if max_in_flight > 0:
+        return max_in_flight
+    return max(1, sr.get_worker_count()//2)
+
+def run_sweep(dev_par_model, points, sweep_dir):
+    # Description:  Create one simss job per sweep point and feed them to the worker pool in the background, at most
+    #               get_max_in_flight at a time.
+    # Arguments:    dev_par_model (DevParModel) - parameter model to start from
+    #               points (List) - sweep points from create_sweep_points
+    #               sweep_dir (string) - directory to store the results in, one sub directory per point
+    # Returns:      jobs (List) - SimssJob for every point, in the same order as points
+    if len(points) > max_points:
+        raise ValueError('At most ' + str(max_points) + ' points per sweep, got ' + str(len(points)))
+    shutil.rmtree(sweep_dir, ignore_errors=True)
+    jobs = []
+    for index, point in enumerate(points):
+        point_dir = os.path.join(sweep_dir, 'point_' + str(index), '')
+        os.makedirs(point_dir, exist_ok=True)
+        par_file = set_parameters(dev_par_model, point).to_txt()
+        with open(point_dir + 'device_parameters.txt', 'w') as fp:
+            fp.write(par_file)
+        jobs.append(sr.create_job(par_file, point_dir))
+    threading.Thread(target=feed_sweep, args=(jobs,), name='sweep_feeder', daemon=True).start()
+    return jobs
+
+def feed_sweep(jobs):
+    # Description:  Start the jobs of a sweep one by one, keeping at most get_max_in_flight of them unfinished on the
+    #               pool. Jobs cancelled before they were started are finished here. Runs in its own thread.
+    # Arguments:    jobs (List) - jobs created by run_sweep
+    limit = get_max_in_flight()
+    started = []
+    for job in jobs:
+        while not job.cancel_requested and sum(1 for other in started if not other.is_finished()) >= limit:
+            time.sleep(feed_interval)
+        if job.cancel_requested:
+            job.status = 'cancelled'
+            job.finished = time.time()
+            continue
+        sr.start_job(job)
+        started.append(job)
+
+def cancel_sweep(jobs):
+    # Description:  Cancel all points of a sweep that have not finished yet, queued, running or still waiting in the
+    #               sweep.
+    # Arguments:    jobs (List) - jobs returned by run_sweep
+    # Returns:      cancelled (number) - number of points cancelled
+    return sum(1 for job in jobs if sr.cancel_job(job.id))
+
+def collect_sweep_results(points, jobs, file_name='JV.dat'):
+    # Description:  Combine the output of all finished sweep points into a single table.
+    #               The swept parameters are added as key columns in front of the simss output columns.
+    # Arguments:    points (List) - sweep points from create_sweep_points
+    #               jobs (List) - jobs returned by run_sweep
+    #               file_name (string) - output file to combine, JV.dat or Var.dat
+    # Returns:      table (DataFrame) - combined results, empty when no point has finished successfully
+    import pandas as pd
+    frames = []
+    for point, job in zip(points, jobs):
+        if job.status != 'done' or not os.path.isfile(job.session_dir + file_name):
+            continue
+        frame = pd.read_csv(job.session_dir + file_name, sep=r'\s+')
+        for position, (name, value) in enumerate(point.items()):
+            # Swept values are numbers in almost all cases, store them as such in the results table
+            number = dpm.to_number(value)
+            frame.insert(position, name, value if number is None else number)
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,148 @@
+# var_sidecar.py>
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from utils import metrics
+
+# Name of the directory next to the Var.dat file that holds the binary columns
+sidecar_suffix = '.cols'
+# Bump when the layout of the sidecar changes, older sidecars are converted again
+sidecar_version = 1
+# Number of opened sidecars kept per process. Their memory maps keep the column files allocated on disk, also after the
+# session directory has been removed, so the least recently used ones are dropped.
+max_open_sidecars = int(os.environ.get('SIMSALABIM_MAX_OPEN_SIDECARS', 256))
+
+_sidecars = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_file_identity(path):
+    # Description:  Cheap identity of a file, changes whenever simss (or the result cache) replaces the file.
+    # Arguments:    path (string) - path to the file
+    # Returns:      identity (List) - [inode, size, modification time in ns]
+    stat = os.stat(path)
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+@metrics.timed('var_sidecar.convert')
+def convert_var_file(path):
+    # Description:  Convert a whitespace delimited Var.dat file to a binary columnar sidecar: one .npy file per column
+    #               and a meta.json with the column names and the row range belonging to every Vext.
+    #               simss writes the grid for one voltage after the other, so every Vext is a contiguous block of rows.
+    # Arguments:    path (string) - path to the Var.dat file
+    # Returns:      meta (dict) - content of meta.json
+    import pandas as pd
+    metrics.incr('var_sidecar.conversions')
+    identity = get_file_identity(path)
+    data_var = pd.read_csv(path, sep=r'\s+')
+    vext = data_var['Vext'].to_numpy()
+    # Start of every block of rows with the same Vext
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(vext) != 0) + 1))
+    stops = np.concatenate((starts[1:], [len(vext)]))
+    meta = {
+        'version': sidecar_version,
+        'source': identity,
+        'rows': len(data_var),
+        'columns': list(data_var.columns),
+        'dtypes': [str(dtype) for dtype in data_var.dtypes],
+        'index': [[float(vext[start]), int(start), int(stop)] for start, stop in zip(starts, stops)]}
+
+    # Assemble the sidecar in a temporary directory and move it in place when complete
+    sidecar_dir = path + sidecar_suffix
+    tmp_dir = tempfile.mkdtemp(prefix='.sidecar_', dir=os.path.dirname(os.path.abspath(path)))
+    for column_index, column in enumerate(data_var.columns):
+        np.save(os.path.join(tmp_dir, str(column_index) + '.npy'), np.ascontiguousarray(data_var[column].to_numpy()))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+    shutil.rmtree(sidecar_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, sidecar_dir)
+    except OSError:
+        # Converted by another session at the same time
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return meta
+
+def open_sidecar(path):
+    # Description:  Get the sidecar of a Var.dat file, converting the file first if the sidecar is missing or stale.
+    #               Opened sidecars are kept per process (at most max_open_sidecars), so a Streamlit rerun only costs
+    #               a stat of Var.dat.
+    # Arguments:    path (string) - path to the Var.dat file
+    # Returns:      sidecar (dict) - 'dir': sidecar directory, 'meta': content of meta.json, 'columns': memory mapped
+    #                                columns loaded so far
+    try:
+        identity = get_file_identity(path)
+    except OSError:
+        # Removed, e.g. with its session directory: release the memory maps
+        with _lock:
+            _sidecars.pop(path, None)
+        raise
+    with _lock:
+        sidecar = _sidecars.get(path)
+        if sidecar is not None:
+            _sidecars.move_to_end(path)
+    if sidecar is not None and sidecar['meta']['source'] == identity:
+        return sidecar
+    meta = None
+    try:
+        with open(os.path.join(path + sidecar_suffix, 'meta.json')) as fp:
+            meta = json.load(fp)
+    except (OSError, ValueError):
+        pass
+    if meta is None or meta.get('version') != sidecar_version or meta.get('source') != identity:
+        meta = convert_var_file(path)
+    sidecar = {'dir': path + sidecar_suffix, 'meta': meta, 'columns': {}}
+    with _lock:
+        _sidecars[path] = sidecar
+        _sidecars.move_to_end(path)
+        while len(_sidecars) > max_open_sidecars:
+            _sidecars.popitem(last=False)
+    return sidecar
+
+def close_sidecars(directory):
+    # Description:  Drop the opened sidecars of the Var.dat files in a directory, e.g. when it is removed.
+    # Arguments:    directory (string) - directory, ending with a separator
+    with _lock:
+        for path in [path for path in _sidecars if path.startswith(directory)]:
+            del _sidecars[path]
+
+def get_columns(sidecar):
+    # Returns:      columns (List) - names of the columns of Var.dat
+    return sidecar['meta']['columns']
+
+def get_voltages(sidecar):
+    # Description:  All voltages present in Var.dat, taken from the index without reading any data.
+    # Returns:      voltages (List) - sorted unique Vext values
+    return sorted(set(entry[0] for entry in sidecar['meta']['index']))
+
+def get_column(sidecar, column):
+    # Description:  Memory map a single column. Only the pages that are actually accessed are read from disk.
+    # Arguments:    column (string) - column name
+    # Returns:      values (ndarray) - read-only memory mapped column
+    values = sidecar['columns'].get(column)
+    if values is None:
+        column_index = sidecar['meta']['columns'].index(column)
+        values = np.load(os.path.join(sidecar['dir'], str(column_index) + '.npy'), mmap_mode='r')
+        sidecar['columns'][column] = values
+    return values
+
+def load_columns(sidecar, columns, vext=None):
+    # Description:  Load a selection of columns, optionally only the rows of a single voltage.
+    # Arguments:    columns (List) - column names to load
+    #               vext (float) - voltage to load the rows for, None to load all rows
+    # Returns:      data_var (DataFrame) - the selected part of Var.dat
+    import pandas as pd
+    if vext is None:
+        row_slices = [slice(0, sidecar['meta']['rows'])]
+    else:
+        row_slices = [slice(start, stop) for value, start, stop in sidecar['meta']['index'] if value == vext]
+    data = {}
+    for column in columns:
+        values = get_column(sidecar, column)
+        if len(row_slices) == 1:
+            data[column] = np.array(values[row_slices[0]])
+        else:
+            data[column] = np.concatenate([values[row_slice] for row_slice in row_slices])
+    return pd.DataFrame(data, columns=columns)
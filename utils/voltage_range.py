@@ -0,0 +1,327 @@
+# voltage_range.py>
+import math
+import os
+import shutil
+import threading
+import time
+from utils import dev_par_model as dpm
+from utils import metrics
+from utils import result_cache as rc
+from utils import run_archive as ra
+from utils import simss_runner as sr
+
+# Parameters that may differ from the previous run for an incremental run
+range_params = ['Vmin', 'Vmax', 'Vstep']
+# Parameters of the voltage section that must have these values: a uniform voltage grid (Vdist), no pre-conditioning
+# or ions fixed at the first voltage (every point then depends on where the scan started) and no early stop at Voc
+required_values = {'Vdist': 1, 'PreCond': 0, 'FixIons': 0, 'until_Voc': 0}
+# Runs of missing voltages shorter than this are not split over several simss processes
+min_chunk_points = 10
+# More chunks than this and a full run is simpler
+max_chunks = 16
+# Allowed difference in J at the voltages simulated twice where chunks meet, relative to the largest |J| of the curve
+continuity_tolerance = 1e-2
+# Incremental output files, the figures in scPars.dat describe a single run and are not merged
+merged_files = ['JV.dat', 'Var.dat']
+
+
+def get_voltage_grid(vmin, vmax, vstep):
+    # Description:  Voltages simss simulates for a uniform grid.
+    # Returns:      voltages (List) - vmin, vmin+vstep, ... up to and including vmax
+    n_points = int(math.floor((vmax - vmin)/vstep + 1e-6)) + 1
+    return [vmin + index*vstep for index in range(max(n_points, 0))]
+
+def read_rows(path):
+    # Description:  Read an output file as text lines, together with the voltage of every line. The lines are not
+    #               parsed further, so merged files keep the formatting of simss.
+    # Arguments:    path (string) - path to JV.dat or Var.dat
+    # Returns:      header (string) - first line
+    #               rows (List) - (Vext, line) pairs
+    with open(path) as fp:
+        header = fp.readline()
+        column = header.split().index('Vext')
+        rows = []
+        for line in fp:
+            fields = line.split()
+            if len(fields) > column:
+                rows.append((float(fields[column]), line if line.endswith('\n') else line + '\n'))
+    return header, rows
+
+def find_index(voltages, value, tolerance):
+    # Returns:      index (number) - index of the voltage within tolerance of value, None when there is none
+    for index, voltage in enumerate(voltages):
+        if abs(voltage - value) <= tolerance:
+            return index
+    return None
+
+def split_runs(indices):
+    # Description:  Split sorted grid indices in runs with a constant spacing, e.g. [0,1,2,5,7,9] -> [0,1,2], [5,7,9].
+    #               A refined grid (Vstep halved) gives a single run of every other index.
+    # Returns:      runs (List) - lists of indices
+    runs = []
+    for index in indices:
+        if runs and (len(runs[-1]) == 1 or index - runs[-1][-1] == runs[-1][1] - runs[-1][0]):
+            runs[-1].append(index)
+        else:
+            runs.append([index])
+    return runs
+
+def plan_extension(session_dir, par_file):
+    # Description:  Check if par_file only changes the voltage range of the results in the session directory, and if so
+    #               plan the simss runs for the missing voltages.
+    # Arguments:    session_dir (string) - session directory with the previous results
+    #               par_file (string) - content of the device_parameters.txt file to simulate
+    # Returns:      plan (dict) - 'grid': voltages of the new run, 'reuse': grid index -> voltage of the previous run,
+    #                             'chunks': lists of grid indices to simulate (including overlapping voltages, for
+    #                             the continuity check, see get_check_chunks).
+    #                             None when an incremental run is not possible or not useful.
+    try:
+        with open(session_dir + sr.run_parameters_file) as fp:
+            previous = dpm.parse_dev_par(fp.read()).values()
+        header, previous_rows = read_rows(session_dir + 'JV.dat')
+    except (OSError, ValueError):
+        return None
+    current = dpm.parse_dev_par(par_file).values()
+    if set(previous) != set(current) or not all(name in current for name in range_params):
+        return None
+    for name in current:
+        if name not in range_params and rc.normalize_value(previous[name]) != rc.normalize_value(current[name]):
+            return None
+    try:
+        for name, value in required_values.items():
+            if name in current and float(current[name]) != value:
+                return None
+        vmin, vmax, vstep = [float(current[name]) for name in range_params]
+    except ValueError:
+        return None
+    if [rc.normalize_value(previous[name]) for name in range_params] == [repr(vmin), repr(vmax), repr(vstep)]:
+        # Nothing changed
+        return None
+    if vstep <= 0 or vmax < vmin:
+        return None
+
+    grid = get_voltage_grid(vmin, vmax, vstep)
+    previous_voltages = [vext for vext, line in previous_rows]
+    tolerance = 1e-6*vstep
+    reuse = {}
+    for index, voltage in enumerate(grid):
+        previous_index = find_index(previous_voltages, voltage, tolerance)
+        if previous_index is not None:
+            reuse[index] = previous_voltages[previous_index]
+    if not reuse:
+        return None
+    missing = [index for index in range(len(grid)) if index not in reuse]
+
+    # Split long runs of missing voltages so they are simulated in parallel
+    chunks = []
+    for run in split_runs(missing):
+        n_pieces = min(max(1, len(run)//min_chunk_points), sr.get_worker_count())
+        size = -(-len(run)//n_pieces)
+        chunks.extend(run[start:start + size] for start in range(0, len(run), size))
+    # Simulate one voltage before and after every chunk again, where it exists, to check that the pieces join
+    for chunk in chunks:
+        spacing = chunk[1] - chunk[0] if len(chunk) > 1 else 1
+        if chunk[0] - spacing >= 0:
+            chunk.insert(0, chunk[0] - spacing)
+        if chunk[-1] + spacing < len(grid):
+            chunk.append(chunk[-1] + spacing)
+    chunks.extend(get_check_chunks(chunks, reuse, len(grid)))
+    if len(chunks) > max_chunks:
+        return None
+    return {'grid': grid, 'reuse': reuse, 'chunks': chunks}
+
+def get_check_chunks(chunks, reuse, n_grid):
+    # Description:  Every chunk must be joined to the previous run by voltages simulated twice, directly or through
+    #               other chunks. Chunks of a refined grid only hold new voltages (every other one), their neighbours on
+    #               their own grid are new as well. Those get a two voltage check chunk: a previous voltage and the
+    #               first voltage of the chunk.
+    # Arguments:    chunks (List) - lists of grid indices, including the overlapping neighbours
+    #               reuse (dict) - grid index -> voltage of the previous run
+    #               n_grid (number) - number of grid voltages
+    # Returns:      check_chunks (List) - the extra chunks, lists of two neighbouring grid indices
+    joined = set(reuse)
+    pending = list(chunks)
+    check_chunks = []
+    while pending:
+        linked = [chunk for chunk in pending if joined.intersection(chunk)]
+        if not linked:
+            # Join the first remaining chunk through a previous voltage next to its first voltage
+            first = pending[0][0]
+            if first - 1 in reuse:
+                check_chunk = [first - 1, first]
+            elif first + 1 < n_grid and first + 1 in reuse:
+                check_chunk = [first, first + 1]
+            else:
+                # No previous voltage next to it, the chunk cannot be checked
+                pending.pop(0)
+                continue
+            check_chunks.append(check_chunk)
+            linked = [pending[0]]
+        for chunk in linked:
+            joined.update(chunk)
+            pending.remove(chunk)
+    return check_chunks
+
+def get_chunk_parameters(par_file, grid, chunk):
+    # Description:  Parameter file for simulating the voltages of a chunk.
+    # Returns:      par_file (string) - the parameters with Vmin, Vmax and Vstep of the chunk
+    dev_par_model = dpm.parse_dev_par(par_file)
+    spacing = chunk[1] - chunk[0] if len(chunk) > 1 else 1
+    vstep = grid[1] - grid[0] if len(grid) > 1 else 1.0
+    dev_par_model.update({'Vmin': '{:.10g}'.format(grid[chunk[0]]), 'Vmax': '{:.10g}'.format(grid[chunk[-1]]),
+                          'Vstep': '{:.10g}'.format(spacing*vstep)})
+    return dev_par_model.to_txt()
+
+def submit_extension(par_file, session_dir, plan, timeout=None):
+    # Description:  Run the chunks of a plan and merge them with the previous results. The returned job is registered
+    #               like a normal simss job, so it can be polled and cancelled by its id.
+    # Arguments:    par_file (string) - content of the device_parameters.txt file to simulate
+    #               session_dir (string) - session directory with the previous results
+    #               plan (dict) - plan from plan_extension
+    #               timeout (float) - time limit of every chunk
+    # Returns:      job (SimssJob) - the job representing the whole run
+    job = sr.SimssJob(par_file, session_dir, timeout)
+    job.cache_key = rc.get_cache_key(par_file, sr.SimSS_path)
+    sr.register_job(job)
+    threading.Thread(target=run_extension, args=(job, plan), name='extension_' + job.id, daemon=True).start()
+    metrics.incr('simss.extensions')
+    return job
+
+def run_extension(job, plan):
+    # Description:  Simulate the chunks in parallel on the worker pool, merge and check the result, and fall back to a
+    #               full run when the pieces do not join. Runs in its own thread.
+    job.started = time.time()
+    job.status = 'running'
+    extension_dir = os.path.join(job.session_dir, 'extension', '')
+    shutil.rmtree(extension_dir, ignore_errors=True)
+    n_reused = len(plan['reuse'])
+    job.output = ['Reusing ' + str(n_reused) + ' of ' + str(len(plan['grid'])) + ' voltages of the previous run, '
+                    + 'simulating the other voltages in ' + str(len(plan['chunks'])) + ' part(s)\n']
+    header = job.output[0]
+    try:
+        chunk_jobs = []
+        for chunk_index, chunk in enumerate(plan['chunks']):
+            chunk_dir = os.path.join(extension_dir, 'chunk_' + str(chunk_index), '')
+            os.makedirs(chunk_dir)
+            # Only the merged result is archived
+            chunk_jobs.append(sr.submit_simss(get_chunk_parameters(job.par_file, plan['grid'], chunk), chunk_dir,
+                                            job.timeout, archive=False))
+        cancel_sent = False
+        while not all(chunk_job.is_finished() for chunk_job in chunk_jobs):
+            if job.cancel_requested and not cancel_sent:
+                for chunk_job in chunk_jobs:
+                    sr.cancel_job(chunk_job.id)
+                cancel_sent = True
+            job.output = [header] + [line for chunk_job in chunk_jobs for line in chunk_job.output]
+            time.sleep(0.2)
+        job.output = [header] + [line for chunk_job in chunk_jobs for line in chunk_job.output]
+        if job.cancel_requested:
+            job.status = 'cancelled'
+            return
+        failed = [chunk_job for chunk_job in chunk_jobs if chunk_job.status != 'done']
+        if failed:
+            job.returncode = failed[0].returncode
+            job.status = 'failed'
+            return
+        merge_dir = os.path.join(extension_dir, 'merged', '')
+        os.makedirs(merge_dir)
+        with metrics.span('simss.extension_merge'):
+            joined = merge_outputs(job.session_dir, plan, [chunk_job.session_dir for chunk_job in chunk_jobs],
+                                    merge_dir)
+        if not joined:
+            # The pieces do not join up: simulate the whole range after all
+            job.output.append('\nThe simulated parts do not join continuously, simulating the full voltage range\n')
+            metrics.incr('simss.extension_fallbacks')
+            full_job = sr.submit_simss(job.par_file, job.session_dir, job.timeout)
+            while not full_job.is_finished():
+                if job.cancel_requested and not cancel_sent:
+                    sr.cancel_job(full_job.id)
+                    cancel_sent = True
+                time.sleep(0.2)
+            job.output.extend(full_job.output)
+            job.returncode = full_job.returncode
+            job.status = 'cancelled' if job.cancel_requested else full_job.status
+            return
+        # Not stored in the result cache: the cache only holds the output of complete simss runs
+        sr.collect_output_files(merge_dir, job.session_dir)
+        sr.record_run_parameters(job)
+        job.returncode = 0
+        job.status = 'done'
+        ra.archive_run(job, merge_dir)
+    except Exception as err:
+        job.output.append(str(err))
+        job.status = 'failed'
+        metrics.incr('simss.failures')
+    finally:
+        job.finished = time.time()
+        shutil.rmtree(extension_dir, ignore_errors=True)
+
+def merge_outputs(session_dir, plan, chunk_dirs, merge_dir):
+    # Description:  Combine the reused rows of the previous output files with the output of the chunks, sorted by
+    #               voltage in the scan direction of the previous run. Voltages simulated in more than one place are
+    #               used to check that the J values agree.
+    # Arguments:    session_dir (string) - directory with the previous output
+    #               plan (dict) - plan from plan_extension
+    #               chunk_dirs (List) - output directories of the chunks, in the order of plan['chunks']
+    #               merge_dir (string) - directory to write the merged files to
+    # Returns:      joined (bool) - False when the chunks do not join continuously, nothing useful is written then
+    grid = plan['grid']
+    tolerance = 1e-6*(grid[1] - grid[0] if len(grid) > 1 else 1.0)
+    header, previous_rows = read_rows(session_dir + 'JV.dat')
+    # Source of every grid voltage: (directory, voltage in that directory's output)
+    sources = {index: (session_dir, voltage) for index, voltage in plan['reuse'].items()}
+    checks = []
+    for chunk, chunk_dir in zip(plan['chunks'], chunk_dirs):
+        chunk_header, chunk_rows = read_rows(chunk_dir + 'JV.dat')
+        chunk_voltages = [vext for vext, line in chunk_rows]
+        for index in chunk:
+            position = find_index(chunk_voltages, grid[index], tolerance)
+            if position is None:
+                return False
+            if index in sources:
+                checks.append((index, chunk_dir, chunk_voltages[position]))
+            else:
+                sources[index] = (chunk_dir, chunk_voltages[position])
+    if len(sources) != len(grid):
+        return False
+
+    # Continuity: J at the overlapping voltages
+    j_values = {}
+    def get_j(directory, voltage):
+        if directory not in j_values:
+            directory_header, rows = read_rows(directory + 'JV.dat')
+            column = directory_header.split().index('Jext')
+            j_values[directory] = {vext: float(line.split()[column]) for vext, line in rows}
+        return j_values[directory][voltage]
+    j_scale = max(abs(get_j(*sources[index])) for index in range(len(grid)))
+    for index, directory, voltage in checks:
+        if abs(get_j(directory, voltage) - get_j(*sources[index])) > continuity_tolerance*max(j_scale, 1e-30):
+            return False
+
+    # Keep the scan direction of the previous run
+    descending = len(previous_rows) > 1 and previous_rows[0][0] > previous_rows[-1][0]
+    order = sorted(range(len(grid)), reverse=descending)
+    directories = set(directory for directory, voltage in sources.values())
+    for file_name in merged_files:
+        if not all(os.path.isfile(directory + file_name) for directory in directories):
+            continue
+        # Rows of every directory grouped per voltage; Var.dat has a block of rows per voltage
+        blocks = {}
+        for directory in directories:
+            file_header, rows = read_rows(directory + file_name)
+            for vext, line in rows:
+                blocks.setdefault(directory, {}).setdefault(vext, []).append(line)
+        with open(merge_dir + file_name, 'w') as fp:
+            fp.write(file_header)
+            for index in order:
+                directory, voltage = sources[index]
+                for vext, lines in blocks.get(directory, {}).items():
+                    if abs(vext - voltage) <= tolerance:
+                        fp.writelines(lines)
+    with open(merge_dir + 'log.txt', 'w') as fp:
+        fp.write('Merged from the previous run and ' + str(len(chunk_dirs)) + ' partial run(s)\n')
+        for chunk_dir in chunk_dirs:
+            if os.path.isfile(chunk_dir + 'log.txt'):
+                with open(chunk_dir + 'log.txt') as chunk_fp:
+                    fp.write(chunk_fp.read())
+    return True
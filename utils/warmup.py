@@ -0,0 +1,86 @@
+# warmup.py>
+import importlib
+import os
+import threading
+import time
+from functools import lru_cache
+from utils import dev_par_model as dpm
+from utils import metrics
+from utils import simss_runner as sr
+
+# Modules the pages only import when something is plotted. They are loaded in a background thread after the first page
+# has been shown, unless SIMSALABIM_PREWARM_IMPORTS=0.
+heavy_modules = ['pandas', 'matplotlib.figure', 'matplotlib.collections', 'seaborn']
+prewarm_imports = os.environ.get('SIMSALABIM_PREWARM_IMPORTS', '1') != '0'
+
+_lock = threading.Lock()
+_prewarmed = False
+_first_paint_reported = False
+_module_loaded = time.time()
+
+
+def get_process_start():
+    # Description:  Start time of the server process, used to report the time until the first page was shown.
+    # Returns:      start (float) - start time in seconds since the epoch
+    try:
+        # Linux: starttime (field 22 of /proc/self/stat) is in clock ticks since boot, /proc/uptime the seconds since
+        # boot. The process name (field 2) may contain spaces, so the fields are counted from its closing parenthesis.
+        with open('/proc/self/stat') as fp:
+            start_ticks = int(fp.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as fp:
+            uptime = float(fp.read().split()[0])
+        return time.time() - (uptime - start_ticks/os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return _module_loaded
+
+@lru_cache(maxsize=1)
+def get_default_model():
+    # Description:  The default device parameters (device_parameters_default_1.txt), parsed once per process.
+    #               Callers must copy() the model before changing it.
+    # Returns:      dev_par_model (DevParModel) - the default device parameters
+    with metrics.span('startup.parse_default_parameters'):
+        return dpm.read_dev_par_file(sr.SimSS_path + 'device_parameters_default_1.txt')
+
+def import_heavy_modules():
+    # Description:  Import the plotting and data modules, recording the import time of each of them.
+    for module_name in heavy_modules:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            continue
+        metrics.observe('startup.import.' + module_name, time.perf_counter() - start)
+
+def prewarm():
+    # Description:  Prepare the process for the first requests. Runs once per process, further calls return at once.
+    #               The default parameters are parsed and the simss location is resolved right away (both are cheap),
+    #               the heavy imports are started in a background thread so they do not delay the first page.
+    global _prewarmed
+    with _lock:
+        if _prewarmed:
+            return
+        _prewarmed = True
+    with metrics.span('startup.prewarm'):
+        try:
+            sr.locate_simss()
+            get_default_model()
+        except OSError:
+            # simss not built (yet), the pages report this when it is used
+            pass
+    if prewarm_imports:
+        threading.Thread(target=import_heavy_modules, name='prewarm_imports', daemon=True).start()
+
+def report_first_paint(session_state, script_start):
+    # Description:  Report the time until the page controls were shown: once per process (time since the process
+    #               started) and once per session (duration of the first script run of the session).
+    # Arguments:    session_state (SessionState) - st.session_state of the current session
+    #               script_start (float) - time.perf_counter() at the start of the script
+    global _first_paint_reported
+    with _lock:
+        first_in_process = not _first_paint_reported
+        _first_paint_reported = True
+    if first_in_process:
+        metrics.observe('startup.first_paint', time.time() - get_process_start())
+    if not session_state.get('first_paint_reported'):
+        session_state['first_paint_reported'] = True
+        metrics.observe('session.first_paint', time.perf_counter() - script_start)